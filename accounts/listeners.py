@@ -3,7 +3,14 @@
 #     from accounts.services import UserService
 #     UserService.invalidate_user(instance.id)
 
+def user_content_changed(sender, instance, **kwargs):
+    # import 写在函数里面避免循环依赖
+    from accounts.services import UserService
+    UserService.bump_content_version(instance.id)
+
+
 def profile_changed(sender, instance, **kwargs):
     # import 写在函数里面避免循环依赖
     from accounts.services import UserService
     UserService.invalidate_profile(instance.user_id)
+    UserService.bump_content_version(instance.user_id)
@@ -0,0 +1,35 @@
+from accounts.services import UserService
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        'Initialize the last-seen index used to skip dormant followers during fanout '
+        'from User.last_login (or date_joined). Users already in the index are kept.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='number of users written by each ZADD, default: 1000',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = 0
+        total, added = 0, 0
+        while True:
+            users = list(
+                User.objects.filter(id__gt=last_id)
+                .order_by('id')
+                .only('id', 'last_login', 'date_joined')[:batch_size]
+            )
+            if not users:
+                break
+            added += UserService.backfill_last_seen(users)
+            total += len(users)
+            last_id = users[-1].id
+        self.stdout.write('{} users checked, {} added to the last-seen index.'.format(total, added))
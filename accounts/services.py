@@ -1,13 +1,28 @@
 from accounts.models import UserProfile
+from collections import OrderedDict
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import caches
-from twitter.cache import USER_PROFILE_PATTERN
+from twitter.cache import (
+    USER_CONTENT_VERSION_PATTERN,
+    USER_LAST_SEEN_KEY,
+    USER_PROFILE_PATTERN,
+)
+from utils.local_cache import LocalCache
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+
+import threading
+import time
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
 
 class UserService:
+    # user_id -> 这个进程最近一次写 last seen 的时间，按照写的时间从旧到新排列
+    last_seen_written = OrderedDict()
+    last_seen_lock = threading.Lock()
 
     # @classmethod
     # def get_user_through_cache(cls, user_id):
@@ -35,19 +50,165 @@ class UserService:
     @classmethod
     def get_profile_through_cache(cls, user_id):
         key = USER_PROFILE_PATTERN.format(user_id=user_id)
+        # 先读进程内的 L1 cache
+        profile = LocalCache.get(key)
+        if profile is not None:
+            return profile
 
         # read from cache first
         profile = cache.get(key)
         # cache hit return
         if profile is not None:
+            LocalCache.set(key, profile)
             return profile
 
         # cache miss, read from db
         profile, _ = UserProfile.objects.get_or_create(user_id=user_id)
         cache.set(key, profile)
+        LocalCache.set(key, profile)
         return profile
 
+    @classmethod
+    def get_profiles_through_cache(cls, user_ids):
+        """
+        批量读取 profiles，返回 {user_id: profile}
+        """
+        user_ids = list({user_id for user_id in user_ids if user_id is not None})
+        keys = {user_id: USER_PROFILE_PATTERN.format(user_id=user_id) for user_id in user_ids}
+        profiles = {}
+        for user_id, key in keys.items():
+            profile = LocalCache.get(key)
+            if profile is not None:
+                profiles[user_id] = profile
+        keys = {user_id: key for user_id, key in keys.items() if user_id not in profiles}
+        if not keys:
+            return profiles
+
+        cached = cache.get_many(list(keys.values()))
+        missing_ids = []
+        for user_id, key in keys.items():
+            profile = cached.get(key)
+            if profile is not None:
+                profiles[user_id] = profile
+                LocalCache.set(key, profile)
+            else:
+                missing_ids.append(user_id)
+        if not missing_ids:
+            return profiles
+
+        loaded = {
+            profile.user_id: profile
+            for profile in UserProfile.objects.filter(user_id__in=missing_ids)
+        }
+        for user_id in missing_ids:
+            # 还没有 profile 的 user 很少，逐个 get_or_create
+            if user_id not in loaded:
+                loaded[user_id], _ = UserProfile.objects.get_or_create(user_id=user_id)
+        cache.set_many({keys[user_id]: profile for user_id, profile in loaded.items()})
+        for user_id, profile in loaded.items():
+            LocalCache.set(keys[user_id], profile)
+        profiles.update(loaded)
+        return profiles
+
+    @classmethod
+    def preload_cached_users(cls, objects, user_id_attr='user_id', cached_attr='_cached_user'):
+        """
+        给一页 objects（tweets, comments, likes, friendships）批量读取 user 和 profile
+        记录在 object 的 cached_attr 和 user 的 _cached_user_profile 上
+        之后 serializer 访问 cached_user 和 user.profile 时不会再访问 memcached
+        """
+        user_ids = [getattr(obj, user_id_attr) for obj in objects]
+        users = MemcachedHelper.get_objects_through_cache(User, user_ids)
+        profiles = cls.get_profiles_through_cache(users.keys())
+        for user in users.values():
+            setattr(user, '_cached_user_profile', profiles[user.id])
+        for obj in objects:
+            user = users.get(getattr(obj, user_id_attr))
+            if user is not None:
+                setattr(obj, cached_attr, user)
+
     @classmethod
     def invalidate_profile(cls, user_id):
         key = USER_PROFILE_PATTERN.format(user_id=user_id)
         cache.delete(key)
+        LocalCache.invalidate(key)
+
+    @classmethod
+    def bump_content_version(cls, user_id):
+        # user / profile / tweets 有变化，包含这个 user 的内容的渲染结果都过期了
+        RedisHelper.bump_versions([USER_CONTENT_VERSION_PATTERN.format(user_id=user_id)])
+
+    @classmethod
+    def get_content_version_keys(cls, user_ids):
+        return [USER_CONTENT_VERSION_PATTERN.format(user_id=user_id) for user_id in user_ids]
+
+    @classmethod
+    def get_content_versions(cls, user_ids):
+        return RedisHelper.get_versions(cls.get_content_version_keys(user_ids))
+
+    @classmethod
+    def touch_last_seen(cls, user_id):
+        """
+        记录 user 最近一次访问的时间，返回之前记录的时间戳（没有记录过的时候返回 None）
+        同一个进程里每个 user 每隔 USER_LAST_SEEN_UPDATE_INTERVAL 秒才写一次 redis
+        没有写 redis 的时候返回 False
+        """
+        now = time.time()
+        with cls.last_seen_lock:
+            written_at = cls.last_seen_written.get(user_id)
+            if written_at is not None and now - written_at < settings.USER_LAST_SEEN_UPDATE_INTERVAL:
+                return False
+            cls.last_seen_written[user_id] = now
+            cls.last_seen_written.move_to_end(user_id)
+            # 超过上限的时候只淘汰最早写的那些 users，其他 users 的 throttle 不受影响
+            while len(cls.last_seen_written) > settings.USER_LAST_SEEN_THROTTLE_MAX_SIZE:
+                cls.last_seen_written.popitem(last=False)
+
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline(transaction=False)
+        pipe.zscore(USER_LAST_SEEN_KEY, user_id)
+        pipe.zadd(USER_LAST_SEEN_KEY, {user_id: now})
+        previous, _ = pipe.execute()
+        return previous
+
+    @classmethod
+    def is_dormant_timestamp(cls, last_seen):
+        # 没有记录的 user 视为活跃，比如刚上线还没有执行 backfill_user_last_seen 的时候
+        # 否则所有的 followers 都会被当成不活跃的，每次 fanout 都会清掉他们的 cache
+        if last_seen is None:
+            return False
+        return last_seen < time.time() - settings.USER_DORMANT_DAYS * 86400
+
+    @classmethod
+    def backfill_last_seen(cls, users):
+        """
+        用 last_login（没有登录过的时候用 date_joined）初始化 users 最近一次访问的时间
+        已经有记录的 users 不会被覆盖
+        """
+        mapping = {}
+        for user in users:
+            seen_at = user.last_login or user.date_joined
+            mapping[user.id] = seen_at.timestamp()
+        if not mapping:
+            return 0
+        conn = RedisClient.get_connection()
+        return conn.zadd(USER_LAST_SEEN_KEY, mapping, nx=True)
+
+    @classmethod
+    def split_active_user_ids(cls, user_ids):
+        """
+        一次 round trip 把 user_ids 分成 (活跃的 user ids, 不活跃的 user ids)
+        """
+        if not user_ids:
+            return [], []
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.zscore(USER_LAST_SEEN_KEY, user_id)
+        active_ids, dormant_ids = [], []
+        for user_id, last_seen in zip(user_ids, pipe.execute()):
+            if cls.is_dormant_timestamp(last_seen):
+                dormant_ids.append(user_id)
+            else:
+                active_ids.append(user_id)
+        return active_ids, dormant_ids
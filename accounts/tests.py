@@ -1,5 +1,9 @@
 from accounts.models import UserProfile
+from accounts.services import UserService
+from datetime import timedelta
+from django.test import override_settings
 from testing.testcases import TestCase
+from utils.time_helpers import utc_now
 
 
 class UserProfileTests(TestCase):
@@ -13,3 +17,53 @@ class UserProfileTests(TestCase):
         p = linghu.profile
         self.assertEqual(isinstance(p, UserProfile), True)
         self.assertEqual(UserProfile.objects.count(), 1)
+
+    def test_preload_cached_users(self):
+        linghu = self.create_user('linghu')
+        dongxie = self.create_user('dongxie')
+        tweets = [
+            self.create_tweet(linghu),
+            self.create_tweet(dongxie),
+            self.create_tweet(linghu),
+        ]
+        UserService.preload_cached_users(tweets)
+        self.assertEqual([t.cached_user.id for t in tweets], [linghu.id, dongxie.id, linghu.id])
+        # 没有 profile 的 user 会创建 profile
+        self.assertEqual(UserProfile.objects.count(), 2)
+        self.assertEqual(tweets[0].cached_user.profile.user_id, linghu.id)
+
+        profiles = UserService.get_profiles_through_cache([linghu.id, dongxie.id])
+        self.assertEqual(profiles[dongxie.id].user_id, dongxie.id)
+
+    def test_last_seen(self):
+        UserService.last_seen_written.clear()
+        linghu = self.create_user('linghu')
+        dongxie = self.create_user('dongxie')
+        self.assertEqual(UserService.touch_last_seen(linghu.id), None)
+        # 同一个进程里短时间内不会重复写 redis
+        self.assertEqual(UserService.touch_last_seen(linghu.id), False)
+        # 没有记录的 user 视为活跃
+        self.assertEqual(
+            UserService.split_active_user_ids([linghu.id, dongxie.id]),
+            ([linghu.id, dongxie.id], []),
+        )
+
+        # 用 last_login 初始化，已经有记录的 user 不会被覆盖
+        linghu.last_login = dongxie.last_login = utc_now() - timedelta(days=60)
+        self.assertEqual(UserService.backfill_last_seen([linghu, dongxie]), 1)
+        self.assertEqual(
+            UserService.split_active_user_ids([linghu.id, dongxie.id]),
+            ([linghu.id], [dongxie.id]),
+        )
+
+    @override_settings(USER_LAST_SEEN_THROTTLE_MAX_SIZE=2)
+    def test_last_seen_throttle_eviction(self):
+        UserService.last_seen_written.clear()
+        users = [self.create_user('user{}'.format(i)) for i in range(3)]
+        for user in users:
+            UserService.touch_last_seen(user.id)
+        # 只淘汰最早写的 user，其他 users 还在 throttle 里
+        self.assertEqual(list(UserService.last_seen_written), [users[1].id, users[2].id])
+        self.assertEqual(UserService.touch_last_seen(users[2].id), False)
+        self.assertNotEqual(UserService.touch_last_seen(users[0].id), False)
+        self.assertEqual(list(UserService.last_seen_written), [users[2].id, users[0].id])
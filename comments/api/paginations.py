@@ -0,0 +1,92 @@
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from utils.paginations import decode_cursor, encode_cursor
+from utils.time_helpers import datetime_to_microseconds
+
+
+class CommentPagination(BasePagination):
+    """
+    comments 按照 (created_at, id) 从旧到新排列，cursor 是上一页最后一个 comment 的 (created_at, id)
+    http://localhost/api/comments/?tweet_id=1&cursor=xxx
+    """
+    page_size = 20
+
+    def __init__(self):
+        super(CommentPagination, self).__init__()
+        self.has_next_page = False
+        self.next_cursor = None
+
+    # 'to_html() must be implemented to display page controls.'
+    def to_html(self):
+        pass
+
+    @classmethod
+    def get_cursor(cls, request):
+        if 'cursor' not in request.query_params:
+            return None, None
+        return decode_cursor(request.query_params['cursor'])
+
+    @classmethod
+    def _is_after(cls, comment, created_at, comment_id):
+        if created_at is None:
+            return True
+        if comment_id is None:
+            return comment.created_at > created_at
+        return (datetime_to_microseconds(comment.created_at), comment.id) > \
+            (datetime_to_microseconds(created_at), comment_id)
+
+    def _get_page(self, comments):
+        self.has_next_page = len(comments) > self.page_size
+        comments = comments[:self.page_size]
+        if self.has_next_page:
+            last = comments[-1]
+            self.next_cursor = encode_cursor(last.created_at, last.id)
+        return comments
+
+    def paginate_queryset(self, queryset, request, view=None):
+        created_at, comment_id = self.get_cursor(request)
+        if comment_id is not None:
+            # 可以用到 (tweet, created_at) 的联合索引，created_at 相同的 comments 再比较 id
+            queryset = queryset.filter(
+                Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=comment_id),
+            )
+        elif created_at is not None:
+            queryset = queryset.filter(created_at__gt=created_at)
+        # 多读一个 comment 用来判断是否还有下一页
+        comments = list(queryset.order_by('created_at', 'id')[:self.page_size + 1])
+        return self._get_page(comments)
+
+    def paginate_cached_range(self, load_range, request):
+        """
+        load_range(created_at__gte=None, count=None) 从 sorted set 里按照 (created_at, id)
+        从小到大读取，返回 (comments, cache 里 comments 的总数)
+        cache 里是最早的 REDIS_LIST_LENGTH_LIMIT 个 comments，cache 满了并且 cursor 之后
+        不够一页的时候，后面的 comments 可能不在 cache 里，返回 None，需要去数据库查询
+        """
+        created_at, comment_id = self.get_cursor(request)
+        count = self.page_size + 1
+        while True:
+            loaded, cached_length = load_range(created_at__gte=created_at, count=count)
+            # score 和 cursor 相同的 comments 里可能有在 cursor 之前的，过滤掉之后不够一页的话多读一些
+            comments = [
+                comment for comment in loaded
+                if self._is_after(comment, created_at, comment_id)
+            ]
+            if len(comments) > self.page_size:
+                break
+            if len(loaded) < count:
+                # cache 里 cursor 之后的 comments 已经读完了
+                if cached_length >= settings.REDIS_LIST_LENGTH_LIMIT:
+                    return None
+                break
+            count *= 2
+        return self._get_page(comments)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'has_next_page': self.has_next_page,
+            'next_cursor': self.next_cursor,
+            'comments': data,
+        })
@@ -1,9 +1,12 @@
 from accounts.api.serializers import UserSerializerForComment
+from accounts.services import UserService
 from comments.models import Comment
 from likes.services import LikeService
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from tweets.models import Tweet
+from utils.redis_helper import RedisHelper
+from utils.serializers import PreloadListSerializer
 
 
 class CommentSerializer(serializers.ModelSerializer):
@@ -22,11 +25,31 @@ class CommentSerializer(serializers.ModelSerializer):
             'likes_count',
             'has_liked',
         )
+        list_serializer_class = PreloadListSerializer
+
+    def preload(self, comments):
+        UserService.preload_cached_users(comments)
+        # 一次 MGET 读出整页 comments 的 likes_count
+        setattr(self, '_preloaded_counts', RedisHelper.get_counts(comments, ['likes_count']))
+        # 一次 object_id__in 的查询读出当前用户点过赞的 comments
+        liked_comment_ids = LikeService.get_liked_object_ids(
+            self.context['request'].user,
+            Comment,
+            [comment.id for comment in comments],
+        )
+        setattr(self, '_preloaded_liked_comment_ids', liked_comment_ids)
 
     def get_likes_count(self, obj):
-        return obj.like_set.count()
+        # return obj.like_set.count()
+        counts = getattr(self, '_preloaded_counts', {})
+        if 'likes_count' in counts.get(obj.id, {}):
+            return counts[obj.id]['likes_count']
+        return RedisHelper.get_count(obj, 'likes_count')
 
     def get_has_liked(self, obj):
+        liked_comment_ids = getattr(self, '_preloaded_liked_comment_ids', None)
+        if liked_comment_ids is not None:
+            return obj.id in liked_comment_ids
         return LikeService.has_liked(self.context['request'].user, obj)
 
 
@@ -1,7 +1,11 @@
+from comments.api.paginations import CommentPagination
 from comments.models import Comment
+from comments.services import CommentService
+from django.test import override_settings
 from django.utils import timezone
 from rest_framework.test import APIClient
 from testing.testcases import TestCase
+from utils.metrics import Metrics
 
 
 COMMENT_URL = '/api/comments/'
@@ -139,6 +143,88 @@ class CommentApiTests(TestCase):
         })
         self.assertEqual(len(response.data['comments']), 2)
 
+    def test_list_pagination(self):
+        # cache 里的 comments 按照 (created_at, id) 从旧到新排列
+        comments = [
+            self.create_comment(self.linghu, self.tweet, str(i))
+            for i in range(3)
+        ]
+        cached_comments, cached_length = CommentService.get_cached_comments_range(self.tweet.id)
+        self.assertEqual(cached_length, 3)
+        self.assertEqual([c.id for c in cached_comments], [c.id for c in comments])
+        response = self.anonymous_client.get(COMMENT_URL, {'tweet_id': self.tweet.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(response.data['next_cursor'], None)
+        self.assertEqual(
+            [c['id'] for c in response.data['comments']],
+            [c.id for c in comments],
+        )
+
+        # 删除 comment 之后 cache 被清空，重新读取时不会再读到被删除的 comment
+        comments[1].delete()
+        response = self.anonymous_client.get(COMMENT_URL, {'tweet_id': self.tweet.id})
+        self.assertEqual(
+            [c['id'] for c in response.data['comments']],
+            [comments[0].id, comments[2].id],
+        )
+        comments.pop(1)
+
+        # comments 超过 cache 的长度限制之后从数据库里翻页
+        page_size = CommentPagination.page_size
+        for i in range(page_size):
+            comments.append(self.create_comment(self.dongxie, self.tweet, str(i)))
+        response = self.anonymous_client.get(COMMENT_URL, {'tweet_id': self.tweet.id})
+        self.assertEqual(response.data['has_next_page'], True)
+        self.assertEqual(
+            [c['id'] for c in response.data['comments']],
+            [c.id for c in comments[:page_size]],
+        )
+        response = self.anonymous_client.get(COMMENT_URL, {
+            'tweet_id': self.tweet.id,
+            'cursor': response.data['next_cursor'],
+        })
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(
+            [c['id'] for c in response.data['comments']],
+            [c.id for c in comments[page_size:]],
+        )
+
+        # 不合法的 cursor
+        response = self.anonymous_client.get(COMMENT_URL, {
+            'tweet_id': self.tweet.id,
+            'cursor': '!',
+        })
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(REDIS_LIST_LENGTH_LIMIT=CommentPagination.page_size * 2)
+    def test_list_pagination_over_cache_limit(self):
+        page_size = CommentPagination.page_size
+        comments = [
+            self.create_comment(self.dongxie, self.tweet, str(i))
+            for i in range(page_size * 3)
+        ]
+        # cache 里只保存最早的 REDIS_LIST_LENGTH_LIMIT 个 comments，新的 comments 不会挤掉它们
+        cached_comments, cached_length = CommentService.get_cached_comments_range(self.tweet.id)
+        self.assertEqual(cached_length, page_size * 2)
+        self.assertEqual([c.id for c in cached_comments], [c.id for c in comments[:page_size * 2]])
+
+        Metrics.clear()
+        results = []
+        response = self.anonymous_client.get(COMMENT_URL, {'tweet_id': self.tweet.id})
+        results.extend(response.data['comments'])
+        while response.data['has_next_page']:
+            response = self.anonymous_client.get(COMMENT_URL, {
+                'tweet_id': self.tweet.id,
+                'cursor': response.data['next_cursor'],
+            })
+            results.extend(response.data['comments'])
+        self.assertEqual([c['id'] for c in results], [c.id for c in comments])
+        # 翻到 cache 后面的页去数据库查询，不会每次都重建 cache
+        self.assertEqual(Metrics.get_counters().get('redis_cache.rebuild'), None)
+        _, cached_length = CommentService.get_cached_comments_range(self.tweet.id)
+        self.assertEqual(cached_length, page_size * 2)
+
     def test_comments_count(self):
         # test tweet detail api
         tweet = self.create_tweet(self.linghu)
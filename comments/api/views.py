@@ -1,9 +1,11 @@
+from comments.api.paginations import CommentPagination
 from comments.api.serializers import (
     CommentSerializer,
     CommentSerializerForCreate,
     CommentSerializerForUpdate,
 )
 from comments.models import Comment
+from comments.services import CommentService
 from django.utils.decorators import method_decorator
 from inbox.services import NotificationService
 from ratelimit.decorators import ratelimit
@@ -22,6 +24,7 @@ class CommentViewSet(viewsets.GenericViewSet):
     serializer_class = CommentSerializerForCreate
     queryset = Comment.objects.all()
     filterset_fields = ('tweet_id',)
+    pagination_class = CommentPagination
 
     # POST /api/comments/ -> create
     # GET /api/comments/ -> list
@@ -50,17 +53,26 @@ class CommentViewSet(viewsets.GenericViewSet):
         #             'message': 'missing tweet_id in request',
         #             'success': False,
         #         }, status=status.HTTP_400_BAD_REQUEST,)
-        queryset = self.get_queryset()
-        comments = self.filter_queryset(queryset).order_by('created_at')
+        # filter_queryset 会检查 tweet_id 的格式，不合法的时候返回 400
+        queryset = self.filter_queryset(self.get_queryset())
+        tweet_id = int(request.query_params['tweet_id'])
+        # 先从 redis 里读这一页的 comment ids，cache 里的数据不全的时候再去数据库查询
+        comments = self.paginator.paginate_cached_range(
+            lambda created_at__gte=None, count=None: CommentService.get_cached_comments_range(
+                tweet_id,
+                created_at__gte=created_at__gte,
+                count=count,
+            ),
+            request,
+        )
+        if comments is None:
+            comments = self.paginate_queryset(queryset)
         serializer = CommentSerializer(
             comments,
             context={'request': request},
             many=True,
         )
-        return Response(
-            {'comments': serializer.data},
-            status=status.HTTP_200_OK,
-        )
+        return self.get_paginated_response(serializer.data)
 
         # 不用filter的方式
         # tweet_id = requests.query_params['tweet_id']
@@ -1,3 +1,4 @@
+from django.conf import settings
 from utils.listeners import invalidate_object_cache
 from utils.redis_helper import RedisHelper
 
@@ -5,21 +6,43 @@ def incr_comments_count(sender, instance, created, **kwargs):
     from tweets.models import Tweet
     from django.db.models import F
 
-    if not created:
+    # tweet 被删除之后 comment 的 tweet_id 是 None
+    if not created or instance.tweet_id is None:
         return
 
     # handle new comment
-    Tweet.objects.filter(id=instance.tweet_id)\
-        .update(comments_count=F('comments_count') + 1)
+    # write-behind 模式下只改 redis 计数器，由 flush_tweet_counters_task 定期批量写回数据库
+    if not settings.COUNTER_WRITE_BEHIND:
+        Tweet.objects.filter(id=instance.tweet_id)\
+            .update(comments_count=F('comments_count') + 1)
     # invalidate_object_cache(sender=Tweet, instance=instance.tweet)
-    RedisHelper.incr_count(instance.tweet, 'comments_count')
+
+    # 只修改已经存在的 redis 计数器，不存在的时候读取的时候再从数据库初始化
+    RedisHelper.incr_count(Tweet(id=instance.tweet_id), 'comments_count')
 
 def decr_comments_count(sender, instance, **kwargs):
     from tweets.models import Tweet
     from django.db.models import F
 
+    if instance.tweet_id is None:
+        return
+
     # handle comment deletion
-    Tweet.objects.filter(id=instance.tweet_id)\
-        .update(comments_count=F('comments_count') - 1)
+    if not settings.COUNTER_WRITE_BEHIND:
+        Tweet.objects.filter(id=instance.tweet_id)\
+            .update(comments_count=F('comments_count') - 1)
     # invalidate_object_cache(sender=Tweet, instance=instance.tweet)
-    RedisHelper.decr_count(instance.tweet, 'comments_count')
+    RedisHelper.decr_count(Tweet(id=instance.tweet_id), 'comments_count')
+
+
+def push_comment_to_cache(sender, instance, created, **kwargs):
+    if not created:
+        return
+
+    from comments.services import CommentService
+    CommentService.push_comment_to_cache(instance)
+
+
+def invalidate_cached_comments(sender, instance, **kwargs):
+    from comments.services import CommentService
+    CommentService.invalidate_cached_comments(instance.tweet_id)
@@ -0,0 +1,32 @@
+from comments.models import Comment
+from comments.services import CommentService
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Recompute Comment.likes_count from the likes table, batch by batch in id order.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='number of comments updated by each UPDATE statement, default: 500',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = 0
+        total = 0
+        while True:
+            comment_ids = list(
+                Comment.objects.filter(id__gt=last_id)
+                .order_by('id')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not comment_ids:
+                break
+            CommentService.reconcile_likes_counts(comment_ids)
+            total += len(comment_ids)
+            last_id = comment_ids[-1]
+        self.stdout.write('{} comments backfilled.'.format(total))
@@ -5,7 +5,13 @@ from likes.models import Like
 from django.contrib.contenttypes.models import ContentType
 # from accounts.services import UserService
 from utils.memcached_helper import MemcachedHelper
-from comments.listeners import incr_comments_count, decr_comments_count
+from comments.listeners import (
+    decr_comments_count,
+    incr_comments_count,
+    invalidate_cached_comments,
+    push_comment_to_cache,
+)
+from utils.listeners import invalidate_object_cache
 from django.db.models.signals import post_save, pre_delete
 
 
@@ -20,6 +26,10 @@ class Comment(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # 和 Tweet.likes_count 一样设置 null=True，加 field 的时候不会锁表
+    # 已有的 comments 用 backfill_comment_likes_count 命令补上
+    likes_count = models.IntegerField(default=0, null=True)
+
     class Meta:
         # 有在某个 tweet 下排序所有 comments 的需求
         index_together = (('tweet', 'created_at'),)
@@ -43,8 +53,17 @@ class Comment(models.Model):
     @property
     def cached_user(self):
         # return UserService.get_user_through_cache(user_id=self.user_id)
-        return MemcachedHelper.get_object_through_cache(User, self.user_id)
+        # serializer 的 preload 会提前批量读好 user 记录在 _cached_user 上
+        if hasattr(self, '_cached_user'):
+            return getattr(self, '_cached_user')
+        user = MemcachedHelper.get_object_through_cache(User, self.user_id)
+        setattr(self, '_cached_user', user)
+        return user
 
 
 post_save.connect(incr_comments_count, sender=Comment)
 pre_delete.connect(decr_comments_count, sender=Comment)
+post_save.connect(push_comment_to_cache, sender=Comment)
+pre_delete.connect(invalidate_cached_comments, sender=Comment)
+post_save.connect(invalidate_object_cache, sender=Comment)
+pre_delete.connect(invalidate_object_cache, sender=Comment)
@@ -0,0 +1,83 @@
+from comments.models import Comment
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Case, Count, IntegerField, Value, When
+from likes.models import Like
+from twitter.cache import TWEET_COMMENTS_PATTERN
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+from utils.time_helpers import datetime_to_microseconds
+
+
+class CommentService(object):
+
+    # tweet 的 comments 在 redis 里存成一个 sorted set，只存 ids
+    # member 补齐到相同的长度，created_at 相同的时候 sorted set 按照 member 的字典序排列
+    # 也就是按照 id 排列，和数据库里 order by created_at, id 的顺序一致
+    @classmethod
+    def _to_member(cls, comment):
+        return '{:020d}'.format(comment.id), datetime_to_microseconds(comment.created_at)
+
+    @classmethod
+    def _get_queryset(cls, tweet_id):
+        # comments 从旧到新翻页，cache 里保存的是最早的 REDIS_LIST_LENGTH_LIMIT 个 comments
+        # 这样 cache 满了之后前面的那些页还是可以从 cache 里读，新的 comments 不再加进 cache
+        return Comment.objects.filter(tweet_id=tweet_id).order_by('created_at', 'id')
+
+    @classmethod
+    def get_cached_comments_range(cls, tweet_id, created_at__gte=None, count=None):
+        """
+        按照 (created_at, id) 从小到大读取 created_at >= created_at__gte 的前 count 个 comments
+        返回 (comments, cache 里 comments 的总数)
+        """
+        min_score = None
+        if created_at__gte is not None:
+            min_score = datetime_to_microseconds(created_at__gte) - 1
+        items, cached_length = RedisHelper.load_sorted_set_range(
+            TWEET_COMMENTS_PATTERN.format(tweet_id=tweet_id),
+            cls._get_queryset(tweet_id),
+            cls._to_member,
+            min_score=min_score,
+            count=count,
+            ascending=True,
+        )
+        comment_ids = [int(member) for member, _ in items]
+        # 一次 get_many 读出这一页的 comments
+        comments = MemcachedHelper.get_objects_through_cache(Comment, comment_ids)
+        return [
+            comments[comment_id]
+            for comment_id in comment_ids
+            if comment_id in comments
+        ], cached_length
+
+    @classmethod
+    def push_comment_to_cache(cls, comment):
+        RedisHelper.push_to_sorted_set(
+            TWEET_COMMENTS_PATTERN.format(tweet_id=comment.tweet_id),
+            comment,
+            cls._get_queryset(comment.tweet_id),
+            cls._to_member,
+            ascending=True,
+        )
+
+    @classmethod
+    def invalidate_cached_comments(cls, tweet_id):
+        # cache 满了的时候删掉一个 member 会让 cache 看起来是完整的，所以直接删除整个 cache
+        conn = RedisClient.get_connection()
+        conn.delete(TWEET_COMMENTS_PATTERN.format(tweet_id=tweet_id))
+
+    @classmethod
+    def reconcile_likes_counts(cls, comment_ids):
+        """
+        用 likes 表重新计算这些 comments 的 likes_count，并且清掉 redis 里的计数器
+        """
+        likes_counts = dict(Like.objects.filter(
+            content_type=ContentType.objects.get_for_model(Comment),
+            object_id__in=comment_ids,
+        ).values('object_id').annotate(count=Count('id')).values_list('object_id', 'count'))
+        Comment.objects.filter(id__in=comment_ids).update(likes_count=Case(
+            *[When(id=comment_id, then=Value(count)) for comment_id, count in likes_counts.items()],
+            default=Value(0),
+            output_field=IntegerField(),
+        ))
+        RedisHelper.reset_counts(Comment, comment_ids, ['likes_count'])
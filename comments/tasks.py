@@ -0,0 +1,11 @@
+from celery import shared_task
+from comments.models import Comment
+from utils.redis_helper import RedisHelper
+from utils.time_constants import ONE_HOUR
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def flush_comment_counters_task():
+    # write-behind 模式下累积在 redis 里的 comments 的 likes_count 变化批量写回数据库
+    flushed = RedisHelper.flush_count_deltas(Comment, 'likes_count')
+    return '{} likes_count flushed.'.format(flushed)
@@ -1,4 +1,8 @@
+from comments.models import Comment
+from django.core.management import call_command
+from io import StringIO
 from testing.testcases import TestCase
+from utils.redis_helper import RedisHelper
 
 class CommentModelTests(TestCase):
 
@@ -25,3 +29,18 @@ class CommentModelTests(TestCase):
         dongxie = self.create_user('dongxie')
         self.create_like(dongxie, self.comment)
         self.assertEqual(self.comment.like_set.count(), 2)
+
+    def test_backfill_likes_count(self):
+        dongxie = self.create_user('dongxie')
+        self.create_like(self.linghu, self.comment)
+        self.create_like(dongxie, self.comment)
+        other = self.create_comment(dongxie, self.tweet)
+
+        # 模拟加 field 之前已经存在的数据
+        Comment.objects.update(likes_count=0)
+        call_command('backfill_comment_likes_count', batch_size=1, stdout=StringIO())
+        self.comment.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(self.comment.likes_count, 2)
+        self.assertEqual(other.likes_count, 0)
+        self.assertEqual(RedisHelper.get_count(self.comment, 'likes_count'), 2)
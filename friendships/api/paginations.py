@@ -1,5 +1,7 @@
+from django.db.models import Q
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
+from utils.paginations import decode_cursor, encode_cursor
 
 
 class FriendshipPagination(PageNumberPagination):
@@ -11,8 +13,55 @@ class FriendshipPagination(PageNumberPagination):
     page_size_query_param = 'size'
     max_page_size = 20
 
+    # 带 cursor 参数的请求按照 cursor 翻页，第一页传一个空的 cursor
+    # http://localhost/api/friendships/1/followers/?cursor=
+    cursor_query_param = 'cursor'
+
+    def __init__(self):
+        super(FriendshipPagination, self).__init__()
+        self.cursor_mode = False
+        self.has_next_page = False
+        self.next_cursor = None
+        # cursor 模式下由 view 设置，从 redis 的计数器里读取
+        self.total_results = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        # 没有 cursor 参数的请求还是按照页码翻页，需要 COUNT(*) 和 OFFSET
+        # 返回的格式和以前一样，已有的 clients 不受影响
+        if self.cursor_query_param not in request.query_params:
+            return super(FriendshipPagination, self).paginate_queryset(queryset, request, view)
+
+        # cursor 模式，按照 (created_at, id) 倒序翻页
+        # 会用到 (to_user_id, created_at) 或者 (from_user_id, created_at) 的联合索引
+        # InnoDB 的二级索引里包含了主键，所以 created_at 相同的时候比较 id 也不需要回表排序
+        self.cursor_mode = True
+        page_size = self.get_page_size(request)
+        cursor = request.query_params[self.cursor_query_param]
+        if cursor:
+            created_at, friendship_id = decode_cursor(cursor)
+            if friendship_id is None:
+                queryset = queryset.filter(created_at__lt=created_at)
+            else:
+                queryset = queryset.filter(
+                    Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=friendship_id),
+                )
+        friendships = list(queryset.order_by('-created_at', '-id')[:page_size + 1])
+        self.has_next_page = len(friendships) > page_size
+        friendships = friendships[:page_size]
+        if self.has_next_page:
+            last = friendships[-1]
+            self.next_cursor = encode_cursor(last.created_at, last.id)
+        return friendships
+
     # 当我完成翻页的功能之后，对返回给前端的数据进行包装。
     def get_paginated_response(self, data):
+        if self.cursor_mode:
+            return Response({
+                'total_results': self.total_results,
+                'has_next_page': self.has_next_page,
+                'next_cursor': self.next_cursor,
+                'results': data,
+            })
         return Response({
             'total_results': self.page.paginator.count,
             'total_pages': self.page.paginator.num_pages,
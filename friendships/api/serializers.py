@@ -1,9 +1,11 @@
 from accounts.api.serializers import UserSerializerForFriendship
+from accounts.services import UserService
 from django.contrib.auth.models import User
 from friendships.models import Friendship
 from friendships.services import FriendshipService
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
+from utils.serializers import PreloadListSerializer
 
 
 class FollowingUserIdSetMixin:
@@ -39,6 +41,10 @@ class FollowerSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
         model = Friendship
         # user来自from_user， 下面这个fields不是对应model里面的fields，会先去user = UserSerializer(source='from_user')这里面找。
         fields = ('user', 'created_at', 'has_followed') # 哪些人粉了我，何时粉的我。
+        list_serializer_class = PreloadListSerializer
+
+    def preload(self, friendships):
+        UserService.preload_cached_users(friendships, 'from_user_id', '_cached_from_user')
 
 
     def get_has_followed(self, obj):
@@ -66,6 +72,10 @@ class FollowingSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
     class Meta:
         model = Friendship
         fields = ('user', 'created_at', 'has_followed')
+        list_serializer_class = PreloadListSerializer
+
+    def preload(self, friendships):
+        UserService.preload_cached_users(friendships, 'to_user_id', '_cached_to_user')
 
     def get_has_followed(self, obj):
         # if self.context['request'].user.is_anonymous:
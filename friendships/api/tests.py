@@ -2,6 +2,7 @@ from friendships.api.paginations import FriendshipPagination
 from friendships.models import Friendship
 from rest_framework.test import APIClient
 from testing.testcases import TestCase
+from utils.time_helpers import utc_now
 
 FOLLOW_URL = '/api/friendships/{}/follow/'
 UNFOLLOW_URL = '/api/friendships/{}/unfollow/'
@@ -222,3 +223,44 @@ class FriendshipApiTests(TestCase):
         self.assertEqual(response.data['total_results'], page_size * 2)
         self.assertEqual(response.data['page_number'], 1)
         self.assertEqual(response.data['has_next_page'], True)
+
+    def test_cursor_pagination(self):
+        page_size = FriendshipPagination.page_size
+        followers = []
+        for i in range(page_size * 2 + 1):
+            follower = self.create_user('linghu_follower{}'.format(i))
+            Friendship.objects.create(from_user=follower, to_user=self.linghu)
+            followers.append(follower)
+        # created_at 相同的 friendships 按照 id 翻页，不会跳过或者重复
+        Friendship.objects.filter(to_user=self.linghu).update(created_at=utc_now())
+
+        url = FOLLOWERS_URL.format(self.linghu.id)
+        # 没有 cursor 参数的时候还是按照页码翻页
+        response = self.anonymous_client.get(url)
+        self.assertEqual(response.data['total_results'], page_size * 2 + 1)
+        self.assertEqual(response.data['total_pages'], 3)
+        self.assertEqual(response.data['page_number'], 1)
+        self.assertEqual('next_cursor' in response.data, False)
+
+        # 空的 cursor 表示 cursor 模式的第一页
+        response = self.anonymous_client.get(url, {'cursor': ''})
+        self.assertEqual(response.data['total_results'], page_size * 2 + 1)
+        self.assertEqual('total_pages' in response.data, False)
+        results = response.data['results']
+        while response.data['has_next_page']:
+            response = self.anonymous_client.get(url, {'cursor': response.data['next_cursor']})
+            results.extend(response.data['results'])
+        self.assertEqual(
+            [r['user']['id'] for r in results],
+            [follower.id for follower in reversed(followers)],
+        )
+
+        # follow / unfollow 的时候更新计数器
+        self.dongxie_client.post(FOLLOW_URL.format(self.linghu.id))
+        response = self.anonymous_client.get(url, {'cursor': ''})
+        self.assertEqual(response.data['total_results'], page_size * 2 + 2)
+        self.dongxie_client.post(UNFOLLOW_URL.format(self.linghu.id))
+        response = self.anonymous_client.get(url, {'cursor': ''})
+        self.assertEqual(response.data['total_results'], page_size * 2 + 1)
+        response = self.anonymous_client.get(FOLLOWINGS_URL.format(self.dongxie.id), {'cursor': ''})
+        self.assertEqual(response.data['total_results'], Friendship.objects.filter(from_user=self.dongxie).count())
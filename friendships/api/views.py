@@ -8,6 +8,7 @@ from friendships.api.serializers import (
 )
 from friendships.models import Friendship
 from friendships.services import FriendshipService
+from newsfeeds.services import NewsFeedService
 from ratelimit.decorators import ratelimit
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
@@ -43,6 +44,9 @@ class FriendshipViewSet(viewsets.GenericViewSet):
         # < QuerySet[ < Friendship: 6 followed 7 >, < Friendship: 1 followed 7 >, < Friendship: 5 followed 7 >] >
         # 于是就需要将friendships传给paginate_queryset去根绝request里面的params进行筛选。
         page=self.paginate_queryset(friendships)
+        # cursor 模式下总数从 redis 的计数器里读取，不需要 COUNT(*)
+        if self.paginator.cursor_mode:
+            self.paginator.total_results = FriendshipService.get_follower_count(int(pk))
 
         # print('This is page {}:'.format(page))
         # This is page ------->
@@ -75,6 +79,8 @@ class FriendshipViewSet(viewsets.GenericViewSet):
         # This is followings: < QuerySet[ < Friendship: 5 followed 7 >, < Friendship: 5 followed 6 >] >.
 
         page = self.paginate_queryset(friendships)
+        if self.paginator.cursor_mode:
+            self.paginator.total_results = FriendshipService.get_following_count(int(pk))
         serializer = FollowingSerializer(
             page,
             context={'request': request},
@@ -111,6 +117,7 @@ class FriendshipViewSet(viewsets.GenericViewSet):
             }, status=status.HTTP_400_BAD_REQUEST)
         instance = serializer.save()
         FriendshipService.invalidate_following_cache(request.user.id)
+        NewsFeedService.on_follow(request.user.id, instance.to_user_id)
         return Response(
             FollowingSerializer(
                 instance,
@@ -141,5 +148,7 @@ class FriendshipViewSet(viewsets.GenericViewSet):
             to_user=pk,
         ).delete()
         FriendshipService.invalidate_following_cache(request.user.id)
+        if deleted:
+            NewsFeedService.on_unfollow(request.user.id, int(pk))
         return Response({'success': True, 'deleted': deleted})
 
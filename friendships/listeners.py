@@ -2,3 +2,16 @@ def invalidate_following_cache(sender, instance, **kwargs):
     # import 写在函数里面避免循环依赖
     from friendships.services import FriendshipService
     FriendshipService.invalidate_following_cache(instance.from_user_id)
+
+
+def incr_friendship_counts(sender, instance, created, **kwargs):
+    if not created:
+        return
+
+    from friendships.services import FriendshipService
+    FriendshipService.change_friendship_counts(instance, 1)
+
+
+def decr_friendship_counts(sender, instance, **kwargs):
+    from friendships.services import FriendshipService
+    FriendshipService.change_friendship_counts(instance, -1)
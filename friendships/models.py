@@ -1,7 +1,11 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save, pre_delete
-from friendships.listeners import invalidate_following_cache
+from friendships.listeners import (
+    decr_friendship_counts,
+    incr_friendship_counts,
+    invalidate_following_cache,
+)
 # from accounts.services import UserService
 from utils.memcached_helper import MemcachedHelper
 
@@ -42,11 +46,22 @@ class Friendship(models.Model):
     @property
     def cached_from_user(self):
         # return UserService.get_user_through_cache(user_id=self.from_user_id)
-        return MemcachedHelper.get_object_through_cache(User, self.from_user_id)
+        # serializer 的 preload 会提前批量读好 user 记录在 _cached_from_user 上
+        if hasattr(self, '_cached_from_user'):
+            return getattr(self, '_cached_from_user')
+        user = MemcachedHelper.get_object_through_cache(User, self.from_user_id)
+        setattr(self, '_cached_from_user', user)
+        return user
 
     @property
     def cached_to_user(self):
-        return MemcachedHelper.get_object_through_cache(User, self.to_user_id)
+        if hasattr(self, '_cached_to_user'):
+            return getattr(self, '_cached_to_user')
+        user = MemcachedHelper.get_object_through_cache(User, self.to_user_id)
+        setattr(self, '_cached_to_user', user)
+        return user
 
 pre_delete.connect(invalidate_following_cache, sender=Friendship)
 post_save.connect(invalidate_following_cache, sender=Friendship)
+pre_delete.connect(decr_friendship_counts, sender=Friendship)
+post_save.connect(incr_friendship_counts, sender=Friendship)
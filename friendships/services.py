@@ -1,7 +1,8 @@
 from django.conf import settings
 from django.core.cache import caches
 from friendships.models import Friendship
-from twitter.cache import FOLLOWINGS_PATTERN
+from twitter.cache import FOLLOWER_COUNT_PATTERN, FOLLOWING_COUNT_PATTERN, FOLLOWINGS_PATTERN
+from utils.redis_helper import RedisHelper
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
@@ -42,6 +43,56 @@ class FriendshipService(object):
         friendships = Friendship.objects.filter(to_user_id=to_user_id)
         return [friendship.from_user_id for friendship in friendships]
 
+    @classmethod
+    def iter_follower_id_batches(cls, to_user_id, batch_size, after_id=0):
+        """
+        按照 friendship id 做 keyset 分页，每次 yield (这一批最后一个 friendship id, follower ids)
+        每次只查询 batch_size 个 follower ids，不需要把所有的 followers 都读到内存里
+
+        这个查询会用到 to_user 这个 foreign key 的 index，InnoDB 的二级索引里包含了主键
+        所以相当于 (to_user_id, id) 的联合索引，where to_user_id = x and id > y order by id
+        不需要 offset，也不需要额外排序
+        """
+        last_id = after_id
+        while True:
+            rows = list(
+                Friendship.objects.filter(to_user_id=to_user_id, id__gt=last_id)
+                .order_by('id')
+                .values_list('id', 'from_user_id')[:batch_size]
+            )
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield last_id, [from_user_id for _, from_user_id in rows]
+            if len(rows) < batch_size:
+                return
+
+    @classmethod
+    def get_follower_count(cls, to_user_id):
+        return RedisHelper.get_count_through_cache(
+            FOLLOWER_COUNT_PATTERN.format(user_id=to_user_id),
+            Friendship.objects.filter(to_user_id=to_user_id),
+        )
+
+    @classmethod
+    def get_following_count(cls, from_user_id):
+        return RedisHelper.get_count_through_cache(
+            FOLLOWING_COUNT_PATTERN.format(user_id=from_user_id),
+            Friendship.objects.filter(from_user_id=from_user_id),
+        )
+
+    @classmethod
+    def change_friendship_counts(cls, friendship, delta):
+        # follow / unfollow 的时候更新 followers 和 followings 的个数
+        RedisHelper.change_existing_count(
+            FOLLOWER_COUNT_PATTERN.format(user_id=friendship.to_user_id),
+            delta,
+        )
+        RedisHelper.change_existing_count(
+            FOLLOWING_COUNT_PATTERN.format(user_id=friendship.from_user_id),
+            delta,
+        )
+
 
     @classmethod
     # def has_followed(cls, user, target):
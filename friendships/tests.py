@@ -24,3 +24,27 @@ class FriendshipServiceTests(TestCase):
         # FriendshipService.invalidate_following_cache(self.linghu.id)
         user_id_set = FriendshipService.get_following_user_id_set(self.linghu.id)
         self.assertSetEqual(user_id_set, {user1.id, user2.id})
+
+    def test_iter_follower_id_batches(self):
+        follower_ids = []
+        for i in range(5):
+            follower = self.create_user('follower{}'.format(i))
+            Friendship.objects.create(from_user=follower, to_user=self.linghu)
+            follower_ids.append(follower.id)
+        Friendship.objects.create(from_user=self.linghu, to_user=self.dongxie)
+
+        batches = list(FriendshipService.iter_follower_id_batches(self.linghu.id, 2))
+        self.assertEqual([ids for _, ids in batches], [
+            follower_ids[:2],
+            follower_ids[2:4],
+            follower_ids[4:],
+        ])
+
+        # 从上一批最后一个 friendship id 之后继续
+        batches = list(FriendshipService.iter_follower_id_batches(
+            self.linghu.id,
+            2,
+            after_id=batches[0][0],
+        ))
+        self.assertEqual([ids for _, ids in batches], [follower_ids[2:4], follower_ids[4:]])
+        self.assertEqual(list(FriendshipService.iter_follower_id_batches(self.dongxie.id, 2)), [])
@@ -1,10 +1,12 @@
 from accounts.api.serializers import UserSerializerForLike
+from accounts.services import UserService
 from comments.models import Comment
 from django.contrib.contenttypes.models import ContentType
 from likes.models import Like
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from tweets.models import Tweet
+from utils.serializers import PreloadListSerializer
 
 
 class LikeSerializer(serializers.ModelSerializer):
@@ -13,6 +15,10 @@ class LikeSerializer(serializers.ModelSerializer):
     class Meta:
         model = Like
         fields = ('user', 'created_at')
+        list_serializer_class = PreloadListSerializer
+
+    def preload(self, likes):
+        UserService.preload_cached_users(likes)
 
 
 class BaseLikeSerializerForCreateAndCancel(serializers.ModelSerializer):
@@ -263,3 +263,26 @@ class LikeApiTests(TestCase):
         self.assertEqual(response.data['results'][0]['tweet']['likes_count'], 3)
         response = self.dongxie_client.get(newsfeed_url)
         self.assertEqual(response.data['results'][0]['tweet']['likes_count'], 3)
+
+    def test_comment_likes_count(self):
+        tweet = self.create_tweet(self.linghu)
+        comment = self.create_comment(self.linghu, tweet)
+        data = {'content_type': 'comment', 'object_id': comment.id}
+        self.linghu_client.post(LIKE_BASE_URL, data)
+        self.dongxie_client.post(LIKE_BASE_URL, data)
+        comment.refresh_from_db()
+        self.assertEqual(comment.likes_count, 2)
+
+        response = self.dongxie_client.get(COMMENT_LIST_API, {'tweet_id': tweet.id})
+        self.assertEqual(response.data['comments'][0]['likes_count'], 2)
+        self.assertEqual(response.data['comments'][0]['has_liked'], True)
+        response = self.dongxie_client.get(TWEET_DETAIL_API.format(tweet.id))
+        self.assertEqual(response.data['comments'][0]['likes_count'], 2)
+
+        # dongxie canceled likes
+        self.dongxie_client.post(LIKE_CANCEL_URL, data)
+        comment.refresh_from_db()
+        self.assertEqual(comment.likes_count, 1)
+        response = self.dongxie_client.get(COMMENT_LIST_API, {'tweet_id': tweet.id})
+        self.assertEqual(response.data['comments'][0]['likes_count'], 1)
+        self.assertEqual(response.data['comments'][0]['has_liked'], False)
@@ -1,16 +1,26 @@
+from django.conf import settings
 from utils.redis_helper import RedisHelper
 
 
-def incr_likes_count(sender, instance, created, **kwargs):
+def _get_liked_model_class(instance):
+    from comments.models import Comment
     from tweets.models import Tweet
+
+    # tweets 和 comments 都有 likes_count，其他的 model 不做统计
+    model_class = instance.content_type.model_class()
+    if model_class not in (Tweet, Comment):
+        return None
+    return model_class
+
+
+def incr_likes_count(sender, instance, created, **kwargs):
     from django.db.models import F
 
     if not created:
         return
 
-    model_class = instance.content_type.model_class()
-    if model_class != Tweet:
-        # TODO HOMEWORK 给 Comment 使用类似的方法进行 likes_count 的统计
+    model_class = _get_liked_model_class(instance)
+    if model_class is None:
         return
 
     # 不可以使用 tweet.likes_count += 1; tweet.save() 的方式
@@ -20,23 +30,24 @@ def incr_likes_count(sender, instance, created, **kwargs):
     # Tweet.objects.filter(id=tweet.id).update(likes_count=F('likes_count') + 1)
 
 
-    Tweet.objects.filter(id=instance.object_id).update(likes_count=F('likes_count') + 1)
-    tweet = instance.content_object
-    RedisHelper.incr_count(tweet, 'likes_count')
+    # write-behind 模式下只改 redis 计数器，由 flush_tweet_counters_task 和
+    # flush_comment_counters_task 定期批量写回数据库
+    if not settings.COUNTER_WRITE_BEHIND:
+        model_class.objects.filter(id=instance.object_id).update(likes_count=F('likes_count') + 1)
+    # 只修改已经存在的 redis 计数器，不存在的时候读取的时候再从数据库初始化
+    RedisHelper.incr_count(model_class(id=instance.object_id), 'likes_count')
 
 def decr_likes_count(sender, instance, **kwargs):
-    from tweets.models import Tweet
     from django.db.models import F
 
-    model_class = instance.content_type.model_class()
-    if model_class != Tweet:
-        # TODO HOMEWORK 给 Comment 使用类似的方法进行 likes_count 的统计
+    model_class = _get_liked_model_class(instance)
+    if model_class is None:
         return
 
     # handle tweet likes cancel
     # tweet = instance.content_object
     # Tweet.objects.filter(id=tweet.id).update(likes_count=F('likes_count') - 1)
 
-    Tweet.objects.filter(id=instance.object_id).update(likes_count=F('likes_count') - 1)
-    tweet = instance.content_object
-    RedisHelper.decr_count(tweet, 'likes_count')
+    if not settings.COUNTER_WRITE_BEHIND:
+        model_class.objects.filter(id=instance.object_id).update(likes_count=F('likes_count') - 1)
+    RedisHelper.decr_count(model_class(id=instance.object_id), 'likes_count')
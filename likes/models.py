@@ -45,7 +45,12 @@ class Like(models.Model):
     @property
     def cached_user(self):
         # return UserService.get_user_through_cache(self.user_id);
-        return MemcachedHelper.get_object_through_cache(User, self.user_id)
+        # serializer 的 preload 会提前批量读好 user 记录在 _cached_user 上
+        if hasattr(self, '_cached_user'):
+            return getattr(self, '_cached_user')
+        user = MemcachedHelper.get_object_through_cache(User, self.user_id)
+        setattr(self, '_cached_user', user)
+        return user
 
 pre_delete.connect(decr_likes_count, sender=Like)
 post_save.connect(incr_likes_count, sender=Like)
@@ -1,6 +1,9 @@
 from newsfeeds.models import NewsFeed
 from rest_framework import serializers
+from tweets.models import Tweet
 from tweets.api.serializers import TweetListSerializer
+from utils.memcached_helper import MemcachedHelper
+from utils.serializers import PreloadListSerializer
 
 
 class NewsFeedSerializer(serializers.ModelSerializer):
@@ -9,3 +12,24 @@ class NewsFeedSerializer(serializers.ModelSerializer):
     class Meta:
         model = NewsFeed
         fields = ('id', 'created_at', 'tweet')
+        list_serializer_class = PreloadListSerializer
+
+    def preload(self, newsfeeds):
+        # 一次 get_many 读出整页 newsfeeds 的 tweets，记录在 _cached_tweet 上
+        # 从 pull 模式的 users 拉取的 newsfeeds 已经带上了 tweet
+        tweets = MemcachedHelper.get_objects_through_cache(
+            Tweet,
+            [
+                newsfeed.tweet_id
+                for newsfeed in newsfeeds
+                if not hasattr(newsfeed, '_cached_tweet')
+            ],
+        )
+        for newsfeed in newsfeeds:
+            if newsfeed.tweet_id in tweets:
+                setattr(newsfeed, '_cached_tweet', tweets[newsfeed.tweet_id])
+        self.fields['tweet'].preload([
+            newsfeed.cached_tweet
+            for newsfeed in newsfeeds
+            if newsfeed.cached_tweet is not None
+        ])
@@ -1,9 +1,13 @@
 from django.conf import settings
+from newsfeeds.constants import FANOUT_FOLLOWER_THRESHOLD
 from newsfeeds.models import NewsFeed
 from newsfeeds.services import NewsFeedService
 from rest_framework.test import APIClient
+from utils.metrics import Metrics
 from testing.testcases import TestCase
+from tweets.models import Tweet
 from utils.paginations import EndlessPagination
+from utils.time_helpers import utc_now
 
 NEWSFEEDS_URL = '/api/newsfeeds/'
 POST_TWEETS_URL = '/api/tweets/'
@@ -111,6 +115,94 @@ class NewsFeedApiTests(TestCase):
         self.assertEqual(len(response.data['results']), 1)
         self.assertEqual(response.data['results'][0]['id'], new_newsfeed.id)
 
+    def test_list_with_pull_mode_user(self):
+        for i in range(FANOUT_FOLLOWER_THRESHOLD):
+            follower = self.create_user('dongxie_follower{}'.format(i))
+            self.create_friendship(follower, self.dongxie)
+        self.linghu_client.post(FOLLOW_URL.format(self.dongxie.id))
+
+        self.linghu_client.post(POST_TWEETS_URL, {'content': 'Hello World'})
+        response = self.dongxie_client.post(POST_TWEETS_URL, {'content': 'Hello Twitter'})
+        posted_tweet_id = response.data['id']
+        # dongxie 的 followers 超过了阈值，没有 fanout 到 linghu 的 newsfeeds
+        self.assertEqual(NewsFeed.objects.filter(user=self.linghu).count(), 1)
+
+        response = self.linghu_client.get(NEWSFEEDS_URL)
+        results = response.data['results']
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0]['id'], -posted_tweet_id)
+        self.assertEqual(results[0]['tweet']['id'], posted_tweet_id)
+        self.assertEqual(results[1]['tweet']['content'], 'Hello World')
+
+        response = self.linghu_client.get(
+            NEWSFEEDS_URL,
+            {'created_at__lt': results[0]['created_at']},
+        )
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['has_next_page'], False)
+
+        # pull 的 tweets 和自己的 newsfeeds 的 created_at 相同的时候按照 cursor 翻页不会跳过
+        page_size = EndlessPagination.page_size
+        pulled_tweets = [self.create_tweet(self.dongxie) for _ in range(page_size)]
+        own_tweets = [self.create_tweet(self.linghu) for _ in range(page_size)]
+        own_feeds = [self.create_newsfeed(self.linghu, tweet) for tweet in own_tweets]
+        created_at = utc_now()
+        Tweet.objects.filter(id__in=[t.id for t in pulled_tweets + own_tweets]).update(
+            created_at=created_at,
+        )
+        NewsFeed.objects.filter(id__in=[f.id for f in own_feeds]).update(created_at=created_at)
+        self.clear_cache()
+
+        tweet_ids = []
+        response = self.linghu_client.get(NEWSFEEDS_URL)
+        tweet_ids.extend(item['tweet']['id'] for item in response.data['results'])
+        while response.data['has_next_page']:
+            response = self.linghu_client.get(
+                NEWSFEEDS_URL,
+                {'cursor': response.data['next_cursor']},
+            )
+            tweet_ids.extend(item['tweet']['id'] for item in response.data['results'])
+        self.assertEqual(
+            tweet_ids[:page_size * 2],
+            [t.id for t in reversed(own_tweets)] + [t.id for t in reversed(pulled_tweets)],
+        )
+        self.assertEqual(len(tweet_ids), len(set(tweet_ids)))
+        self.assertEqual(len(tweet_ids), page_size * 2 + 2)
+
+    def test_rendered_first_page(self):
+        tweet = self.create_tweet(self.linghu, 'content1')
+        self.create_newsfeed(self.dongxie, tweet)
+        response = self.dongxie_client.get(NEWSFEEDS_URL)
+        self.assertEqual(response.data['results'][0]['tweet']['has_liked'], False)
+
+        # 版本号没有变化，直接返回渲染好的结果，has_liked 和计数重新读取
+        Metrics.clear()
+        self.create_like(self.dongxie, tweet)
+        response = self.dongxie_client.get(NEWSFEEDS_URL)
+        results = response.data['results']
+        self.assertEqual(Metrics.get_counters()['newsfeeds.rendered_page_hit'], 1)
+        self.assertEqual(results[0]['tweet']['has_liked'], True)
+        self.assertEqual(results[0]['tweet']['likes_count'], 1)
+        self.assertEqual(response.data['has_next_page'], False)
+
+        # 有新的 newsfeed 的时候重新渲染
+        new_tweet = self.create_tweet(self.dongxie)
+        self.create_newsfeed(self.dongxie, new_tweet)
+        response = self.dongxie_client.get(NEWSFEEDS_URL)
+        self.assertEqual(Metrics.get_counters()['newsfeeds.rendered_page_stale'], 1)
+        self.assertEqual(
+            [item['tweet']['id'] for item in response.data['results']],
+            [new_tweet.id, tweet.id],
+        )
+
+        # 带时间参数的请求不使用渲染好的结果
+        response = self.dongxie_client.get(
+            NEWSFEEDS_URL,
+            {'created_at__lt': response.data['results'][0]['created_at']},
+        )
+        self.assertEqual([item['tweet']['id'] for item in response.data['results']], [tweet.id])
+        self.assertEqual(Metrics.get_counters()['newsfeeds.rendered_page_hit'], 1)
+
     def test_user_cache(self):
         profile = self.dongxie.profile
         profile.nickname = 'huanglaoxie'
@@ -1,4 +1,6 @@
+from dateutil import parser
 from django.utils.decorators import method_decorator
+from functools import partial
 from newsfeeds.api.serializers import NewsFeedSerializer
 from newsfeeds.models import NewsFeed
 from newsfeeds.services import NewsFeedService
@@ -22,13 +24,33 @@ class NewsFeedViewSet(viewsets.GenericViewSet):
     def list(self, request):
         # page = self.paginate_queryset(self.get_queryset())
 
-        cached_newsfeeds = NewsFeedService.get_cached_newsfeeds(request.user.id)
-        page = self.paginator.paginate_cached_list(cached_newsfeeds, request)
+        pull_user_ids = NewsFeedService.get_pull_user_ids(request.user.id)
+        # 没有时间参数的第一页是访问量最大的请求，先看看有没有渲染好的结果
+        is_first_page = self.paginator.is_first_page(request)
+        if is_first_page:
+            rendered = NewsFeedService.get_rendered_first_page(request.user.id, pull_user_ids)
+            if rendered is not None:
+                results, self.paginator.has_next_page = rendered
+                return self.get_paginated_response(
+                    NewsFeedService.overlay_viewer_fields(request.user, results),
+                )
+            # 在读取 newsfeeds 之前读取版本号
+            newsfeeds_version = NewsFeedService.get_newsfeeds_version(request.user.id)
+
+        # 按照 created_at 的范围从 cache 里读取当前这一页需要的 newsfeeds
+        page = self.paginator.paginate_cached_range(
+            partial(NewsFeedService.get_cached_newsfeeds_range, request.user.id),
+            request,
+        )
         # page 是 None，代表了我想请求的数据不再 cache 中，需要直接去 DB 中获取。
         if page is None:
             queryset = NewsFeed.objects.filter(user=request.user)
             page = self.paginate_queryset(queryset)
 
+        # 合并关注的 pull 模式的 users 的 tweets
+        if pull_user_ids:
+            page = self._merge_pulled_tweets(list(page), pull_user_ids, request)
+
         serializer = NewsFeedSerializer(
             page,
             context={'request': request},
@@ -37,4 +59,38 @@ class NewsFeedViewSet(viewsets.GenericViewSet):
         # return Response({
         #     'newsfeeds': serializer.data,
         # }, status=status.HTTP_200_OK)
+        if is_first_page:
+            NewsFeedService.set_rendered_first_page(
+                request.user.id,
+                newsfeeds_version,
+                pull_user_ids,
+                serializer.data,
+                self.paginator.has_next_page,
+            )
         return self.get_paginated_response(serializer.data)
+
+    def _merge_pulled_tweets(self, page, pull_user_ids, request):
+        if 'created_at__gt' in request.query_params:
+            # 下拉刷新不做翻页，合并所有更新的 tweets
+            return NewsFeedService.merge_pulled_tweets(
+                request.user.id,
+                page,
+                pull_user_ids,
+                created_at__gt=parser.isoparse(request.query_params['created_at__gt']),
+            )
+
+        created_at__lt, object_id = self.paginator.get_cursor(request)
+        page_size = self.paginator.page_size
+        # 多取一个用来判断是否还有下一页
+        # pull 的 tweets 和自己的 newsfeeds 用同一个 (created_at, id) 的 cursor 翻页
+        merged = NewsFeedService.merge_pulled_tweets(
+            request.user.id,
+            page,
+            pull_user_ids,
+            created_at__lt=created_at__lt,
+            count=page_size + 1,
+            object_id=object_id,
+        )
+        if len(merged) > page_size:
+            self.paginator.has_next_page = True
+        return merged[:page_size]
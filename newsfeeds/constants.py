@@ -1,3 +1,19 @@
 from django.conf import settings
 
 FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
+# followers 超过这个数量的 user 发 tweet 时不再 fanout（pull 模式）
+# 他们的 tweets 在 followers 读取 newsfeeds 的时候从他们的 user tweets cache 里拉取并合并
+FANOUT_FOLLOWER_THRESHOLD = 10000 if not settings.TESTING else 5
+# 按照 followers 的数量把 fanout 的 batch 任务分到不同的 queue 里
+# 大 V 的几千个 batch 任务不会排在普通 users 只有一个 batch 的任务前面
+# (queue, followers 的数量上限)，None 表示没有上限
+FANOUT_QUEUE_TIERS = (
+    ('newsfeeds_small', FANOUT_BATCH_SIZE),
+    ('newsfeeds_medium', 5000 if not settings.TESTING else 4),
+    ('newsfeeds_large', None),
+)
+# follow 之后把被关注的人最近的多少条 tweets 补充到 newsfeeds 里
+FOLLOW_BACKFILL_TWEETS_LIMIT = 100 if not settings.TESTING else 3
+# unfollow 之后从 newsfeeds 里删除被关注的人最近的多少条 tweets，每次删除多少条
+UNFOLLOW_PURGE_TWEETS_LIMIT = 1000 if not settings.TESTING else 5
+UNFOLLOW_PURGE_BATCH_SIZE = 500 if not settings.TESTING else 2
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from newsfeeds.services import NewsFeedService
+from utils.metrics import Metrics
+
+FANOUT_METRICS = (
+    'fanout.latency_ms',
+    'fanout.main_queue_wait_ms',
+    'fanout.batch_queue_wait_ms',
+    'fanout.bulk_create_ms',
+    'fanout.cache_push_ms',
+    'fanout.batch_count',
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Print percentiles of the recent fanout metrics and the backlog of each fanout queue. '
+        'Use utils.metrics.RedisMetricsSink to see the values recorded by the celery workers.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--percentiles',
+            default='50,90,99',
+            help='comma separated percentiles, default: 50,90,99',
+        )
+
+    def handle(self, *args, **options):
+        percentiles = [int(p) for p in options['percentiles'].split(',')]
+        for name in FANOUT_METRICS:
+            count, values = Metrics.get_percentiles(name, percentiles)
+            if not count:
+                self.stdout.write('{}: no data'.format(name))
+                continue
+            self.stdout.write('{} (n={}): {}'.format(
+                name,
+                count,
+                ', '.join('p{}={:.1f}'.format(p, values[p]) for p in percentiles),
+            ))
+        for queue, backlog in NewsFeedService.get_fanout_backlog().items():
+            self.stdout.write('{} backlog: {}'.format(queue, backlog))
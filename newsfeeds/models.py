@@ -23,6 +23,11 @@ class NewsFeed(models.Model):
 
     @property
     def cached_tweet(self):
-        return MemcachedHelper.get_object_through_cache(Tweet, self.tweet_id)
+        # 记录在 instance 上，同一个 newsfeed 多次访问 cached_tweet 时不会重复访问 memcached
+        if hasattr(self, '_cached_tweet'):
+            return getattr(self, '_cached_tweet')
+        tweet = MemcachedHelper.get_object_through_cache(Tweet, self.tweet_id)
+        setattr(self, '_cached_tweet', tweet)
+        return tweet
 
 post_save.connect(push_newsfeed_to_cache, sender=NewsFeed)
@@ -1,9 +1,44 @@
+from accounts.services import UserService
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+from django.db.models import Case, DateTimeField, Value, When
 from friendships.services import FriendshipService
+from friendships.models import Friendship
+from newsfeeds.constants import (
+    FANOUT_QUEUE_TIERS,
+    FOLLOW_BACKFILL_TWEETS_LIMIT,
+    UNFOLLOW_PURGE_BATCH_SIZE,
+    UNFOLLOW_PURGE_TWEETS_LIMIT,
+)
 from newsfeeds.models import NewsFeed
 from newsfeeds.models import NewsFeed
-from twitter.cache import USER_NEWSFEEDS_PATTERN
+from tweets.models import Tweet
+from tweets.services import TweetService
+from likes.services import LikeService
+from twitter.cache import (
+    FANOUT_CHECKPOINT_PATTERN,
+    FANOUT_PENDING_BATCHES_PATTERN,
+    NEWSFEED_PULL_USERS_KEY,
+    RENDERED_NEWSFEEDS_PATTERN,
+    USER_NEWSFEEDS_PATTERN,
+    USER_NEWSFEEDS_VERSION_PATTERN,
+)
+from utils.metrics import Metrics
+from utils.redis_client import RedisClient
 from utils.redis_helper import RedisHelper
-from newsfeeds.tasks import fanout_newsfeeds_main_task
+from utils.time_constants import ONE_HOUR
+from utils.time_helpers import datetime_to_microseconds, microseconds_to_datetime
+from newsfeeds.tasks import (
+    backfill_followee_newsfeeds_task,
+    fanout_newsfeeds_main_task,
+    purge_followee_newsfeeds_task,
+)
+
+import heapq
+import time
+
+cache = caches['testing'] if settings.TESTING else caches['default']
 
 
 class NewsFeedService(object):
@@ -46,16 +81,470 @@ class NewsFeedService(object):
         # fanout_newsfeeds_task.delay(tweet.id) # 异步任务
         # fanout_newsfeeds_task(tweet.id)  # 同步任务
 
-        fanout_newsfeeds_main_task.delay(tweet.id, tweet.user_id)
+        # created_at 用来统计从发 tweet 到 fanout 完成的时间，enqueued_at 用来统计在队列里等待的时间
+        fanout_newsfeeds_main_task.delay(
+            tweet.id,
+            tweet.user_id,
+            created_at=datetime_to_microseconds(tweet.created_at),
+            enqueued_at=time.time(),
+        )
 
     @classmethod
-    def get_cached_newsfeeds(cls, user_id):
-        queryset = NewsFeed.objects.filter(user_id=user_id).order_by('-created_at')
+    def get_fanout_queue(cls, follower_count):
+        for queue, max_follower_count in FANOUT_QUEUE_TIERS:
+            if max_follower_count is None or follower_count <= max_follower_count:
+                return queue
+
+    @classmethod
+    def get_fanout_backlog(cls):
+        """
+        每个 tier 的 queue 里还在排队的 batch 任务的个数
+        celery 的 redis broker 把每个 queue 存成一个同名的 list
+        """
+        conn = RedisClient.get_broker_connection()
+        pipeline = conn.pipeline(transaction=False)
+        for queue, _ in FANOUT_QUEUE_TIERS:
+            pipeline.llen(queue)
+        return {
+            queue: length
+            for (queue, _), length in zip(FANOUT_QUEUE_TIERS, pipeline.execute())
+        }
+
+    @classmethod
+    def get_fanout_checkpoint(cls, tweet_id):
+        """
+        返回这个 tweet 的 fanout 已经创建了 batch 任务的最后一个 friendship id
+        还没有开始 fanout 的时候返回 None
+        """
+        conn = RedisClient.get_connection()
+        checkpoint = conn.get(FANOUT_CHECKPOINT_PATTERN.format(tweet_id=tweet_id))
+        return None if checkpoint is None else int(checkpoint)
+
+    @classmethod
+    def set_fanout_checkpoint(cls, tweet_id, friendship_id):
+        # main task 的 time_limit 是一个小时，checkpoint 保留一天足够重试的时候使用
+        conn = RedisClient.get_connection()
+        conn.set(FANOUT_CHECKPOINT_PATTERN.format(tweet_id=tweet_id), friendship_id, ex=ONE_HOUR * 24)
+
+    @classmethod
+    def add_pending_fanout_batches(cls, tweet_id, amount):
+        """
+        修改 tweet 还没有执行完的 fanout batch 任务的个数，返回修改之后的个数
+        main task 在开始创建 batch 任务之前先 +1，创建完之后再 -1，所以个数变成 0 的时候
+        一定是所有的 batch 任务都执行完了
+        """
+        key = FANOUT_PENDING_BATCHES_PATTERN.format(tweet_id=tweet_id)
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        pipeline.incrby(key, amount)
+        pipeline.expire(key, ONE_HOUR)
+        pending, _ = pipeline.execute()
+        return pending
+
+    @classmethod
+    def finish_fanout_batch(cls, tweet_id, created_at):
+        # 最后一个执行完的 batch 记录从发 tweet 到 fanout 完成的时间
+        if cls.add_pending_fanout_batches(tweet_id, -1) != 0 or created_at is None:
+            return
+        created_at = microseconds_to_datetime(created_at)
+        Metrics.observe('fanout.latency_ms', (timezone.now() - created_at).total_seconds() * 1000)
+
+    @classmethod
+    def on_follow(cls, from_user_id, to_user_id):
+        # 异步地把被关注的人最近的 tweets 补充到 newsfeeds 里
+        backfill_followee_newsfeeds_task.delay(from_user_id, to_user_id)
+
+    @classmethod
+    def on_unfollow(cls, from_user_id, to_user_id):
+        # 异步地从 newsfeeds 里删除被关注的人的 tweets
+        purge_followee_newsfeeds_task.delay(from_user_id, to_user_id)
+
+    # newsfeeds 在 redis 里存成一个 sorted set
+    #   member: '{newsfeed_id}:{tweet_id}'，score: created_at 的 microseconds
+    # 只存 id 而不是整个序列化之后的 newsfeed，fanout 的时候每个 follower 只需要写几十个字节
+    # tweet 的内容在 serialize 的时候通过 memcached 批量读取
+    @classmethod
+    def _to_member(cls, newsfeed):
+        member = '{}:{}'.format(newsfeed.id, newsfeed.tweet_id)
+        return member, datetime_to_microseconds(newsfeed.created_at)
+
+    @classmethod
+    def _from_member(cls, user_id, member, score):
+        newsfeed_id, tweet_id = member.split(':')
+        return NewsFeed.from_db(
+            None,
+            ['id', 'user_id', 'tweet_id', 'created_at'],
+            [int(newsfeed_id), user_id, int(tweet_id), microseconds_to_datetime(score)],
+        )
+
+    @classmethod
+    def get_cached_newsfeeds_range(cls, user_id, created_at__lt=None, created_at__gt=None, count=None):
+        """
+        读取 created_at__gt < created_at < created_at__lt 的前 count 个 newsfeeds
+        返回 (newsfeeds, cache 里 newsfeeds 的总数)
+        """
+        queryset = NewsFeed.objects.filter(user_id=user_id).order_by('-created_at', '-id')
         key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
-        return RedisHelper.load_objects(key, queryset)
+        items, cached_length = RedisHelper.load_sorted_set_range(
+            key,
+            queryset,
+            cls._to_member,
+            max_score=None if created_at__lt is None else datetime_to_microseconds(created_at__lt),
+            min_score=None if created_at__gt is None else datetime_to_microseconds(created_at__gt),
+            count=count,
+        )
+        newsfeeds = [
+            cls._from_member(user_id, member, score)
+            for member, score in items
+        ]
+        return newsfeeds, cached_length
+
+    @classmethod
+    def get_cached_newsfeeds(cls, user_id):
+        newsfeeds, _ = cls.get_cached_newsfeeds_range(user_id)
+        return newsfeeds
 
     @classmethod
     def push_newsfeed_to_cache(cls, newsfeed):
-        queryset = NewsFeed.objects.filter(user_id=newsfeed.user_id).order_by('-created_at')
+        queryset = NewsFeed.objects.filter(user_id=newsfeed.user_id).order_by('-created_at', '-id')
         key = USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id)
-        RedisHelper.push_object(key, newsfeed, queryset)
+        RedisHelper.push_to_sorted_set(key, newsfeed, queryset, cls._to_member)
+        cls.bump_newsfeeds_versions([newsfeed.user_id])
+
+    @classmethod
+    def push_newsfeeds_to_cache(cls, newsfeeds):
+        """
+        fanout 时批量 push，一次 round trip 完成
+        只 push 到已经在 cache 里的 newsfeeds，cache 里没有的 user 下次读取的时候再从数据库重建
+        不会在 fanout 的 worker 里为每个 follower 重新 load 整个 newsfeeds
+        """
+        items = []
+        for newsfeed in newsfeeds:
+            member, score = cls._to_member(newsfeed)
+            key = USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id)
+            items.append((key, member, score))
+        pushed = RedisHelper.push_to_sorted_sets(items)
+        # cache 里没有的 users 数据库里的 newsfeeds 也变了，同样需要增加版本号
+        cls.bump_newsfeeds_versions([newsfeed.user_id for newsfeed in newsfeeds])
+        Metrics.incr('newsfeeds.cache_pushed', pushed)
+        Metrics.incr('newsfeeds.cold_cache_skipped', len(items) - pushed)
+        return pushed
+
+    @classmethod
+    def invalidate_cached_newsfeeds(cls, user_ids):
+        if not user_ids:
+            return
+        conn = RedisClient.get_connection()
+        conn.delete(*[USER_NEWSFEEDS_PATTERN.format(user_id=user_id) for user_id in user_ids])
+        cls.bump_newsfeeds_versions(user_ids)
+
+    @classmethod
+    def evict_cached_newsfeeds(cls, user_ids):
+        """
+        fanout 给不活跃的 users 时调用，只处理 cache 还在的 users，返回清掉了多少个
+        已经被清掉的 users 不会再重复 DEL 和增加版本号，不活跃的 users 每个 tweet 不会再产生写操作
+        """
+        if not user_ids:
+            return 0
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipeline.delete(USER_NEWSFEEDS_PATTERN.format(user_id=user_id))
+        evicted_ids = [
+            user_id
+            for user_id, deleted in zip(user_ids, pipeline.execute())
+            if deleted
+        ]
+        cls.bump_newsfeeds_versions(evicted_ids)
+        return len(evicted_ids)
+
+    @classmethod
+    def bump_newsfeeds_versions(cls, user_ids):
+        # 只有最近读取过 newsfeeds 的 users 有版本号，fanout 给其他 users 的时候不会创建新的 key
+        return RedisHelper.bump_versions([
+            USER_NEWSFEEDS_VERSION_PATTERN.format(user_id=user_id)
+            for user_id in user_ids
+        ])
+
+    @classmethod
+    def get_newsfeeds_version(cls, user_id):
+        key = USER_NEWSFEEDS_VERSION_PATTERN.format(user_id=user_id)
+        return RedisHelper.get_versions([key])[0]
+
+    # 渲染好的 newsfeeds 第一页存在 memcached 里，同时记录渲染时的版本号
+    #   newsfeeds_version: user 的 newsfeeds 的版本号，fanout push 的时候增加
+    #   author_ids / content_versions: 第一页里 tweets 的作者和关注的 pull 模式的 users
+    #   的内容版本号，user / profile 修改或者发了新 tweet 的时候增加
+    # 版本号都没有变的时候直接返回，不需要再读取 tweets, users 和 profiles 进行序列化
+    # has_liked 和计数经常变化，每次读取的时候重新读
+    @classmethod
+    def get_rendered_first_page(cls, user_id, pull_user_ids):
+        """
+        返回 (results, has_next_page)，渲染结果不存在或者已经过期的时候返回 None
+        """
+        rendered = cache.get(RENDERED_NEWSFEEDS_PATTERN.format(user_id=user_id))
+        if rendered is None or rendered['pull_user_ids'] != list(pull_user_ids):
+            Metrics.incr('newsfeeds.rendered_page_miss')
+            return None
+        if rendered['newsfeeds_version'] != cls.get_newsfeeds_version(user_id) or \
+                rendered['content_versions'] != UserService.get_content_versions(rendered['author_ids']):
+            Metrics.incr('newsfeeds.rendered_page_stale')
+            return None
+        Metrics.incr('newsfeeds.rendered_page_hit')
+        return rendered['results'], rendered['has_next_page']
+
+    @classmethod
+    def set_rendered_first_page(cls, user_id, newsfeeds_version, pull_user_ids, results, has_next_page):
+        """
+        newsfeeds_version 需要在读取 newsfeeds 之前读取，读取之后有新的 newsfeeds push 进来
+        的话版本号就对不上了，下次读取的时候会重新渲染
+        """
+        author_ids = {
+            item['tweet']['user']['id']
+            for item in results
+            if item['tweet'] is not None and item['tweet']['user'] is not None
+        }
+        author_ids = sorted(author_ids | set(pull_user_ids))
+        content_versions = UserService.get_content_versions(author_ids)
+        # 版本号要比渲染结果保存得久，否则版本号过期之后重新从 0 开始，可能和保存的版本号碰巧相同
+        version_keys = [USER_NEWSFEEDS_VERSION_PATTERN.format(user_id=user_id)]
+        version_keys += UserService.get_content_version_keys(author_ids)
+        if not RedisHelper.touch_versions(version_keys):
+            return
+        cache.set(
+            RENDERED_NEWSFEEDS_PATTERN.format(user_id=user_id),
+            {
+                'newsfeeds_version': newsfeeds_version,
+                'pull_user_ids': list(pull_user_ids),
+                'author_ids': author_ids,
+                'content_versions': content_versions,
+                'results': results,
+                'has_next_page': has_next_page,
+            },
+            settings.NEWSFEED_RENDERED_PAGE_TIMEOUT,
+        )
+
+    @classmethod
+    def overlay_viewer_fields(cls, user, results):
+        """
+        在渲染好的结果上重新读取 has_liked 和计数
+        一次 MGET 读取计数，一次 object_id__in 的查询读取 has_liked
+        """
+        tweets = [item['tweet'] for item in results if item['tweet'] is not None]
+        if not tweets:
+            return results
+        tweet_ids = [tweet['id'] for tweet in tweets]
+        counts = RedisHelper.get_counts(
+            [Tweet(id=tweet_id) for tweet_id in tweet_ids],
+            ['likes_count', 'comments_count'],
+        )
+        liked_ids = LikeService.get_liked_object_ids(user, Tweet, tweet_ids)
+        for tweet in tweets:
+            tweet.update(counts.get(tweet['id'], {}))
+            tweet['has_liked'] = tweet['id'] in liked_ids
+        return results
+
+    @classmethod
+    def backfill_newsfeeds(cls, user_id, tweets):
+        """
+        把 tweets 补充到 user 的 newsfeeds 里，已经存在的 newsfeeds 会被跳过，可以重复执行
+        """
+        tweets = list(tweets)
+        if not tweets:
+            return 0
+        started_at = timezone.now()
+        NewsFeed.objects.bulk_create(
+            [NewsFeed(user_id=user_id, tweet_id=tweet.id) for tweet in tweets],
+            ignore_conflicts=True,
+        )
+        # auto_now_add 会把 created_at 设置成现在，改成 tweet 的 created_at
+        # 这样补充的 newsfeeds 才会按照时间顺序排在 newsfeeds 里，而不是全部排在最前面
+        # 只修改这次新创建的 newsfeeds
+        NewsFeed.objects.filter(
+            user_id=user_id,
+            tweet_id__in=[tweet.id for tweet in tweets],
+            created_at__gte=started_at,
+        ).update(created_at=Case(
+            *[When(tweet_id=tweet.id, then=Value(tweet.created_at)) for tweet in tweets],
+            output_field=DateTimeField(),
+        ))
+        # 直接删除 cache，下次读取的时候从数据库重建
+        cls.invalidate_cached_newsfeeds([user_id])
+        return len(tweets)
+
+    @classmethod
+    def backfill_followee(cls, user_id, followee_id):
+        """
+        把 followee 最近 FOLLOW_BACKFILL_TWEETS_LIMIT 条 tweets 补充到 user 的 newsfeeds 里
+        """
+        # 任务执行之前可能已经 unfollow 了
+        if not Friendship.objects.filter(from_user_id=user_id, to_user_id=followee_id).exists():
+            return 0
+        # pull 模式的 users 的 tweets 在读取的时候合并
+        if followee_id in cls.get_pull_user_ids(user_id):
+            return 0
+        tweets = TweetService.get_cached_tweets_range(
+            followee_id,
+            count=FOLLOW_BACKFILL_TWEETS_LIMIT,
+        )
+        return cls.backfill_newsfeeds(user_id, tweets)
+
+    @classmethod
+    def purge_followee(cls, user_id, followee_id):
+        """
+        从 user 的 newsfeeds 里删除 followee 最近 UNFOLLOW_PURGE_TWEETS_LIMIT 条 tweets
+        更早的 tweets 在 newsfeeds 里已经翻得很深了，为了控制任务的执行时间不再删除
+        """
+        # 任务执行之前可能又重新 follow 了
+        if Friendship.objects.filter(from_user_id=user_id, to_user_id=followee_id).exists():
+            return 0
+        tweet_ids = list(
+            Tweet.objects.filter(user_id=followee_id)
+            .order_by('-created_at')
+            .values_list('id', flat=True)[:UNFOLLOW_PURGE_TWEETS_LIMIT]
+        )
+        deleted = 0
+        for index in range(0, len(tweet_ids), UNFOLLOW_PURGE_BATCH_SIZE):
+            batch_ids = tweet_ids[index: index + UNFOLLOW_PURGE_BATCH_SIZE]
+            count, _ = NewsFeed.objects.filter(user_id=user_id, tweet_id__in=batch_ids).delete()
+            deleted += count
+        if deleted:
+            cls.invalidate_cached_newsfeeds([user_id])
+        return deleted
+
+    @classmethod
+    def backfill_from_followings(cls, user_id, since=None):
+        """
+        从关注的人最近的 tweets 里补充 user 的 newsfeeds，用于 fanout 时被跳过的不活跃 user
+        pull 模式的 users 的 tweets 在读取的时候合并，这里不需要补充
+        """
+        following_user_ids = set(FriendshipService.get_following_user_id_set(user_id))
+        following_user_ids -= set(cls.get_pull_user_ids(user_id))
+        if not following_user_ids:
+            return 0
+        tweets = Tweet.objects.filter(user_id__in=following_user_ids)
+        if since is not None:
+            tweets = tweets.filter(created_at__gt=since)
+        tweets = tweets.order_by('-created_at')[:settings.REDIS_LIST_LENGTH_LIMIT]
+        return cls.backfill_newsfeeds(user_id, tweets)
+
+    @classmethod
+    def mark_pull_user(cls, user_id):
+        # 一旦变成 pull 模式就不再变回 push 模式
+        # 否则 followers 的 newsfeeds 里会缺少 pull 模式期间发的 tweets
+        conn = RedisClient.get_connection()
+        conn.sadd(NEWSFEED_PULL_USERS_KEY, user_id)
+
+    @classmethod
+    def get_pull_user_ids(cls, user_id):
+        """
+        user 关注的 pull 模式的 users
+        pull 模式的 users 只是 followers 特别多的少数 users，所以直接读出整个 set
+        """
+        conn = RedisClient.get_connection()
+        pull_user_ids = {int(pull_user_id) for pull_user_id in conn.smembers(NEWSFEED_PULL_USERS_KEY)}
+        if not pull_user_ids:
+            return []
+        following_user_ids = FriendshipService.get_following_user_id_set(user_id)
+        return sorted(pull_user_ids & set(following_user_ids))
+
+    @classmethod
+    def merge_pulled_tweets(
+        cls,
+        user_id,
+        newsfeeds,
+        pull_user_ids,
+        created_at__lt=None,
+        created_at__gt=None,
+        count=None,
+        object_id=None,
+    ):
+        """
+        把 pull 模式的 users 在 created_at__gt < created_at < created_at__lt 范围内的 tweets
+        和 newsfeeds 按照 (created_at, id) 倒序做 k-way merge，返回前 count 个 newsfeeds
+        object_id 是 cursor 里的 id，有的时候按照 (created_at__lt, object_id) 翻页
+
+        newsfeeds 和每个 user 的 tweets 都是已经按照 _merge_key 倒序排好的，并且各自最多
+        只需要取 count 个，所以 merge 的结果一定是完整的前 count 个
+        pull 出来的 tweets 包装成没有保存到数据库的 NewsFeed，id 是 -tweet_id
+        """
+        timelines = [newsfeeds]
+        for pull_user_id in pull_user_ids:
+            tweets = cls._get_pulled_tweets(
+                pull_user_id,
+                created_at__lt,
+                created_at__gt,
+                count,
+                object_id,
+            )
+            timelines.append([cls._newsfeed_from_tweet(user_id, tweet) for tweet in tweets])
+
+        merged = []
+        # 变成 pull 模式之前发的 tweets 可能已经 fanout 到 newsfeeds 里了，按照 tweet_id 去重
+        seen_tweet_ids = set()
+        for newsfeed in heapq.merge(*timelines, key=cls._merge_key, reverse=True):
+            if newsfeed.tweet_id in seen_tweet_ids:
+                continue
+            seen_tweet_ids.add(newsfeed.tweet_id)
+            merged.append(newsfeed)
+            if count is not None and len(merged) >= count:
+                break
+        return merged
+
+    @classmethod
+    def _merge_key(cls, newsfeed):
+        """
+        和 EndlessPagination 一样按照 (created_at, id) 排列
+        created_at 相同的时候自己的 newsfeeds（id > 0）排在 pull 的 tweets（id < 0）前面
+        pull 的 tweets 之间按照 tweet id 倒序，和 TweetService 读出来的顺序一致
+        """
+        created_at = datetime_to_microseconds(newsfeed.created_at)
+        if newsfeed.id is not None and newsfeed.id < 0:
+            return created_at, 0, -newsfeed.id
+        return created_at, 1, newsfeed.id or 0
+
+    @classmethod
+    def _get_pulled_tweets(cls, pull_user_id, created_at__lt, created_at__gt, count, object_id):
+        """
+        读取 pull 模式的 user 排在 cursor (created_at__lt, object_id) 后面的前 count 个 tweets
+        """
+        if created_at__lt is None or object_id is None:
+            return TweetService.get_cached_tweets_range(
+                pull_user_id,
+                created_at__lt=created_at__lt,
+                created_at__gt=created_at__gt,
+                count=count,
+            )
+
+        # created_at 和 cursor 相同的 tweets 单独读出来
+        # cursor 是自己的 newsfeed 的时候这些 tweets 都排在它后面
+        # cursor 是 pull 的 tweet 的时候只有 tweet id 更小的排在它后面
+        created_at = datetime_to_microseconds(created_at__lt)
+        ties = TweetService.get_cached_tweets_range(
+            pull_user_id,
+            created_at__lt=microseconds_to_datetime(created_at + 1),
+            created_at__gt=microseconds_to_datetime(created_at - 1),
+        )
+        tweets = [
+            tweet for tweet in ties
+            if object_id > 0 or tweet.id < -object_id
+        ]
+        tweets.extend(TweetService.get_cached_tweets_range(
+            pull_user_id,
+            created_at__lt=created_at__lt,
+            created_at__gt=created_at__gt,
+            count=count,
+        ))
+        return tweets if count is None else tweets[:count]
+
+    @classmethod
+    def _newsfeed_from_tweet(cls, user_id, tweet):
+        # id 用 -tweet_id，不会和自己的 newsfeeds 重复，也可以作为翻页的 cursor
+        newsfeed = NewsFeed(
+            id=-tweet.id,
+            user_id=user_id,
+            tweet_id=tweet.id,
+            created_at=tweet.created_at,
+        )
+        setattr(newsfeed, '_cached_tweet', tweet)
+        return newsfeed
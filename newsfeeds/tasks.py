@@ -1,17 +1,32 @@
+from accounts.services import UserService
 from celery import shared_task
+from django.conf import settings
 from friendships.services import FriendshipService
 from newsfeeds.models import NewsFeed
 from tweets.models import Tweet
+from utils.metrics import Metrics
 from utils.time_constants import ONE_HOUR
-from newsfeeds.constants import FANOUT_BATCH_SIZE
+from utils.time_helpers import microseconds_to_datetime
+
+import time
+from newsfeeds.constants import FANOUT_BATCH_SIZE, FANOUT_FOLLOWER_THRESHOLD
+
+
+def _observe_duration_ms(name, started_at):
+    Metrics.observe(name, (time.time() - started_at) * 1000)
 
 
 # 这个任务如果执行超过了 time_limit 就会报一个超时的错误。防止任务无休止的执行下去。
-@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
-def fanout_newsfeeds_batch_task(tweet_id, follower_ids):
+# acks_late: 执行完之后才 ack，worker 在执行过程中挂掉的话任务会被重新投递，所以任务必须可以重复执行
+# queue 由 fanout_newsfeeds_main_task 按照 followers 的数量选择，见 settings.CELERY_TASK_ROUTES
+@shared_task(time_limit=ONE_HOUR, acks_late=True)
+def fanout_newsfeeds_batch_task(tweet_id, follower_ids, created_at=None, enqueued_at=None):
     # import 写在里面避免循环依赖
     from newsfeeds.services import NewsFeedService
 
+    if enqueued_at is not None:
+        _observe_duration_ms('fanout.batch_queue_wait_ms', enqueued_at)
+
     # 错误的方法
     # 不可以将数据库操作放在 for 循环里面，效率会非常低
     # for follower in FriendshipService.get_followers(tweet.user):
@@ -26,33 +41,118 @@ def fanout_newsfeeds_batch_task(tweet_id, follower_ids):
     #     NewsFeed.objects.create(user_id=follower_id, tweet_id=tweet_id)
     # 正确的方法：使用 bulk_create，会把 insert 语句合成一条 ->
 
+    # 不活跃的 followers 不写 cache，删掉他们还在的 cache，下次访问的时候从数据库重建
+    active_ids, dormant_ids = UserService.split_active_user_ids(follower_ids)
+    evicted = NewsFeedService.evict_cached_newsfeeds(dormant_ids)
+    Metrics.incr('fanout.dormant_cache_write_skipped', len(dormant_ids))
+    Metrics.incr('fanout.dormant_cache_evicted', evicted)
+    if settings.FANOUT_DORMANT_MODE == 'skip':
+        # 数据库也不写，下次访问的时候从关注的人的 tweets 里拉取
+        Metrics.incr('fanout.dormant_db_write_skipped', len(dormant_ids))
+        follower_ids = active_ids
+
     newsfeeds = [
         NewsFeed(user_id=follower_id, tweet_id=tweet_id)
         for follower_id in follower_ids
     ]
-    NewsFeed.objects.bulk_create(newsfeeds)
+    started_at = time.time()
+    # 任务重试或者被重新投递的时候，已经创建过的 newsfeeds 会违反 (user, tweet) 的 unique 约束
+    # ignore_conflicts 跳过这些 newsfeeds，而不是让整个 batch 失败
+    NewsFeed.objects.bulk_create(newsfeeds, ignore_conflicts=True)
+    _observe_duration_ms('fanout.bulk_create_ms', started_at)
 
     # bulk create 不会触发 post_save 的 signal，所以需要手动 push 到 cache 里
-    for newsfeed in newsfeeds:
-        NewsFeedService.push_newsfeed_to_cache(newsfeed)
+    # MySQL 的 bulk_create 不会给 objects 设置 id，需要重新查询一次
+    # 这个查询会用到 (user, tweet) 的 unique index
+    # 重新查询出来的 newsfeeds 的 member 和之前 push 过的一样，sorted set 里不会重复
+    started_at = time.time()
+    NewsFeedService.push_newsfeeds_to_cache(
+        NewsFeed.objects.filter(tweet_id=tweet_id, user_id__in=active_ids),
+    )
+    _observe_duration_ms('fanout.cache_push_ms', started_at)
+
+    NewsFeedService.finish_fanout_batch(tweet_id, created_at)
 
     return "{} newsfeeds created".format(len(newsfeeds))
 
 
-@shared_task(routing_key='default', time_limit=ONE_HOUR)
-def fanout_newsfeeds_main_task(tweet_id, tweet_user_id):
+@shared_task(routing_key='default', time_limit=ONE_HOUR, acks_late=True)
+def fanout_newsfeeds_main_task(tweet_id, tweet_user_id, created_at=None, enqueued_at=None):
+    # import 写在里面避免循环依赖
+    from newsfeeds.services import NewsFeedService
+
+    if enqueued_at is not None:
+        _observe_duration_ms('fanout.main_queue_wait_ms', enqueued_at)
+    # 之前执行到一半挂掉了的话，从上次创建了 batch 任务的最后一个 friendship id 之后继续
+    checkpoint = NewsFeedService.get_fanout_checkpoint(tweet_id)
+    if checkpoint is None:
+        # 创建 batch 任务的过程中占住一个计数，避免先创建的 batch 执行完的时候被当成最后一个
+        # 重新执行的时候上次占住的计数还在，不需要再加
+        NewsFeedService.add_pending_fanout_batches(tweet_id, 1)
+        NewsFeedService.set_fanout_checkpoint(tweet_id, 0)
+        checkpoint = 0
+
     # 将推给自己的 Newsfeed 率先创建，确保自己能最快看到
-    NewsFeed.objects.create(user_id=tweet_user_id, tweet_id=tweet_id)
+    NewsFeed.objects.get_or_create(user_id=tweet_user_id, tweet_id=tweet_id)
+
+    # followers 太多的 user 不做 fanout，followers 读取 newsfeeds 的时候再拉取
+    follower_count = FriendshipService.get_follower_count(tweet_user_id)
+    if follower_count > FANOUT_FOLLOWER_THRESHOLD:
+        NewsFeedService.mark_pull_user(tweet_user_id)
+        NewsFeedService.finish_fanout_batch(tweet_id, created_at)
+        return '{} followers, skip fanout for pull mode user.'.format(follower_count)
+
+    # 按照 followers 的数量选择 queue，同一个 tweet 的所有 batch 任务都在同一个 queue 里
+    queue = NewsFeedService.get_fanout_queue(follower_count)
 
-    # 获得所有的 follower ids，按照 batch size 拆分开
-    follower_ids = FriendshipService.get_follower_ids(tweet_user_id)
-    index = 0
-    while index < len(follower_ids):
-        batch_ids = follower_ids[index: index + FANOUT_BATCH_SIZE]
-        fanout_newsfeeds_batch_task.delay(tweet_id, batch_ids)
-        index += FANOUT_BATCH_SIZE
+    # 一批一批地读 follower ids，每读出一批就马上创建这一批的 fanout 任务
+    # 不需要先把所有的 follower ids 读到内存里
+    follower_count, batch_count = 0, 0
+    for last_friendship_id, batch_ids in FriendshipService.iter_follower_id_batches(
+        tweet_user_id,
+        FANOUT_BATCH_SIZE,
+        after_id=checkpoint,
+    ):
+        NewsFeedService.add_pending_fanout_batches(tweet_id, 1)
+        fanout_newsfeeds_batch_task.apply_async(
+            args=(tweet_id, batch_ids),
+            kwargs={'created_at': created_at, 'enqueued_at': time.time()},
+            queue=queue,
+            routing_key=queue,
+        )
+        # 先创建任务再记录 checkpoint，中间挂掉的话这个 batch 会被重复创建，batch 任务可以重复执行
+        NewsFeedService.set_fanout_checkpoint(tweet_id, last_friendship_id)
+        follower_count += len(batch_ids)
+        batch_count += 1
+
+    Metrics.observe('fanout.batch_count', batch_count)
+    Metrics.incr('fanout.{}.batches'.format(queue), batch_count)
+    NewsFeedService.finish_fanout_batch(tweet_id, created_at)
 
     return '{} newsfeeds going to fanout, {} batches created.'.format(
-        len(follower_ids),
-        (len(follower_ids) - 1) // FANOUT_BATCH_SIZE + 1,
+        follower_count,
+        batch_count,
     )
+
+
+@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
+def backfill_dormant_user_newsfeeds_task(user_id, last_seen):
+    # 不活跃期间 fanout 跳过了这个 user，从关注的人在这之后发的 tweets 里补充 newsfeeds
+    from newsfeeds.services import NewsFeedService
+    since = None if last_seen is None else microseconds_to_datetime(last_seen * 10 ** 6)
+    count = NewsFeedService.backfill_from_followings(user_id, since)
+    return '{} newsfeeds backfilled.'.format(count)
+
+
+@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
+def backfill_followee_newsfeeds_task(user_id, followee_id):
+    from newsfeeds.services import NewsFeedService
+    count = NewsFeedService.backfill_followee(user_id, followee_id)
+    return '{} newsfeeds backfilled.'.format(count)
+
+
+@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
+def purge_followee_newsfeeds_task(user_id, followee_id):
+    from newsfeeds.services import NewsFeedService
+    count = NewsFeedService.purge_followee(user_id, followee_id)
+    return '{} newsfeeds purged.'.format(count)
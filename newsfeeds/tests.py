@@ -1,9 +1,23 @@
+from accounts.services import UserService
+from datetime import timedelta
+from django.conf import settings
+from django.test import override_settings
+from newsfeeds.constants import FANOUT_FOLLOWER_THRESHOLD, FOLLOW_BACKFILL_TWEETS_LIMIT
+from newsfeeds.models import NewsFeed
 from newsfeeds.services import NewsFeedService
+from newsfeeds.tasks import (
+    backfill_dormant_user_newsfeeds_task,
+    backfill_followee_newsfeeds_task,
+    fanout_newsfeeds_batch_task,
+    fanout_newsfeeds_main_task,
+    purge_followee_newsfeeds_task,
+)
 from testing.testcases import TestCase
-from twitter.cache import USER_NEWSFEEDS_PATTERN
+from twitter.cache import USER_NEWSFEEDS_PATTERN, USER_NEWSFEEDS_VERSION_PATTERN
+from utils.metrics import Metrics
 from utils.redis_client import RedisClient
-from newsfeeds.models import NewsFeed
-from newsfeeds.tasks import fanout_newsfeeds_main_task
+from utils.time_helpers import datetime_to_microseconds, utc_now
+import time
 
 
 class NewsFeedServiceTests(TestCase):
@@ -50,6 +64,66 @@ class NewsFeedServiceTests(TestCase):
         feeds = NewsFeedService.get_cached_newsfeeds(self.linghu.id)
         self.assertEqual([f.id for f in feeds], [feed2.id, feed1.id])
 
+    def test_push_newsfeeds_to_cache(self):
+        self.create_newsfeed(self.linghu, self.create_tweet(self.dongxie))
+        RedisClient.clear()
+        conn = RedisClient.get_connection()
+        # linghu 的 newsfeeds 在 cache 里，dongxie 的不在
+        NewsFeedService.get_cached_newsfeeds(self.linghu.id)
+
+        tweet = self.create_tweet(self.dongxie)
+        NewsFeed.objects.bulk_create([
+            NewsFeed(user=self.linghu, tweet=tweet),
+            NewsFeed(user=self.dongxie, tweet=tweet),
+        ])
+        newsfeeds = NewsFeed.objects.filter(tweet=tweet)
+        self.assertEqual(NewsFeedService.push_newsfeeds_to_cache(newsfeeds), 1)
+        self.assertEqual(
+            conn.exists(USER_NEWSFEEDS_PATTERN.format(user_id=self.dongxie.id)),
+            False,
+        )
+        feeds = NewsFeedService.get_cached_newsfeeds(self.linghu.id)
+        self.assertEqual(len(feeds), 2)
+        self.assertEqual(feeds[0].tweet_id, tweet.id)
+
+    def test_get_cached_newsfeeds_range(self):
+        newsfeeds = []
+        for i in range(5):
+            tweet = self.create_tweet(self.dongxie)
+            newsfeeds.append(self.create_newsfeed(self.linghu, tweet))
+        newsfeeds = newsfeeds[::-1]
+
+        RedisClient.clear()
+        conn = RedisClient.get_connection()
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=self.linghu.id)
+
+        # cache miss
+        feeds, cached_length = NewsFeedService.get_cached_newsfeeds_range(self.linghu.id, count=2)
+        self.assertEqual([f.id for f in feeds], [f.id for f in newsfeeds[:2]])
+        self.assertEqual(cached_length, 5)
+        # cache 里只存了 newsfeed id 和 tweet id
+        self.assertEqual(
+            conn.zrevrange(key, 0, 0),
+            ['{}:{}'.format(newsfeeds[0].id, newsfeeds[0].tweet_id).encode('utf-8')],
+        )
+
+        # cache hit，按照 created_at 的范围查询
+        feeds, _ = NewsFeedService.get_cached_newsfeeds_range(
+            self.linghu.id,
+            created_at__lt=newsfeeds[1].created_at,
+            count=2,
+        )
+        self.assertEqual([f.id for f in feeds], [f.id for f in newsfeeds[2:4]])
+        self.assertEqual(feeds[0].tweet_id, newsfeeds[2].tweet_id)
+        self.assertEqual(feeds[0].user_id, self.linghu.id)
+        self.assertEqual(feeds[0].created_at, newsfeeds[2].created_at)
+
+        feeds, _ = NewsFeedService.get_cached_newsfeeds_range(
+            self.linghu.id,
+            created_at__gt=newsfeeds[2].created_at,
+        )
+        self.assertEqual([f.id for f in feeds], [f.id for f in newsfeeds[:2]])
+
 class NewsFeedTaskTests(TestCase):
 
     def setUp(self):
@@ -86,3 +160,222 @@ class NewsFeedTaskTests(TestCase):
         self.assertEqual(len(cached_list), 3)
         cached_list = NewsFeedService.get_cached_newsfeeds(self.dongxie.id)
         self.assertEqual(len(cached_list), 3)
+
+    def test_fanout_metrics(self):
+        Metrics.clear()
+        for i in range(4):
+            user = self.create_user('user{}'.format(i))
+            self.create_friendship(user, self.linghu)
+        tweet = self.create_tweet(self.linghu)
+        fanout_newsfeeds_main_task(
+            tweet.id,
+            self.linghu.id,
+            created_at=datetime_to_microseconds(tweet.created_at),
+            enqueued_at=time.time(),
+        )
+        count, percentiles = Metrics.get_percentiles('fanout.batch_count', [50])
+        self.assertEqual((count, percentiles), (1, {50: 2}))
+        # 所有 batch 执行完之后只记录一次 latency
+        count, percentiles = Metrics.get_percentiles('fanout.latency_ms', [50])
+        self.assertEqual(count, 1)
+        self.assertEqual(percentiles[50] >= 0, True)
+        self.assertEqual(Metrics.get_percentiles('fanout.main_queue_wait_ms')[0], 1)
+        self.assertEqual(Metrics.get_percentiles('fanout.batch_queue_wait_ms')[0], 2)
+        self.assertEqual(Metrics.get_percentiles('fanout.bulk_create_ms')[0], 2)
+        self.assertEqual(Metrics.get_percentiles('fanout.cache_push_ms')[0], 2)
+
+    def test_fanout_queue_tiers(self):
+        self.assertEqual(NewsFeedService.get_fanout_queue(0), 'newsfeeds_small')
+        self.assertEqual(NewsFeedService.get_fanout_queue(3), 'newsfeeds_small')
+        self.assertEqual(NewsFeedService.get_fanout_queue(4), 'newsfeeds_medium')
+        self.assertEqual(NewsFeedService.get_fanout_queue(5), 'newsfeeds_large')
+
+        Metrics.clear()
+        for i in range(4):
+            user = self.create_user('user{}'.format(i))
+            self.create_friendship(user, self.linghu)
+        tweet = self.create_tweet(self.linghu)
+        fanout_newsfeeds_main_task(tweet.id, self.linghu.id)
+        self.assertEqual(Metrics.get_counters()['fanout.newsfeeds_medium.batches'], 2)
+
+        conn = RedisClient.get_broker_connection()
+        conn.lpush('newsfeeds_large', 'message')
+        self.assertEqual(NewsFeedService.get_fanout_backlog(), {
+            'newsfeeds_small': 0,
+            'newsfeeds_medium': 0,
+            'newsfeeds_large': 1,
+        })
+
+    def test_fanout_is_idempotent_and_resumable(self):
+        followers = [self.create_user('user{}'.format(i)) for i in range(4)]
+        friendships = [self.create_friendship(user, self.linghu) for user in followers]
+        tweet = self.create_tweet(self.linghu)
+
+        # 重复执行的 batch 不会失败，也不会重复创建 newsfeeds
+        follower_ids = [user.id for user in followers[:2]]
+        fanout_newsfeeds_batch_task(tweet.id, follower_ids)
+        fanout_newsfeeds_batch_task(tweet.id, follower_ids)
+        self.assertEqual(NewsFeed.objects.filter(tweet=tweet).count(), 2)
+
+        # 模拟 main task 创建了第一个 batch 之后挂掉了，重新执行时从 checkpoint 继续
+        NewsFeedService.set_fanout_checkpoint(tweet.id, friendships[2].id)
+        msg = fanout_newsfeeds_main_task(tweet.id, self.linghu.id)
+        self.assertEqual(msg, '1 newsfeeds going to fanout, 1 batches created.')
+        self.assertEqual(NewsFeedService.get_fanout_checkpoint(tweet.id), friendships[3].id)
+        self.assertEqual(
+            set(NewsFeed.objects.filter(tweet=tweet).values_list('user_id', flat=True)),
+            {self.linghu.id, followers[0].id, followers[1].id, followers[3].id},
+        )
+
+        # 执行完之后再次执行不会重复 fanout
+        msg = fanout_newsfeeds_main_task(tweet.id, self.linghu.id)
+        self.assertEqual(msg, '0 newsfeeds going to fanout, 0 batches created.')
+        self.assertEqual(NewsFeed.objects.filter(tweet=tweet).count(), 4)
+
+    def test_fanout_pull_mode(self):
+        for i in range(FANOUT_FOLLOWER_THRESHOLD + 1):
+            user = self.create_user('user{}'.format(i))
+            self.create_friendship(user, self.linghu)
+        self.create_friendship(self.dongxie, self.linghu)
+
+        tweet = self.create_tweet(self.linghu, 'tweet 1')
+        msg = fanout_newsfeeds_main_task(tweet.id, self.linghu.id)
+        self.assertEqual(
+            msg,
+            '{} followers, skip fanout for pull mode user.'.format(FANOUT_FOLLOWER_THRESHOLD + 2),
+        )
+        # 只给自己创建了 newsfeed
+        self.assertEqual(NewsFeed.objects.filter(tweet=tweet).count(), 1)
+        self.assertEqual(NewsFeedService.get_pull_user_ids(self.dongxie.id), [self.linghu.id])
+        self.assertEqual(NewsFeedService.get_pull_user_ids(self.linghu.id), [])
+
+        # 读取的时候和自己的 newsfeeds 合并，并且按照 tweet 去重
+        own_feed = self.create_newsfeed(self.dongxie, self.create_tweet(self.dongxie))
+        old_feed = self.create_newsfeed(self.dongxie, tweet)
+        newsfeeds, _ = NewsFeedService.get_cached_newsfeeds_range(self.dongxie.id)
+        tweet2 = self.create_tweet(self.linghu, 'tweet 2')
+        merged = NewsFeedService.merge_pulled_tweets(
+            self.dongxie.id,
+            newsfeeds,
+            [self.linghu.id],
+            count=10,
+        )
+        self.assertEqual(
+            [(f.id, f.tweet_id) for f in merged],
+            [(-tweet2.id, tweet2.id), (old_feed.id, tweet.id), (own_feed.id, own_feed.tweet_id)],
+        )
+
+        # 往下翻页
+        merged = NewsFeedService.merge_pulled_tweets(
+            self.dongxie.id,
+            newsfeeds[1:],
+            [self.linghu.id],
+            created_at__lt=old_feed.created_at,
+            count=10,
+        )
+        self.assertEqual([f.tweet_id for f in merged], [own_feed.tweet_id, tweet.id])
+
+    @override_settings(FANOUT_DORMANT_MODE='skip')
+    def test_fanout_skips_dormant_followers(self):
+        Metrics.clear()
+        UserService.last_seen_written.clear()
+        dormant_user = self.create_user('dormant')
+        self.create_friendship(self.dongxie, self.linghu)
+        self.create_friendship(dormant_user, self.linghu)
+        # 没有记录最近访问时间的 followers 视为活跃
+        self.assertEqual(
+            UserService.split_active_user_ids([dormant_user.id]),
+            ([dormant_user.id], []),
+        )
+
+        UserService.touch_last_seen(self.dongxie.id)
+        dormant_user.last_login = utc_now() - timedelta(days=60)
+        UserService.backfill_last_seen([dormant_user])
+        # 不活跃之前已经有 cache
+        old_feed = self.create_newsfeed(dormant_user, self.create_tweet(self.dongxie))
+        NewsFeedService.get_cached_newsfeeds(dormant_user.id)
+        conn = RedisClient.get_connection()
+        dormant_key = USER_NEWSFEEDS_PATTERN.format(user_id=dormant_user.id)
+        self.assertEqual(conn.exists(dormant_key), True)
+
+        tweet = self.create_tweet(self.linghu)
+        fanout_newsfeeds_main_task(tweet.id, self.linghu.id)
+        self.assertEqual(NewsFeed.objects.filter(user=self.dongxie).count(), 1)
+        self.assertEqual(NewsFeed.objects.filter(user=dormant_user).count(), 1)
+        self.assertEqual(conn.exists(dormant_key), False)
+        counters = Metrics.get_counters()
+        self.assertEqual(counters['fanout.dormant_cache_write_skipped'], 1)
+        self.assertEqual(counters['fanout.dormant_db_write_skipped'], 1)
+        self.assertEqual(counters['fanout.dormant_cache_evicted'], 1)
+
+        # 已经清掉的 cache 不会再重复 DEL 和增加版本号
+        version = NewsFeedService.get_newsfeeds_version(dormant_user.id)
+        NewsFeedService.evict_cached_newsfeeds([dormant_user.id])
+        self.assertEqual(NewsFeedService.get_newsfeeds_version(dormant_user.id), version)
+
+        # 回来访问的时候从关注的人的 tweets 里补充，可以重复执行
+        backfill_dormant_user_newsfeeds_task(dormant_user.id, None)
+        backfill_dormant_user_newsfeeds_task(dormant_user.id, None)
+        newsfeeds = NewsFeed.objects.filter(user=dormant_user, tweet=tweet)
+        self.assertEqual(len(newsfeeds), 1)
+        self.assertEqual(newsfeeds[0].created_at, tweet.created_at)
+        feeds = NewsFeedService.get_cached_newsfeeds(dormant_user.id)
+        self.assertEqual([f.tweet_id for f in feeds], [tweet.id, old_feed.tweet_id])
+
+    def test_newsfeeds_versions(self):
+        conn = RedisClient.get_connection()
+        key = USER_NEWSFEEDS_VERSION_PATTERN.format(user_id=self.dongxie.id)
+
+        # 没有读取过版本号的 user 不会创建 key
+        self.assertEqual(NewsFeedService.bump_newsfeeds_versions([self.dongxie.id]), 0)
+        self.assertEqual(conn.exists(key), False)
+
+        # 读取之后才有版本号，并且会过期
+        self.assertEqual(NewsFeedService.get_newsfeeds_version(self.dongxie.id), 0)
+        self.assertEqual(0 < conn.ttl(key) <= settings.NEWSFEED_VERSION_TIMEOUT, True)
+        self.create_newsfeed(self.dongxie, self.create_tweet(self.linghu))
+        self.assertEqual(NewsFeedService.get_newsfeeds_version(self.dongxie.id), 1)
+        self.assertEqual(conn.ttl(key) > 0, True)
+
+        # 版本号过期之后不保存渲染结果
+        conn.delete(key)
+        NewsFeedService.set_rendered_first_page(self.dongxie.id, 1, [], [], False)
+        self.assertEqual(NewsFeedService.get_rendered_first_page(self.dongxie.id, []), None)
+        self.assertEqual(conn.exists(key), False)
+
+    def test_backfill_and_purge_followee(self):
+        tweets = [
+            self.create_tweet(self.linghu)
+            for _ in range(FOLLOW_BACKFILL_TWEETS_LIMIT + 1)
+        ]
+        # 还没有 follow 的时候不补充
+        backfill_followee_newsfeeds_task(self.dongxie.id, self.linghu.id)
+        self.assertEqual(NewsFeed.objects.filter(user=self.dongxie).count(), 0)
+
+        # follow 之后只补充最近的 FOLLOW_BACKFILL_TWEETS_LIMIT 条，可以重复执行
+        NewsFeedService.get_cached_newsfeeds(self.dongxie.id)
+        friendship = self.create_friendship(self.dongxie, self.linghu)
+        backfill_followee_newsfeeds_task(self.dongxie.id, self.linghu.id)
+        backfill_followee_newsfeeds_task(self.dongxie.id, self.linghu.id)
+        expected_ids = [t.id for t in reversed(tweets)][:FOLLOW_BACKFILL_TWEETS_LIMIT]
+        feeds = NewsFeedService.get_cached_newsfeeds(self.dongxie.id)
+        self.assertEqual([f.tweet_id for f in feeds], expected_ids)
+
+        # 重新 follow 了的情况下不删除
+        purge_followee_newsfeeds_task(self.dongxie.id, self.linghu.id)
+        self.assertEqual(
+            NewsFeed.objects.filter(user=self.dongxie).count(),
+            FOLLOW_BACKFILL_TWEETS_LIMIT,
+        )
+
+        # unfollow 之后从数据库和 cache 里都删除
+        own_tweet = self.create_tweet(self.dongxie)
+        NewsFeed.objects.create(user=self.dongxie, tweet=own_tweet)
+        friendship.delete()
+        purge_followee_newsfeeds_task(self.dongxie.id, self.linghu.id)
+        self.assertEqual(
+            [f.tweet_id for f in NewsFeed.objects.filter(user=self.dongxie)],
+            [own_tweet.id],
+        )
+        feeds = NewsFeedService.get_cached_newsfeeds(self.dongxie.id)
+        self.assertEqual([f.tweet_id for f in feeds], [own_tweet.id])
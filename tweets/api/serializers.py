@@ -1,4 +1,5 @@
 from accounts.api.serializers import UserSerializerForTweet
+from accounts.services import UserService
 from comments.api.serializers import CommentSerializer
 from likes.api.serializers import LikeSerializer
 from likes.services import LikeService
@@ -8,6 +9,7 @@ from tweets.constants import TWEET_PHOTOS_UPLOAD_LIMIT
 from tweets.models import Tweet
 from tweets.services import TweetService
 from utils.redis_helper import RedisHelper
+from utils.serializers import PreloadListSerializer
 
 
 class TweetListSerializer(serializers.ModelSerializer):
@@ -29,19 +31,50 @@ class TweetListSerializer(serializers.ModelSerializer):
             'has_liked',
             'photo_urls',
         )
+        # many=True 的时候会先调用 preload 批量读取整页 tweets 的数据
+        list_serializer_class = PreloadListSerializer
+
+    def preload(self, tweets):
+        # 一次 get_many 读出整页 tweets 的 users 和 profiles
+        UserService.preload_cached_users(tweets)
+        # 一次 MGET 读出整页 tweets 的 likes_count 和 comments_count
+        counts = RedisHelper.get_counts(tweets, ['likes_count', 'comments_count'])
+        setattr(self, '_preloaded_counts', counts)
+        tweet_ids = [tweet.id for tweet in tweets]
+        # 一次 object_id__in 的查询读出当前用户点过赞的 tweets
+        liked_tweet_ids = LikeService.get_liked_object_ids(
+            self.context['request'].user,
+            Tweet,
+            tweet_ids,
+        )
+        setattr(self, '_preloaded_liked_tweet_ids', liked_tweet_ids)
+        # 一次 tweet_id__in 的查询读出整页 tweets 的 photos
+        setattr(self, '_preloaded_photo_urls', TweetService.get_photo_urls_by_tweet(tweet_ids))
 
     def get_likes_count(self, obj):
         # return obj.like_set.count()
-        return RedisHelper.get_count(obj, 'likes_count')
+        return self._get_count(obj, 'likes_count')
 
     def get_comments_count(self, obj):
         # return obj.comment_set.count()
-        return RedisHelper.get_count(obj, 'comments_count')
+        return self._get_count(obj, 'comments_count')
+
+    def _get_count(self, obj, attr):
+        counts = getattr(self, '_preloaded_counts', {})
+        if attr in counts.get(obj.id, {}):
+            return counts[obj.id][attr]
+        return RedisHelper.get_count(obj, attr)
 
     def get_has_liked(self, obj):
+        liked_tweet_ids = getattr(self, '_preloaded_liked_tweet_ids', None)
+        if liked_tweet_ids is not None:
+            return obj.id in liked_tweet_ids
         return LikeService.has_liked(self.context['request'].user, obj)
 
     def get_photo_urls(self, obj):
+        preloaded_photo_urls = getattr(self, '_preloaded_photo_urls', {})
+        if obj.id in preloaded_photo_urls:
+            return preloaded_photo_urls[obj.id]
         photo_urls = []
         for photo in obj.tweetphoto_set.all().order_by('order'):
             photo_urls.append(photo.file.url)
@@ -1,8 +1,11 @@
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from rest_framework.test import APIClient # 与django自带的client的区别在于 请求和response的数据格式都要求成为json。
 from testing.testcases import TestCase
 from tweets.models import Tweet, TweetPhoto
 from utils.paginations import EndlessPagination
+from utils.time_helpers import utc_now
 
 
 # 注意要加 '/' 结尾，要不然会产生 301 redirect
@@ -45,6 +48,26 @@ class TweetApiTests(TestCase):
         self.assertEqual(response.data['results'][0]['id'], self.tweets2[1].id)
         self.assertEqual(response.data['results'][1]['id'], self.tweets2[0].id)
 
+    def test_list_api_preload(self):
+        self.create_like(self.user1, self.tweets1[0])
+        TweetPhoto.objects.create(tweet=self.tweets1[0], user=self.user1, file='b.jpg', order=1)
+        TweetPhoto.objects.create(tweet=self.tweets1[0], user=self.user1, file='a.jpg', order=0)
+        response = self.user1_client.get(TWEET_LIST_API, {'user_id': self.user1.id})
+        results = response.data['results']
+        self.assertEqual([r['has_liked'] for r in results], [False, False, True])
+        self.assertEqual(len(results[2]['photo_urls']), 2)
+        self.assertEqual('a.jpg' in results[2]['photo_urls'][0], True)
+        self.assertEqual('b.jpg' in results[2]['photo_urls'][1], True)
+        self.assertEqual(results[0]['photo_urls'], [])
+
+        # 每一页的查询次数和这一页有多少 tweets 无关
+        self.user1_client.get(TWEET_LIST_API, {'user_id': self.user2.id})
+        with CaptureQueriesContext(connection) as user1_queries:
+            self.user1_client.get(TWEET_LIST_API, {'user_id': self.user1.id})
+        with CaptureQueriesContext(connection) as user2_queries:
+            self.user1_client.get(TWEET_LIST_API, {'user_id': self.user2.id})
+        self.assertEqual(len(user1_queries), len(user2_queries))
+
     def test_create_api(self):
         # 必须登录
         response = self.anonymous_client.post(TWEET_CREATE_API)
@@ -204,3 +227,30 @@ class TweetApiTests(TestCase):
         self.assertEqual(response.data['has_next_page'], False)
         self.assertEqual(len(response.data['results']), 1)
         self.assertEqual(response.data['results'][0]['id'], new_tweet.id)
+
+    def test_cursor_pagination(self):
+        page_size = EndlessPagination.page_size
+        user = self.create_user('cursor_user')
+        tweets = [self.create_tweet(user) for _ in range(page_size * 2 + 1)]
+        # 所有的 tweets 的 created_at 都相同，只按照 created_at 翻页会跳过或者重复
+        Tweet.objects.filter(user=user).update(created_at=utc_now())
+        self.clear_cache()
+
+        results = []
+        response = self.anonymous_client.get(TWEET_LIST_API, {'user_id': user.id})
+        results.extend(response.data['results'])
+        while response.data['has_next_page']:
+            response = self.anonymous_client.get(TWEET_LIST_API, {
+                'user_id': user.id,
+                'cursor': response.data['next_cursor'],
+            })
+            results.extend(response.data['results'])
+        self.assertEqual(response.data['next_cursor'], None)
+        self.assertEqual([r['id'] for r in results], [t.id for t in reversed(tweets)])
+
+        # 不合法的 cursor
+        response = self.anonymous_client.get(TWEET_LIST_API, {
+            'user_id': user.id,
+            'cursor': 'not a cursor',
+        })
+        self.assertEqual(response.status_code, 400)
@@ -1,4 +1,5 @@
 from django.utils.decorators import method_decorator
+from functools import partial
 from newsfeeds.services import NewsFeedService
 from ratelimit.decorators import ratelimit
 from rest_framework import viewsets
@@ -67,10 +68,11 @@ class TweetViewSet(viewsets.GenericViewSet):
 
 
         user_id = request.query_params['user_id']
-        tweets = Tweet.objects.filter(user_id=user_id).prefetch_related('user')
-
-        cached_tweets = TweetService.get_cached_tweets(user_id)
-        page = self.paginator.paginate_cached_list(cached_tweets, request)
+        # 按照 cursor 的 created_at 从 sorted set 里只读取当前这一页需要的 tweets
+        page = self.paginator.paginate_cached_range(
+            partial(TweetService.load_cached_tweets_range, user_id),
+            request,
+        )
         if page is None:
             # 这句查询会被翻译为
             # select * from twitter_tweets
@@ -78,7 +80,7 @@ class TweetViewSet(viewsets.GenericViewSet):
             # order by created_at desc
             # 这句 SQL 查询会用到 user 和 created_at 的联合索引
             # 单纯的 user 索引是不够的
-            queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
+            queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at', '-id')
             page = self.paginate_queryset(queryset)
 
         # 将找出来的tweets传给serializer
@@ -4,3 +4,9 @@ def push_tweet_to_cache(sender, instance, created, **kwargs):
 
     from tweets.services import TweetService
     TweetService.push_tweet_to_cache(instance)
+
+
+def tweet_changed(sender, instance, **kwargs):
+    # pull 模式的 user 发了新的 tweet 或者 tweet 被修改了，渲染好的 newsfeeds 需要重新渲染
+    from accounts.services import UserService
+    UserService.bump_content_version(instance.user_id)
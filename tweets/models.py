@@ -8,7 +8,7 @@ from tweets.constants import TweetPhotoStatus, TWEET_PHOTO_STATUS_CHOICES
 from utils.memcached_helper import MemcachedHelper
 from django.db.models.signals import post_save, pre_delete
 from utils.listeners import invalidate_object_cache
-from tweets.listeners import push_tweet_to_cache
+from tweets.listeners import push_tweet_to_cache, tweet_changed
 
 
 # https://stackoverflow.com/questions/35129697/difference-between-model-fieldsin-django-and-serializer-fieldsin-django-rest
@@ -72,7 +72,12 @@ class Tweet(models.Model):
     @property
     def cached_user(self):
         # return UserService.get_user_through_cache(self.user_id)
-        return MemcachedHelper.get_object_through_cache(User, self.user_id)
+        # serializer 的 preload 会提前批量读好 user 记录在 _cached_user 上
+        if hasattr(self, '_cached_user'):
+            return getattr(self, '_cached_user')
+        user = MemcachedHelper.get_object_through_cache(User, self.user_id)
+        setattr(self, '_cached_user', user)
+        return user
 
 class TweetPhoto(models.Model):
     # 图片在哪个 Tweet 下面
@@ -116,3 +121,5 @@ class TweetPhoto(models.Model):
 post_save.connect(invalidate_object_cache, sender=Tweet)
 pre_delete.connect(invalidate_object_cache, sender=Tweet)
 post_save.connect(push_tweet_to_cache, sender=Tweet)
+post_save.connect(tweet_changed, sender=Tweet)
+pre_delete.connect(tweet_changed, sender=Tweet)
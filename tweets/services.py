@@ -1,7 +1,16 @@
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Case, Count, IntegerField, Value, When
+from likes.models import Like
 from tweets.models import Tweet
 from tweets.models import TweetPhoto
 from twitter.cache import USER_TWEETS_PATTERN
+from utils.memcached_helper import MemcachedHelper
 from utils.redis_helper import RedisHelper
+from utils.time_helpers import datetime_to_microseconds, utc_now
+
+RECONCILE_BATCH_SIZE = 500
 
 class TweetService(object):
 
@@ -18,16 +27,149 @@ class TweetService(object):
             photos.append(photo)
         TweetPhoto.objects.bulk_create(photos)
 
+    @classmethod
+    def get_photo_urls_by_tweet(cls, tweet_ids):
+        """
+        一次 tweet_id__in 的查询读出所有 tweets 的 photos，返回 {tweet_id: [photo url]}
+        每个 tweet 的 photos 按照 order 排列，没有 photo 的 tweet 也会有一个空的 list
+        """
+        photo_urls = {tweet_id: [] for tweet_id in tweet_ids}
+        if not photo_urls:
+            return photo_urls
+        photos = TweetPhoto.objects.filter(
+            tweet_id__in=list(photo_urls),
+        ).order_by('tweet_id', 'order', 'id')
+        for photo in photos:
+            photo_urls[photo.tweet_id].append(photo.file.url)
+        return photo_urls
+
+    # user 的 tweets 在 redis 里存成一个 sorted set，只存 ids
+    # member 补齐到相同的长度，created_at 相同的时候 sorted set 按照 member 的字典序排列
+    # 也就是按照 id 排列，和数据库里 order by created_at desc, id desc 的顺序一致
+    # 翻页的时候按照 score 的范围读取，不需要读出整个 cache 再查找 cursor 的位置
+    @classmethod
+    def _to_member(cls, tweet):
+        return '{:020d}'.format(tweet.id), datetime_to_microseconds(tweet.created_at)
+
+    @classmethod
+    def _get_queryset(cls, user_id):
+        return Tweet.objects.filter(user_id=user_id).order_by('-created_at', '-id')
+
+    @classmethod
+    def load_cached_tweets_range(cls, user_id, created_at__lt=None, created_at__gt=None, count=None):
+        """
+        从 cache 里读取 created_at__gt < created_at < created_at__lt 的前 count 个 tweets
+        返回 (tweets, cache 里 tweets 的总数)
+        """
+        items, cached_length = RedisHelper.load_sorted_set_range(
+            USER_TWEETS_PATTERN.format(user_id=user_id),
+            cls._get_queryset(user_id),
+            cls._to_member,
+            max_score=None if created_at__lt is None else datetime_to_microseconds(created_at__lt),
+            min_score=None if created_at__gt is None else datetime_to_microseconds(created_at__gt),
+            count=count,
+        )
+        tweet_ids = [int(member) for member, _ in items]
+        # 一次 get_many 读出这一页的 tweets，已经删除的 tweets 会被跳过
+        tweets = MemcachedHelper.get_objects_through_cache(Tweet, tweet_ids)
+        return [
+            tweets[tweet_id]
+            for tweet_id in tweet_ids
+            if tweet_id in tweets
+        ], cached_length
+
     @classmethod
     def get_cached_tweets(cls, user_id):
-        queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
-        key = USER_TWEETS_PATTERN.format(user_id=user_id)
-        return RedisHelper.load_objects(key, queryset)
+        tweets, _ = cls.load_cached_tweets_range(user_id)
+        return tweets
+
+    @classmethod
+    def get_cached_tweets_range(cls, user_id, created_at__lt=None, created_at__gt=None, count=None):
+        """
+        读取 created_at__gt < created_at < created_at__lt 的前 count 个 tweets
+        cache 里的数据不够的时候去数据库查询
+        """
+        tweets, cached_length = cls.load_cached_tweets_range(
+            user_id,
+            created_at__lt=created_at__lt,
+            created_at__gt=created_at__gt,
+            count=count,
+        )
+        # cache 里已经是全部的数据，或者已经读够了 count 个
+        if cached_length < settings.REDIS_LIST_LENGTH_LIMIT:
+            return tweets
+        if count is not None and len(tweets) >= count:
+            return tweets
 
+        queryset = Tweet.objects.filter(user_id=user_id)
+        if created_at__lt is not None:
+            queryset = queryset.filter(created_at__lt=created_at__lt)
+        if created_at__gt is not None:
+            queryset = queryset.filter(created_at__gt=created_at__gt)
+        queryset = queryset.order_by('-created_at', '-id')
+        if count is not None:
+            queryset = queryset[:count]
+        return list(queryset)
 
-    # 当我发了一条帖子之后，要把这个帖子放在key的左侧
+    # 当我发了一条帖子之后，要把这个帖子放进 sorted set
     @classmethod
     def push_tweet_to_cache(cls, tweet):
-        queryset = Tweet.objects.filter(user_id=tweet.user_id).order_by('-created_at')
-        key = USER_TWEETS_PATTERN.format(user_id=tweet.user_id)
-        RedisHelper.push_object(key, tweet, queryset)
+        RedisHelper.push_to_sorted_set(
+            USER_TWEETS_PATTERN.format(user_id=tweet.user_id),
+            tweet,
+            cls._get_queryset(tweet.user_id),
+            cls._to_member,
+        )
+
+    @classmethod
+    def reconcile_recent_counts(cls, hours):
+        """
+        write-behind 模式下如果 redis 丢失了还没写回的 deltas，数据库里的计数就不准了
+        likes 和 comments 表才是真正的数据来源，用它们重新计算最近 hours 小时内
+        被点赞、被评论或者新发布的 tweets 的计数
+        """
+        from comments.models import Comment
+
+        since = utc_now() - timedelta(hours=hours)
+        tweet_ids = set(Like.objects.filter(
+            content_type=ContentType.objects.get_for_model(Tweet),
+            created_at__gte=since,
+        ).values_list('object_id', flat=True))
+        tweet_ids |= set(Comment.objects.filter(
+            created_at__gte=since,
+        ).values_list('tweet_id', flat=True))
+        tweet_ids |= set(Tweet.objects.filter(
+            created_at__gte=since,
+        ).values_list('id', flat=True))
+        tweet_ids.discard(None)
+
+        tweet_ids = sorted(tweet_ids)
+        for index in range(0, len(tweet_ids), RECONCILE_BATCH_SIZE):
+            cls.reconcile_counts(tweet_ids[index: index + RECONCILE_BATCH_SIZE])
+        return len(tweet_ids)
+
+    @classmethod
+    def reconcile_counts(cls, tweet_ids):
+        from comments.models import Comment
+
+        likes_counts = dict(Like.objects.filter(
+            content_type=ContentType.objects.get_for_model(Tweet),
+            object_id__in=tweet_ids,
+        ).values('object_id').annotate(count=Count('id')).values_list('object_id', 'count'))
+        comments_counts = dict(Comment.objects.filter(
+            tweet_id__in=tweet_ids,
+        ).values('tweet_id').annotate(count=Count('id')).values_list('tweet_id', 'count'))
+
+        Tweet.objects.filter(id__in=tweet_ids).update(
+            likes_count=cls._case_by_id(likes_counts),
+            comments_count=cls._case_by_id(comments_counts),
+        )
+        RedisHelper.reset_counts(Tweet, tweet_ids, ['likes_count', 'comments_count'])
+
+    @classmethod
+    def _case_by_id(cls, values):
+        return Case(
+            *[When(id=tweet_id, then=Value(value)) for tweet_id, value in values.items()],
+            default=Value(0),
+            output_field=IntegerField(),
+        )
@@ -0,0 +1,27 @@
+from celery import shared_task
+from tweets.models import Tweet
+from utils.redis_helper import RedisHelper
+from utils.time_constants import ONE_HOUR
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def flush_tweet_counters_task():
+    # write-behind 模式下累积在 redis 里的计数变化批量写回数据库
+    # 即使关闭了 write-behind 模式也继续运行，把之前累积的 deltas 写完
+    flushed = {
+        attr: RedisHelper.flush_count_deltas(Tweet, attr)
+        for attr in ('likes_count', 'comments_count')
+    }
+    return '{} likes_count and {} comments_count flushed.'.format(
+        flushed['likes_count'],
+        flushed['comments_count'],
+    )
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def reconcile_tweet_counters_task(hours):
+    # redis 丢失了 write-behind 的 deltas 之后，用 likes 和 comments 表重新计算最近
+    # hours 小时内有变化的 tweets 的计数
+    from tweets.services import TweetService
+    count = TweetService.reconcile_recent_counts(hours)
+    return '{} tweets reconciled.'.format(count)
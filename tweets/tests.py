@@ -1,8 +1,14 @@
 from datetime import timedelta
+from django.conf import settings
+from django.db.models import F
+from django.test import override_settings
 from testing.testcases import TestCase
 from tweets.constants import TweetPhotoStatus
-from tweets.models import TweetPhoto
+from tweets.models import Tweet, TweetPhoto
+from tweets.tasks import flush_tweet_counters_task
 from utils.redis_client import RedisClient
+from utils.models import CounterFlush
+from utils.redis_helper import RedisHelper
 from utils.redis_serializers import DjangoModelSerializer
 from utils.time_helpers import utc_now
 from tweets.services import TweetService
@@ -101,3 +107,136 @@ class TweetServiceTests(TestCase):
 
         tweets = TweetService.get_cached_tweets(self.linghu.id)
         self.assertEqual([t.id for t in tweets], [tweet2.id, tweet1.id])
+
+    def test_load_cached_tweets_range(self):
+        tweets = []
+        for i in range(5):
+            tweets.append(self.create_tweet(self.linghu, 'tweet {}'.format(i)))
+        tweets = tweets[::-1]
+        tweet_ids = [t.id for t in tweets]
+
+        RedisClient.clear()
+
+        # cache miss
+        loaded, cached_length = TweetService.load_cached_tweets_range(self.linghu.id, count=2)
+        self.assertEqual([t.id for t in loaded], tweet_ids[:2])
+        self.assertEqual(cached_length, 5)
+
+        # cache hit，只读取 cursor 之后的 tweets
+        loaded, cached_length = TweetService.load_cached_tweets_range(
+            self.linghu.id,
+            created_at__lt=tweets[0].created_at,
+            count=3,
+        )
+        self.assertEqual([t.id for t in loaded], tweet_ids[1:4])
+        self.assertEqual(cached_length, 5)
+
+        loaded, cached_length = TweetService.load_cached_tweets_range(
+            self.linghu.id,
+            created_at__gt=tweets[2].created_at,
+        )
+        self.assertEqual([t.id for t in loaded], tweet_ids[:2])
+        self.assertEqual(cached_length, 5)
+
+        # 删除的 tweet 不会出现在结果里
+        tweets[1].delete()
+        loaded, _ = TweetService.load_cached_tweets_range(self.linghu.id, count=3)
+        self.assertEqual([t.id for t in loaded], [tweet_ids[0], tweet_ids[2]])
+
+    @override_settings(COUNTER_WRITE_BEHIND=True)
+    def test_write_behind_counts(self):
+        tweet = self.create_tweet(self.linghu, 'tweet')
+        dongxie = self.create_user('dongxie')
+        self.create_like(self.linghu, tweet)
+        self.create_like(dongxie, tweet)
+        self.create_comment(dongxie, tweet)
+
+        # 数据库还没有被修改，redis 里是最新的计数
+        tweet.refresh_from_db()
+        self.assertEqual(tweet.likes_count, 0)
+        self.assertEqual(tweet.comments_count, 0)
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 2)
+        self.assertEqual(RedisHelper.get_count(tweet, 'comments_count'), 1)
+
+        # redis 计数器过期之后，用数据库的值加上没有写回的 deltas 重新初始化
+        conn = RedisClient.get_connection()
+        conn.delete(RedisHelper.get_count_key(tweet, 'likes_count'))
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 2)
+
+        flush_tweet_counters_task()
+        tweet.refresh_from_db()
+        self.assertEqual(tweet.likes_count, 2)
+        self.assertEqual(tweet.comments_count, 1)
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 2)
+
+        # 再次 flush 不会重复写回
+        flush_tweet_counters_task()
+        tweet.refresh_from_db()
+        self.assertEqual(tweet.likes_count, 2)
+
+    @override_settings(COUNTER_WRITE_BEHIND=True)
+    def test_flush_interleaved_with_cold_read(self):
+        tweet = self.create_tweet(self.linghu, 'tweet')
+        dongxie = self.create_user('dongxie')
+        self.create_like(self.linghu, tweet)
+        self.create_like(dongxie, tweet)
+        conn = RedisClient.get_connection()
+        key = RedisHelper.get_count_key(tweet, 'likes_count')
+        deltas_key, flushing_key = RedisHelper.get_count_deltas_keys(Tweet, 'likes_count')
+        lock_key, generation_key, _ = RedisHelper.get_count_flush_keys(Tweet, 'likes_count')
+
+        # 读数据库和读 deltas 之间有一次完整的 flush，算出来的值不能写进 cache
+        conn.delete(key)
+        guards = RedisHelper._get_flush_guards(Tweet, ['likes_count'])
+        self.assertEqual(Tweet.objects.get(id=tweet.id).likes_count, 0)
+        RedisHelper.flush_count_deltas(Tweet, 'likes_count')
+        pending, cacheable = RedisHelper._get_pending_deltas(
+            Tweet, ['likes_count'], [tweet.id], guards,
+        )
+        self.assertEqual(pending['likes_count'].get(tweet.id, 0), 0)
+        self.assertEqual(cacheable['likes_count'], False)
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 2)
+
+        # 模拟 flush 在 UPDATE 提交之后、删除 deltas 之前挂掉了
+        self.create_like(self.create_user('ouyang'), tweet)
+        conn.rename(deltas_key, flushing_key)
+        generation = conn.incr(generation_key)
+        Tweet.objects.filter(id=tweet.id).update(likes_count=F('likes_count') + 1)
+        CounterFlush.objects.create(
+            flush_key=RedisHelper.get_count_flush_key(Tweet, 'likes_count', generation),
+            object_ids=str(tweet.id),
+        )
+        lock = conn.lock(lock_key, timeout=settings.COUNTER_FLUSH_LOCK_TIMEOUT)
+        lock.acquire(blocking=False)
+
+        # 锁还没有过期的时候，cache miss 读到的数据库的值和 deltas 里都有这个 +1，不会写进 cache
+        conn.delete(key)
+        RedisHelper.get_count(tweet, 'likes_count')
+        self.assertEqual(conn.exists(key), False)
+        RedisHelper.get_counts([tweet], ['likes_count'])
+        self.assertEqual(conn.exists(key), False)
+
+        # 重试的时候不会重复写回
+        lock.release()
+        RedisHelper.flush_count_deltas(Tweet, 'likes_count')
+        self.assertEqual(Tweet.objects.get(id=tweet.id).likes_count, 3)
+        self.assertEqual(conn.exists(flushing_key), False)
+        self.assertEqual(CounterFlush.objects.count(), 0)
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 3)
+        self.assertEqual(conn.get(key), b'3')
+
+    @override_settings(COUNTER_WRITE_BEHIND=True)
+    def test_reconcile_recent_counts(self):
+        tweet = self.create_tweet(self.linghu, 'tweet')
+        self.create_like(self.linghu, tweet)
+        self.create_comment(self.linghu, tweet)
+
+        # 模拟 redis 丢失了还没写回的 deltas
+        RedisClient.clear()
+        self.assertEqual(Tweet.objects.get(id=tweet.id).likes_count, 0)
+
+        self.assertEqual(TweetService.reconcile_recent_counts(1), 1)
+        tweet.refresh_from_db()
+        self.assertEqual(tweet.likes_count, 1)
+        self.assertEqual(tweet.comments_count, 1)
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 1)
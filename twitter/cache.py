@@ -2,8 +2,50 @@
 FOLLOWINGS_PATTERN = 'followings:{user_id}'
 USER_PATTERN = 'user:{user_id}'
 USER_PROFILE_PATTERN = 'userprofile:{user_id}'
+# 渲染好的 newsfeeds 第一页
+RENDERED_NEWSFEEDS_PATTERN = 'rendered_newsfeeds:{user_id}'
+# cache miss 时只有拿到 lease 的请求去数据库 load
+CACHE_LEASE_PATTERN = 'lease:{key}'
 
 
 # redis
-USER_TWEETS_PATTERN = 'user_tweets:{user_id}'
-USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:{user_id}'
+# sorted set，user 最新的 tweets 的 ids，和之前存成 list 的 user_tweets:{user_id} 使用不同的 key
+#   member: 补齐到 20 位的 tweet id，score: created_at 的 microseconds
+USER_TWEETS_PATTERN = 'user_tweet_ids:{user_id}'
+# sorted set，和之前存成 list 的 user_newsfeeds:{user_id} 使用不同的 key，升级的时候不会冲突
+USER_NEWSFEEDS_PATTERN = 'user_newsfeed_ids:{user_id}'
+# sorted set，tweet 最早的 comments 的 ids（comments 从旧到新翻页）
+#   member: 补齐到 20 位的 comment id，score: created_at 的 microseconds
+TWEET_COMMENTS_PATTERN = 'tweet_comment_ids:{tweet_id}'
+# set，所有 pull 模式的 user ids
+NEWSFEED_PULL_USERS_KEY = 'newsfeed_pull_users'
+# sorted set，member: user id，score: 最近一次访问的时间戳
+USER_LAST_SEEN_KEY = 'user_last_seen'
+# 版本号，渲染好的 newsfeeds 第一页用来判断是否过期
+#   newsfeeds 有变化的时候增加 user 的 newsfeeds 版本号
+#   user / profile / tweets 有变化的时候增加 user 的内容版本号
+USER_NEWSFEEDS_VERSION_PATTERN = 'user_newsfeeds_version:{user_id}'
+USER_CONTENT_VERSION_PATTERN = 'user_content_version:{user_id}'
+# user 的 followers 和 followings 的个数，避免每次 COUNT(*)
+FOLLOWER_COUNT_PATTERN = 'follower_count:{user_id}'
+FOLLOWING_COUNT_PATTERN = 'following_count:{user_id}'
+# 一个 tweet 还没有执行完的 fanout batch 任务的个数，用来判断最后一个 batch
+FANOUT_PENDING_BATCHES_PATTERN = 'fanout_pending_batches:{tweet_id}'
+# 一个 tweet 的 fanout 已经创建了 batch 任务的最后一个 friendship id
+FANOUT_CHECKPOINT_PATTERN = 'fanout_checkpoint:{tweet_id}'
+# list，RedisMetricsSink 记录的最近的值
+METRICS_OBSERVATIONS_PATTERN = 'metrics_observations:{name}'
+# cache 重建时的 single-flight 锁
+CACHE_REBUILD_LOCK_PATTERN = 'rebuild_lock:{key}'
+# 重建 cache 的过程中有新的数据没能 push 进去，重建的结果不能再写进 cache
+CACHE_REBUILD_DIRTY_PATTERN = 'rebuild_dirty:{key}'
+# write-behind 模式下还没有写回数据库的计数变化
+COUNT_DELTAS_PATTERN = 'count_deltas:{name}'
+COUNT_DELTAS_FLUSHING_PATTERN = 'count_deltas_flushing:{name}'
+COUNT_FLUSH_LOCK_PATTERN = 'flush_lock:{key}'
+# 每次把 deltas rename 成 flushing 的时候加一，用来识别数据库里这一轮 flush 的记录
+COUNT_FLUSH_GENERATION_PATTERN = 'count_flush_generation:{name}'
+# 每写回一批 deltas 加一，cache miss 时读数据库的前后不一样说明中间有 flush，不能写 cache
+COUNT_FLUSH_EPOCH_PATTERN = 'count_flush_epoch:{name}'
+# 进程内 L1 cache 的 invalidate 通知
+LOCAL_CACHE_INVALIDATION_CHANNEL = 'local_cache_invalidation'
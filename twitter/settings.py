@@ -55,6 +55,8 @@ INSTALLED_APPS = [
     'comments',
     'likes',
     'inbox',
+    # write-behind 计数器写回数据库的记录
+    'utils',
 ]
 
 REST_FRAMEWORK = {
@@ -73,6 +75,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'utils.middlewares.UserActivityMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -211,19 +214,121 @@ CACHES = {
 REDIS_HOST = '127.0.0.1'
 REDIS_PORT = 6379
 REDIS_DB = 0 if TESTING else 1
+# celery broker 使用的 db，和 CELERY_BROKER_URL 保持一致
+REDIS_BROKER_DB = 0 if TESTING else 2
+# 每个进程里每个 db 的 connection pool 最多建立多少个连接
+REDIS_MAX_CONNECTIONS = 50
+# 连接都在使用中的时候，最多等待这么久拿到一个空闲的连接，超时之后才报错
+REDIS_POOL_TIMEOUT = 2  # in seconds
+REDIS_SOCKET_TIMEOUT = 1  # in seconds
+REDIS_SOCKET_CONNECT_TIMEOUT = 1  # in seconds
+REDIS_SOCKET_KEEPALIVE = True
+# 连接空闲超过这么久之后，下次使用前先 PING 一下检查连接是否还可用
+REDIS_HEALTH_CHECK_INTERVAL = 30  # in seconds
 REDIS_KEY_EXPIRE_TIME = 7 * 86400  # in seconds
 REDIS_LIST_LENGTH_LIMIT = 1000 if not TESTING else 20
 
+# cache 重建的 single-flight 配置
+# 热门 key 过期的时候只有拿到锁的请求去数据库查询并写 cache
+# 其他请求每隔 CACHE_REBUILD_POLL_INTERVAL 秒检查一次 cache，最多检查 CACHE_REBUILD_POLL_TIMES 次
+# 超时之后直接读数据库，但是不写 cache
+CACHE_REBUILD_LOCK_TIMEOUT = 5  # in seconds
+CACHE_REBUILD_POLL_INTERVAL = 0.05  # in seconds
+CACHE_REBUILD_POLL_TIMES = 10
+# 数据库里不存在的 object 在 memcached 里记录多久，避免对不存在的 id 的请求每次都查询数据库
+# object 被创建的时候 post_save 会 invalidate 这个 key
+NEGATIVE_CACHE_TIMEOUT = 60  # in seconds
+
+# 进程内的 L1 cache，缓存 User 和 UserProfile 这类很少修改的 objects
+# 修改时通过 redis pub/sub 通知所有进程删除，TTL 是漏掉通知时的兜底
+LOCAL_CACHE_ENABLED = False
+LOCAL_CACHE_MAX_SIZE = 10000
+LOCAL_CACHE_TIMEOUT = 60  # in seconds
+# MemcachedHelper 里使用 L1 cache 的 models
+LOCAL_CACHE_MODELS = ('User',)
+
+# write-behind 模式下，likes_count 和 comments_count 的变化只写进 redis
+# 由 celery beat 每隔 COUNTER_FLUSH_INTERVAL 秒批量写回数据库，避免热门 tweet 的行锁竞争
+COUNTER_WRITE_BEHIND = False
+COUNTER_FLUSH_INTERVAL = 10  # in seconds
+COUNTER_FLUSH_BATCH_SIZE = 500
+COUNTER_FLUSH_LOCK_TIMEOUT = 60  # in seconds
+
+# 超过 USER_DORMANT_DAYS 天没有访问过的 user 视为不活跃
+USER_DORMANT_DAYS = 30
+# 每个进程里同一个 user 最多每隔这么久更新一次最近访问时间
+USER_LAST_SEEN_UPDATE_INTERVAL = 600  # in seconds
+# 每个进程最多记录多少个 users 最近一次写 last seen 的时间
+USER_LAST_SEEN_THROTTLE_MAX_SIZE = 10000
+# fanout 时怎么处理不活跃的 followers
+#   'db_only': 只写数据库，不写 cache（并删除已有的 cache）
+#   'skip': 数据库和 cache 都不写，下次访问的时候再从关注的人的 tweets 里拉取
+FANOUT_DORMANT_MODE = 'db_only'
+
+# 渲染好的 newsfeeds 第一页在 memcached 里保存多久
+# 版本号没有变化的时候直接返回，只需要重新读取 has_liked 和计数
+NEWSFEED_RENDERED_PAGE_TIMEOUT = 300  # in seconds
+# 渲染结果用到的版本号在 redis 里保存多久，必须比渲染结果保存得久
+# 只有读取过的版本号才会存在，没有人读取的 users 不会在 redis 里留下版本号
+NEWSFEED_VERSION_TIMEOUT = NEWSFEED_RENDERED_PAGE_TIMEOUT * 2  # in seconds
+
+# Metrics.observe 记录的耗时等数据写到哪里
+#   'utils.metrics.InMemoryMetricsSink': 每个进程各自保存，同时打 log
+#   'utils.metrics.RedisMetricsSink': 保存在 redis 里，所有进程共享
+METRICS_SINK = 'utils.metrics.InMemoryMetricsSink'
+# 每个名字保留最近多少个值
+METRICS_SINK_MAX_OBSERVATIONS = 1000
+
 # Celery Configuration Options
 # 使用如下命令把 worker 进程（只执行异步任务的进程，可以在不同的机器上）单独跑起来
 #   celery -A twitter worker -l INFO
-CELERY_BROKER_URL = 'redis://127.0.0.1:6379/2' if not TESTING else 'redis://127.0.0.1:6379/0'
+CELERY_BROKER_URL = 'redis://{}:{}/{}'.format(REDIS_HOST, REDIS_PORT, REDIS_BROKER_DB)
+# celery 自己管理 broker 的连接，这里限制每个进程的连接数并打开 keepalive
+CELERY_BROKER_POOL_LIMIT = 10
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'socket_timeout': REDIS_SOCKET_TIMEOUT,
+    'socket_connect_timeout': REDIS_SOCKET_CONNECT_TIMEOUT,
+    'socket_keepalive': REDIS_SOCKET_KEEPALIVE,
+    # worker 轮流读取 -Q 里的每个 queue，只要有 worker 在读，任何一个 queue 都不会被饿死
+    # 不能用 'priority'：那样前面的 queue 一直有任务的时候，后面的 queue 永远读不到
+    'queue_order_strategy': 'round_robin',
+}
 CELERY_TIMEZONE = "UTC"
 CELERY_TASK_ALWAYS_EAGER = TESTING
+# fanout 的 batch 任务按照 followers 的数量分到 newsfeeds_small / medium / large 三个 queue
+# （见 newsfeeds.constants.FANOUT_QUEUE_TIERS），使用如下命令分配 workers
+#   celery -A twitter worker -Q newsfeeds_small,newsfeeds_medium,newsfeeds_large -c 6
+#   celery -A twitter worker -Q newsfeeds_small -c 4
+# 第一组 workers 轮流读取三个 queues，第二组只处理小的 fanout
+# 每个 tier 的权重来自于读取它的 workers 的 concurrency，三个 queues 都有任务的时候
+# small 大约分到 4 + 6 / 3 = 6 个 workers，medium 和 large 各大约 2 个
 CELERY_QUEUES = (
     Queue('default', routing_key='default'),
     Queue('newsfeeds', routing_key='newsfeeds'),
+    Queue('newsfeeds_small', routing_key='newsfeeds_small'),
+    Queue('newsfeeds_medium', routing_key='newsfeeds_medium'),
+    Queue('newsfeeds_large', routing_key='newsfeeds_large'),
 )
+CELERY_TASK_ROUTES = {
+    # fanout 的 batch 任务由 main 任务在 apply_async 的时候按照 followers 的数量指定 queue
+    # 没有指定 queue 的调用（比如手动重试）当作最大的 tier，不会挤占小的 fanout
+    'newsfeeds.tasks.fanout_newsfeeds_batch_task': {
+        'queue': 'newsfeeds_large',
+        'routing_key': 'newsfeeds_large',
+    },
+}
+# 使用如下命令启动定时任务
+#   celery -A twitter beat -l INFO
+CELERY_BEAT_SCHEDULE = {
+    'flush-tweet-counters': {
+        'task': 'tweets.tasks.flush_tweet_counters_task',
+        'schedule': COUNTER_FLUSH_INTERVAL,
+    },
+    'flush-comment-counters': {
+        'task': 'comments.tasks.flush_comment_counters_task',
+        'schedule': COUNTER_FLUSH_INTERVAL,
+    },
+}
 
 # Rate Limiter
 RATELIMIT_USE_CACHE = 'ratelimit'
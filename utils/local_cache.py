@@ -0,0 +1,154 @@
+from collections import OrderedDict
+from django.conf import settings
+from twitter.cache import LOCAL_CACHE_INVALIDATION_CHANNEL
+from utils.metrics import Metrics
+from utils.redis_client import RedisClient
+
+import copy
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LocalCache:
+    """
+    进程内的 LRU cache（L1），放在 memcached 前面
+    用来缓存 User 和 UserProfile 这类几乎每一行数据都会用到、又很少修改的 objects
+
+    - 最多保存 LOCAL_CACHE_MAX_SIZE 个 key，超出时淘汰最久没有访问的 key
+    - 每个 key 最多保存 LOCAL_CACHE_TIMEOUT 秒，即使漏掉了 invalidate 通知也不会一直读到旧数据
+    - invalidate 时通过 redis pub/sub 通知所有进程删除自己 L1 里的 key
+    """
+    # key -> (过期时间, value)
+    store = OrderedDict()
+    lock = threading.Lock()
+    # 启动了 subscriber 线程的进程的 pid
+    subscriber_pid = None
+
+    @classmethod
+    def is_enabled(cls):
+        return settings.LOCAL_CACHE_ENABLED
+
+    @classmethod
+    def get(cls, key):
+        if not cls.is_enabled():
+            return None
+        cls._ensure_subscriber()
+        with cls.lock:
+            item = cls.store.get(key)
+            if item is not None and item[0] < time.monotonic():
+                del cls.store[key]
+                item = None
+            if item is None:
+                Metrics.incr('local_cache.misses')
+                return None
+            cls.store.move_to_end(key)
+        Metrics.incr('local_cache.hits')
+        return cls._copy(item[1])
+
+    @classmethod
+    def set(cls, key, value):
+        if not cls.is_enabled() or value is None:
+            return
+        cls._ensure_subscriber()
+        expire_at = time.monotonic() + settings.LOCAL_CACHE_TIMEOUT
+        value = cls._copy(value)
+        with cls.lock:
+            cls.store[key] = (expire_at, value)
+            cls.store.move_to_end(key)
+            while len(cls.store) > settings.LOCAL_CACHE_MAX_SIZE:
+                cls.store.popitem(last=False)
+
+    @classmethod
+    def invalidate(cls, key):
+        if not cls.is_enabled():
+            return
+        cls.delete(key)
+        # 通知其他进程（包括其他机器上的进程）删除这个 key
+        RedisClient.get_connection().publish(LOCAL_CACHE_INVALIDATION_CHANNEL, key)
+
+    @classmethod
+    def delete(cls, key):
+        with cls.lock:
+            cls.store.pop(key, None)
+
+    @classmethod
+    def clear(cls):
+        with cls.lock:
+            cls.store.clear()
+
+    @classmethod
+    def get_stats(cls):
+        counters = Metrics.get_counters()
+        with cls.lock:
+            size = len(cls.store)
+        return {
+            'size': size,
+            'hits': counters.get('local_cache.hits', 0),
+            'misses': counters.get('local_cache.misses', 0),
+        }
+
+    @classmethod
+    def _copy(cls, value):
+        # 调用方会在 object 上 setattr（比如 _cached_user_profile）
+        # 返回副本，避免修改到 L1 里保存的 object
+        value = copy.copy(value)
+        state = getattr(value, '_state', None)
+        if state is not None:
+            value._state = copy.copy(state)
+            value._state.fields_cache = {}
+        return value
+
+    @classmethod
+    def _ensure_subscriber(cls):
+        if cls.subscriber_pid == os.getpid():
+            return
+        with cls.lock:
+            if cls.subscriber_pid == os.getpid():
+                return
+            # fork 出来的子进程不会继承父进程的 subscriber 线程，需要重新启动
+            cls.store.clear()
+            cls.subscriber_pid = os.getpid()
+        thread = threading.Thread(
+            target=cls._listen,
+            name='local-cache-invalidation',
+            daemon=True,
+        )
+        thread.start()
+
+    @classmethod
+    def _listen(cls):
+        pid = os.getpid()
+        while cls.subscriber_pid == pid:
+            pubsub = None
+            try:
+                # subscriber 使用单独的连接，不占用处理请求的 pool
+                pubsub = RedisClient.get_subscriber_connection().pubsub(
+                    ignore_subscribe_messages=True,
+                )
+                pubsub.subscribe(LOCAL_CACHE_INVALIDATION_CHANNEL)
+                # 断线期间可能漏掉了 invalidate 通知，重新订阅之后清空 L1
+                cls.clear()
+                while cls.subscriber_pid == pid:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        cls._handle_message(message)
+            except Exception:
+                logger.exception('local cache subscriber disconnected, retrying')
+                cls.clear()
+                time.sleep(1)
+            finally:
+                if pubsub is not None:
+                    pubsub.close()
+
+    @classmethod
+    def _handle_message(cls, message):
+        if message.get('type') != 'message':
+            return
+        key = message['data']
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        cls.delete(key)
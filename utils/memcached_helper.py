@@ -1,8 +1,20 @@
 from django.conf import settings
 from django.core.cache import caches
+from twitter.cache import CACHE_LEASE_PATTERN
+from utils.local_cache import LocalCache
+from utils.metrics import Metrics
+
+import time
+import uuid
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
+# cache.get 的默认值，用来区分 cache miss 和 cache 里存的值
+_ABSENT = object()
+# 数据库里不存在的 object 在 cache 里存成这个值（negative caching）
+# python-memcached 的 get 没有办法区分存进去的 None 和 cache miss，所以不能直接存 None
+DOES_NOT_EXIST = '__does_not_exist__'
+
 
 class MemcachedHelper:
 
@@ -10,23 +22,143 @@ class MemcachedHelper:
     def get_key(cls, model_class, object_id):
         return '{}:{}'.format(model_class.__name__, object_id)
 
+    @classmethod
+    def use_local_cache(cls, model_class):
+        return LocalCache.is_enabled() and \
+            model_class.__name__ in settings.LOCAL_CACHE_MODELS
+
     @classmethod
     def get_object_through_cache(cls, model_class, object_id):
+        """
+        object 不存在的时候返回 None，并且在 cache 里记录 NEGATIVE_CACHE_TIMEOUT 秒
+        避免对不存在的 id 的请求每次都查询数据库
+        """
+        if object_id is None:
+            return None
         key = cls.get_key(model_class, object_id)
-        # cache hit
-        obj = cache.get(key)
-        if obj:
+        if not cls.use_local_cache(model_class):
+            return cls._get_object_through_memcached(model_class, object_id, key)
+
+        # 先读进程内的 L1 cache
+        obj = LocalCache.get(key)
+        if obj is not None:
             return obj
+        obj = cls._get_object_through_memcached(model_class, object_id, key)
+        LocalCache.set(key, obj)
+        return obj
+
+    @classmethod
+    def _get_object_through_memcached(cls, model_class, object_id, key):
+        # cache hit
+        obj = cache.get(key, _ABSENT)
+        if obj is not _ABSENT:
+            return cls._from_cached_value(obj)
 
         # cache miss
-        obj = model_class.objects.get(id=object_id)
-        # using default expire time
-        cache.set(key, obj)
-        return obj
+        # 只有拿到 lease 的请求去数据库 load，避免热门 object 过期时所有请求同时查询数据库
+        lease_key = CACHE_LEASE_PATTERN.format(key=key)
+        token = uuid.uuid4().hex
+        if cache.add(lease_key, token, settings.CACHE_REBUILD_LOCK_TIMEOUT):
+            obj = model_class.objects.filter(id=object_id).first()
+            # 如果在 load 的过程中 object 被修改了，invalidate 会删掉 lease
+            # 这时就不再把可能过期的 object 写进 cache
+            if cache.get(lease_key) == token:
+                cls._set_cached_value(key, obj)
+                cache.delete(lease_key)
+            return obj
 
+        # 其他请求正在 load，等一小段时间再从 cache 里读
+        Metrics.incr('memcached.rebuild_coalesced')
+        for _ in range(settings.CACHE_REBUILD_POLL_TIMES):
+            time.sleep(settings.CACHE_REBUILD_POLL_INTERVAL)
+            obj = cache.get(key, _ABSENT)
+            if obj is not _ABSENT:
+                return cls._from_cached_value(obj)
+
+        # 等待超时，直接读数据库，但是不写 cache
+        Metrics.incr('memcached.rebuild_wait_timeout')
+        return model_class.objects.filter(id=object_id).first()
+
+    @classmethod
+    def _from_cached_value(cls, value):
+        if value == DOES_NOT_EXIST:
+            Metrics.incr('memcached.negative_hit')
+            return None
+        return value
+
+    @classmethod
+    def _set_cached_value(cls, key, obj):
+        if obj is None:
+            cache.set(key, DOES_NOT_EXIST, settings.NEGATIVE_CACHE_TIMEOUT)
+        else:
+            # using default expire time
+            cache.set(key, obj)
+
+    @classmethod
+    def get_objects_through_cache(cls, model_class, object_ids):
+        """
+        批量版本的 get_object_through_cache，返回 {object_id: object}
+        一次 get_many 读出所有 objects，cache miss 的部分用一次 id__in 查询补齐再 set_many
+        不存在的 object 不会出现在返回结果里
+        """
+        object_ids = list({
+            object_id for object_id in object_ids if object_id is not None
+        })
+        if not object_ids:
+            return {}
+
+        keys = {object_id: cls.get_key(model_class, object_id) for object_id in object_ids}
+        objects = {}
+        use_local_cache = cls.use_local_cache(model_class)
+        if use_local_cache:
+            for object_id, key in keys.items():
+                obj = LocalCache.get(key)
+                if obj is not None:
+                    objects[object_id] = obj
+            keys = {
+                object_id: key
+                for object_id, key in keys.items()
+                if object_id not in objects
+            }
+            if not keys:
+                return objects
+
+        cached = cache.get_many(list(keys.values()))
+        missing_ids = []
+        for object_id, key in keys.items():
+            obj = cached.get(key, _ABSENT)
+            if obj is _ABSENT:
+                missing_ids.append(object_id)
+                continue
+            obj = cls._from_cached_value(obj)
+            if obj is not None:
+                objects[object_id] = obj
+
+        if missing_ids:
+            loaded = list(model_class.objects.filter(id__in=missing_ids))
+            if loaded:
+                # using default expire time
+                cache.set_many({keys[obj.id]: obj for obj in loaded})
+            for obj in loaded:
+                objects[obj.id] = obj
+            # 数据库里不存在的 objects 做 negative caching
+            not_found = {
+                keys[object_id]: DOES_NOT_EXIST
+                for object_id in missing_ids
+                if object_id not in objects
+            }
+            if not_found:
+                cache.set_many(not_found, settings.NEGATIVE_CACHE_TIMEOUT)
+
+        if use_local_cache:
+            for object_id in keys:
+                if object_id in objects:
+                    LocalCache.set(keys[object_id], objects[object_id])
+        return objects
 
     @classmethod
     def invalidate_cached_object(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
-        cache.delete(key)
-
+        cache.delete_many([key, CACHE_LEASE_PATTERN.format(key=key)])
+        if cls.use_local_cache(model_class):
+            LocalCache.invalidate(key)
@@ -0,0 +1,124 @@
+from collections import Counter, deque
+from django.conf import settings
+from django.utils.module_loading import import_string
+from twitter.cache import METRICS_OBSERVATIONS_PATTERN
+from utils.redis_client import RedisClient
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class InMemoryMetricsSink:
+    """
+    默认的 sink，每个名字在进程内保存最近 METRICS_SINK_MAX_OBSERVATIONS 个值，并且打一条 log
+    只能看到当前进程记录的值，需要汇总多个 worker 的数据时使用 RedisMetricsSink
+    """
+
+    def __init__(self):
+        self.observations = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, value):
+        logger.info('metrics %s=%s', name, value)
+        with self.lock:
+            if name not in self.observations:
+                self.observations[name] = deque(maxlen=settings.METRICS_SINK_MAX_OBSERVATIONS)
+            self.observations[name].append(value)
+
+    def get_observations(self, name):
+        with self.lock:
+            return list(self.observations.get(name, []))
+
+    def clear(self):
+        with self.lock:
+            self.observations.clear()
+
+
+class RedisMetricsSink:
+    """
+    每个名字在 redis 里保存最近 METRICS_SINK_MAX_OBSERVATIONS 个值，所有进程共享
+    """
+
+    def observe(self, name, value):
+        key = METRICS_OBSERVATIONS_PATTERN.format(name=name)
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        pipeline.lpush(key, value)
+        pipeline.ltrim(key, 0, settings.METRICS_SINK_MAX_OBSERVATIONS - 1)
+        pipeline.execute()
+
+    def get_observations(self, name):
+        key = METRICS_OBSERVATIONS_PATTERN.format(name=name)
+        conn = RedisClient.get_connection()
+        return [float(value) for value in conn.lrange(key, 0, -1)]
+
+    def clear(self):
+        conn = RedisClient.get_connection()
+        keys = list(conn.scan_iter(METRICS_OBSERVATIONS_PATTERN.format(name='*')))
+        if keys:
+            conn.delete(*keys)
+
+
+class Metrics:
+    """
+    进程内的计数器，用来统计 cache 的一些行为，比如 cache 重建时有多少请求被合并了
+    每个 web / worker 进程各自计数
+
+    observe 记录耗时这类需要看分布的值，写到 settings.METRICS_SINK 指定的 sink 里
+    """
+    counters = Counter()
+    lock = threading.Lock()
+    # METRICS_SINK -> sink instance
+    sinks = {}
+
+    @classmethod
+    def incr(cls, name, amount=1):
+        with cls.lock:
+            cls.counters[name] += amount
+
+    @classmethod
+    def get_counters(cls):
+        with cls.lock:
+            return dict(cls.counters)
+
+    @classmethod
+    def get_sink(cls):
+        path = settings.METRICS_SINK
+        sink = cls.sinks.get(path)
+        if sink is not None:
+            return sink
+        with cls.lock:
+            if path not in cls.sinks:
+                cls.sinks[path] = import_string(path)()
+            return cls.sinks[path]
+
+    @classmethod
+    def observe(cls, name, value):
+        try:
+            cls.get_sink().observe(name, value)
+        except Exception:
+            # 统计数据写失败不能影响正常的业务
+            logger.exception('failed to record metrics %s', name)
+
+    @classmethod
+    def get_percentiles(cls, name, percentiles=(50, 90, 99)):
+        """
+        返回 (最近记录的值的个数, {percentile: value})，没有记录过的时候返回 (0, {})
+        """
+        values = sorted(cls.get_sink().get_observations(name))
+        if not values:
+            return 0, {}
+        result = {}
+        for percentile in percentiles:
+            # nearest-rank
+            index = max(0, -(-len(values) * percentile // 100) - 1)
+            result[percentile] = values[index]
+        return len(values), result
+
+    @classmethod
+    def clear(cls):
+        with cls.lock:
+            cls.counters.clear()
+        cls.get_sink().clear()
@@ -0,0 +1,27 @@
+from accounts.services import UserService
+from django.conf import settings
+
+
+class UserActivityMiddleware:
+    """
+    记录登录用户最近一次访问的时间，fanout 的时候用来跳过不活跃的 followers
+    在 response 之后读取 request.user，DRF 认证出来的 user 也会被设置到 request.user 上
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        user = getattr(request, 'user', None)
+        if user is None or not user.is_authenticated:
+            return response
+
+        previous = UserService.touch_last_seen(user.id)
+        if previous is not False and \
+                settings.FANOUT_DORMANT_MODE == 'skip' and \
+                UserService.is_dormant_timestamp(previous):
+            # 不活跃期间的 tweets 没有 fanout 给这个 user，异步地从关注的人的 tweets 里拉取
+            from newsfeeds.tasks import backfill_dormant_user_newsfeeds_task
+            backfill_dormant_user_newsfeeds_task.delay(user.id, previous)
+        return response
@@ -0,0 +1,21 @@
+from django.db import models
+
+
+class CounterFlush(models.Model):
+    """
+    write-behind 模式下一批计数写回数据库的记录，和这一批的 UPDATE 在同一个 transaction 里提交
+    写回之后再从 redis 的 flushing hash 里删掉这一批，然后删除这条记录
+    如果进程在 UPDATE 提交之后、删除 redis 里的 deltas 之前挂掉了，重试的时候看到这条记录
+    就知道这一批已经写回过了，只需要删除 redis 里的 deltas，不会重复写回
+    """
+    # '{flushing key}:{generation}'，每次把 deltas rename 成 flushing 的时候 generation 加一
+    flush_key = models.CharField(max_length=255, db_index=True)
+    # 这一批写回的 object ids，用逗号分隔
+    object_ids = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def get_object_ids(self):
+        return [int(object_id) for object_id in self.object_ids.split(',') if object_id]
+
+    def __str__(self):
+        return '{} flushed {}'.format(self.flush_key, self.object_ids)
@@ -1,7 +1,36 @@
+from rest_framework.exceptions import ValidationError
 from rest_framework.pagination import BasePagination
 from rest_framework.response import Response
 from dateutil import parser
 from django.conf import settings
+from django.db.models import Q
+from utils.time_helpers import datetime_to_microseconds, microseconds_to_datetime
+
+import base64
+import binascii
+
+
+def encode_cursor(created_at, object_id):
+    """
+    把 (created_at, id) 编码成一个不透明的字符串，客户端只需要原样传回来
+    id 是 None（比如旧的 created_at__lt 参数）的时候只按照 created_at 翻页
+    """
+    value = '{}:{}'.format(
+        datetime_to_microseconds(created_at),
+        '' if object_id is None else object_id,
+    )
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        value = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        created_at, object_id = value.split(':')
+        created_at = microseconds_to_datetime(int(created_at))
+        object_id = int(object_id) if object_id else None
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValidationError({'cursor': 'Invalid cursor.'})
+    return created_at, object_id
 
 
 class EndlessPagination(BasePagination):
@@ -15,38 +44,41 @@ class EndlessPagination(BasePagination):
     def to_html(self):
         pass
 
-    def paginate_ordered_list(self, reverse_ordered_list, request):
-        if 'created_at__gt' in request.query_params:
-            created_at__gt = parser.isoparse(request.query_params['created_at__gt'])
-            objects = []
-            for obj in reverse_ordered_list:
-                if obj.created_at > created_at__gt:
-                    objects.append(obj)
-                else:
-                    break
-            self.has_next_page = False
-            return objects
+    @classmethod
+    def is_first_page(cls, request):
+        return not any(
+            param in request.query_params
+            for param in ('cursor', 'created_at__lt', 'created_at__gt')
+        )
 
-        index = 0
+    @classmethod
+    def get_cursor(cls, request):
+        """
+        返回往下翻页的位置 (created_at, id)，没有的时候返回 (None, None)
+        cursor 参数是 get_paginated_response 返回的 next_cursor，按照 (created_at, id) 翻页
+        created_at 相同的 objects 不会被跳过或者重复返回
+        旧的 created_at__lt 参数只按照 created_at 翻页，id 是 None
+        """
+        if 'cursor' in request.query_params:
+            return decode_cursor(request.query_params['cursor'])
         if 'created_at__lt' in request.query_params:
-            created_at__lt = parser.isoparse(request.query_params['created_at__lt'])
-            for index, obj in enumerate(reverse_ordered_list):
-                if obj.created_at < created_at__lt:
-                    break
-            else:
-                # 如果上面的for 没有执行到break，则运行else
-                # 没找到任何满足条件的 objects, 返回空数组
-                # 注意这个 else 对应的是 for，参见 python 的 for else 语法
-                reverse_ordered_list = []
-        self.has_next_page = len(reverse_ordered_list) > index + self.page_size
-        return reverse_ordered_list[index: index + self.page_size]
+            return parser.isoparse(request.query_params['created_at__lt']), None
+        return None, None
+
+    @classmethod
+    def _sort_key(cls, obj):
+        return datetime_to_microseconds(obj.created_at), obj.id or 0
+
+    @classmethod
+    def _is_before(cls, obj, created_at, object_id):
+        # obj 是否排在 (created_at, object_id) 的后面，也就是下一页的数据
+        if object_id is None:
+            return obj.created_at < created_at
+        return cls._sort_key(obj) < (datetime_to_microseconds(created_at), object_id)
 
     # 'paginate_queryset() must be implemented.'
     def paginate_queryset(self, queryset, request, view=None):
 
-        # if type(queryset) == list:
-        #     return self.paginate_ordered_list(queryset, request)
-
         if 'created_at__gt' in request.query_params:
             # created_at__gt 用于下拉刷新的时候加载最新的内容进来
             # 为了简便起见，下拉刷新不做翻页机制，直接加载所有更新的数据
@@ -54,39 +86,89 @@ class EndlessPagination(BasePagination):
             created_at__gt = request.query_params['created_at__gt']
             queryset = queryset.filter(created_at__gt=created_at__gt)
             self.has_next_page = False
-            return queryset.order_by('-created_at')
+            return queryset.order_by('-created_at', '-id')
 
-        if 'created_at__lt' in request.query_params:
+        created_at, object_id = self.get_cursor(request)
+        if object_id is not None:
+            # (created_at, id) < (cursor 的 created_at, cursor 的 id)
+            # 可以用到 (user, created_at) 的联合索引，created_at 相同的 objects 再比较 id
+            queryset = queryset.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=object_id),
+            )
+        elif created_at is not None:
             # created_at__lt 用于向上滚屏（往下翻页）的时候加载下一页的数据
             # 寻找 created_at < created_at__lt 的 objects 里按照 created_at 倒序的前
             # page_size + 1 个 objects
             # 比如目前的 created_at 列表是 [10, 9, 8, 7 .. 1] 如果 created_at__lt=10
             # page_size = 2 则应该返回 [9, 8, 7]，多返回一个 object 的原因是为了判断是否
             # 还有下一页从而减少一次空加载。
-            created_at__lt = request.query_params['created_at__lt']
-            queryset = queryset.filter(created_at__lt=created_at__lt)
+            queryset = queryset.filter(created_at__lt=created_at)
 
-        queryset = queryset.order_by('-created_at')[:self.page_size + 1]
+        queryset = queryset.order_by('-created_at', '-id')[:self.page_size + 1]
         self.has_next_page = len(queryset) > self.page_size
         return queryset[:self.page_size]
 
-    def paginate_cached_list(self, cached_list, request):
-        paginated_list = self.paginate_ordered_list(cached_list, request)
-        # 如果是上翻页，paginated_list 里是所有的最新的数据，直接返回
+    def paginate_cached_range(self, load_range, request):
+        """
+        load_range(created_at__lt=None, created_at__gt=None, count=None) 从 sorted set 里
+        按照 created_at 的范围读取，返回 (objects, cache 里 objects 的总数)
+        created_at__lt / created_at__gt 直接对应 score 的范围查询，不需要读出整个 cache
+        """
         if 'created_at__gt' in request.query_params:
-            return paginated_list
-        # 如果还有下一页，说明 cached_list 里的数据还没有取完，也直接返回
+            # 下拉刷新不做翻页，直接返回所有更新的数据
+            created_at__gt = parser.isoparse(request.query_params['created_at__gt'])
+            objects, _ = load_range(created_at__gt=created_at__gt)
+            self.has_next_page = False
+            return objects
+
+        created_at, object_id = self.get_cursor(request)
+        objects, cached_length = self._load_range_page(load_range, created_at, object_id)
+        self.has_next_page = len(objects) > self.page_size
         if self.has_next_page:
-            return paginated_list
-        # 如果 cached_list 的长度不足最大限制，说明 cached_list 里已经是所有数据了
-        if len(cached_list) < settings.REDIS_LIST_LENGTH_LIMIT:
-            return paginated_list
-        # 如果进入这里，说明可能存在在数据库里没有 load 在 cache 里的数据，需要直接去数据库查询
+            return objects[:self.page_size]
+        # 如果 cache 的长度不足最大限制，说明 cache 里已经是所有数据了
+        if cached_length < settings.REDIS_LIST_LENGTH_LIMIT:
+            return objects
+        # cache 里的数据可能不全，需要去数据库查询
         return None
 
+    def _load_range_page(self, load_range, created_at, object_id):
+        """
+        读取 cursor 之后的 page_size + 1 个 objects（多读一个用来判断是否还有下一页）
+
+        sorted set 的 score 只有 created_at，created_at 相同的 objects 的顺序和 id 无关
+        所以再多读一个 object，确认和第 page_size + 1 个 object 的 created_at 相同的 objects
+        都已经读出来了，然后按照 (created_at, id) 排序，保证每一页的边界和 cursor 一致
+        有 id 的 cursor 需要读取 score <= cursor 的 created_at 的 objects，再按照 id 过滤
+        """
+        created_at__lt = created_at
+        if object_id is not None:
+            created_at__lt = microseconds_to_datetime(datetime_to_microseconds(created_at) + 1)
+        count = self.page_size + 2
+        while True:
+            loaded, cached_length = load_range(created_at__lt=created_at__lt, count=count)
+            objects = [
+                obj for obj in loaded
+                if created_at is None or self._is_before(obj, created_at, object_id)
+            ]
+            objects.sort(key=self._sort_key, reverse=True)
+            if len(loaded) < count:
+                break
+            if len(objects) > self.page_size and \
+                    loaded[-1].created_at < objects[self.page_size].created_at:
+                break
+            count *= 2
+        return objects[:self.page_size + 1], cached_length
+
     # 'get_paginated_response() must be implemented.'
     def get_paginated_response(self, data):
+        next_cursor = None
+        if self.has_next_page and data:
+            # 用这一页最后一个 object 的 (created_at, id) 作为下一页的 cursor
+            last = data[-1]
+            next_cursor = encode_cursor(parser.isoparse(last['created_at']), last['id'])
         return Response({
             'has_next_page': self.has_next_page,
+            'next_cursor': next_cursor,
             'results': data,
         })
@@ -1,20 +1,115 @@
 from django.conf import settings
+
+import os
 import redis
+import threading
 
 
 class RedisClient:
-    conn = None
-
-    @classmethod
-    def get_connection(cls):
-        if cls.conn:
-            return cls.conn
-        cls.conn = redis.Redis(
-            host=settings.REDIS_HOST,
-            port=settings.REDIS_PORT,
-            db=settings.REDIS_DB,
-        )
-        return cls.conn
+    # db -> BlockingConnectionPool，不同的 db（比如 cache 和 celery broker）使用各自的 pool
+    # 连接都在使用中的时候排队等待 REDIS_POOL_TIMEOUT 秒，而不是直接 raise ConnectionError
+    pools = {}
+    # db -> redis.Redis
+    conns = {}
+    # 创建 pools 的进程的 pid
+    pid = None
+    lock = threading.Lock()
+
+    @classmethod
+    def _check_pid(cls):
+        # celery prefork / gunicorn 的 worker 是 fork 出来的子进程
+        # 子进程不能继续使用父进程里建立的 socket，需要重新创建 pool
+        if cls.pid == os.getpid():
+            return
+        with cls.lock:
+            if cls.pid == os.getpid():
+                return
+            cls.pools = {}
+            cls.conns = {}
+            cls.pid = os.getpid()
+
+    @classmethod
+    def get_pool(cls, db=None):
+        if db is None:
+            db = settings.REDIS_DB
+        cls._check_pid()
+        pool = cls.pools.get(db)
+        if pool is not None:
+            return pool
+
+        with cls.lock:
+            if db not in cls.pools:
+                cls.pools[db] = redis.BlockingConnectionPool(
+                    max_connections=settings.REDIS_MAX_CONNECTIONS,
+                    timeout=settings.REDIS_POOL_TIMEOUT,
+                    **cls._get_connection_kwargs(db)
+                )
+            return cls.pools[db]
+
+    @classmethod
+    def _get_connection_kwargs(cls, db):
+        return {
+            'host': settings.REDIS_HOST,
+            'port': settings.REDIS_PORT,
+            'db': db,
+            'socket_timeout': settings.REDIS_SOCKET_TIMEOUT,
+            'socket_connect_timeout': settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+            'socket_keepalive': settings.REDIS_SOCKET_KEEPALIVE,
+            'health_check_interval': settings.REDIS_HEALTH_CHECK_INTERVAL,
+        }
+
+    @classmethod
+    def get_subscriber_connection(cls, db=None):
+        """
+        pub/sub 的 subscriber 会一直占用一个连接，使用单独的 pool，不占用处理请求的 pool 里的连接
+        每次调用都返回一个新的 client，调用方用完之后需要关闭 pubsub
+        """
+        if db is None:
+            db = settings.REDIS_DB
+        return redis.Redis(connection_pool=redis.ConnectionPool(
+            max_connections=1,
+            **cls._get_connection_kwargs(db)
+        ))
+
+    @classmethod
+    def get_connection(cls, db=None):
+        if db is None:
+            db = settings.REDIS_DB
+        cls._check_pid()
+        conn = cls.conns.get(db)
+        if conn is not None:
+            return conn
+        # redis.Redis 本身只是对 pool 的一层包装，每次执行命令时才会从 pool 里借一个连接
+        # 所以多个线程可以安全地共用同一个 redis.Redis
+        conn = redis.Redis(connection_pool=cls.get_pool(db))
+        cls.conns[db] = conn
+        return conn
+
+    @classmethod
+    def get_broker_connection(cls):
+        # celery broker 所在的 db，用来查看 message queue 的状态
+        return cls.get_connection(settings.REDIS_BROKER_DB)
+
+    @classmethod
+    def get_pool_stats(cls):
+        cls._check_pid()
+        stats = {}
+        with cls.lock:
+            for db, pool in cls.pools.items():
+                # BlockingConnectionPool 的 queue 里放着空闲的连接，还没有创建的位置是 None
+                created_connections = len(pool._connections)
+                available_connections = len([
+                    connection
+                    for connection in list(pool.pool.queue)
+                    if connection is not None
+                ])
+                stats[db] = {
+                    'max_connections': pool.max_connections,
+                    'created_connections': created_connections,
+                    'in_use_connections': created_connections - available_connections,
+                    'available_connections': available_connections,
+                }
+        return stats
 
     @classmethod
     def clear(cls):
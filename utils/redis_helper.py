@@ -1,94 +1,504 @@
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, When
+from redis.exceptions import LockError, WatchError
+from twitter.cache import (
+    CACHE_REBUILD_DIRTY_PATTERN,
+    CACHE_REBUILD_LOCK_PATTERN,
+    COUNT_DELTAS_FLUSHING_PATTERN,
+    COUNT_DELTAS_PATTERN,
+    COUNT_FLUSH_EPOCH_PATTERN,
+    COUNT_FLUSH_GENERATION_PATTERN,
+    COUNT_FLUSH_LOCK_PATTERN,
+)
+from utils.metrics import Metrics
 from utils.redis_client import RedisClient
-from utils.redis_serializers import DjangoModelSerializer
+
+import time
+
+
+# KEYS[1]: 计数器的 key
+# ARGV[1]: 变化量 delta
+# key 存在的时候加上 delta，不存在的时候什么都不做并且返回 nil，下次读取的时候再从数据库初始化
+# 写的时候不负责初始化，所以写的路径上不需要读数据库，并发的写也不会重复计算同一次变化
+CHANGE_EXISTING_COUNT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+return nil
+"""
+
+
+# KEYS[1]: 计数器的 key，KEYS[2]: 等待写回数据库的 deltas hash
+# ARGV[1]: object id，ARGV[2]: 变化量 delta
+# 先把 delta 记录到 deltas hash 里，再和 CHANGE_EXISTING_COUNT_SCRIPT 一样只修改已经存在的计数器
+# key 不存在的时候，读取的时候用数据库的值加上所有没有写回的 deltas 初始化
+WRITE_BEHIND_CHANGE_COUNT_SCRIPT = """
+redis.call('HINCRBY', KEYS[2], ARGV[1], ARGV[2])
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[2])
+end
+return nil
+"""
+
+
+# KEYS[3 * i - 2]: sorted set 的 key，KEYS[3 * i - 1]: 它的重建锁，KEYS[3 * i]: 它的 dirty 标记
+# ARGV[1]: sorted set 最多保留多少个 members，ARGV[2]: dirty 标记的过期时间
+# ARGV[3]: 1 表示保留 score 最小的 members，0 表示保留 score 最大的 members
+# ARGV[2 * i + 2], ARGV[2 * i + 3]: 要加到第 i 个 sorted set 里的 member 和 score
+# 只 push 到已经存在的 sorted set 里，不存在的 sorted set 等下次读取的时候再从数据库重建
+# exists 和 zadd 在脚本里原子执行，不会出现 key 刚好过期、zadd 出一个只有一个 member 的
+# 不完整 cache 的情况
+# sorted set 不存在但是有请求正在重建的时候，它读数据库的时候可能还看不到这个 member，标记为 dirty
+# 让重建的结果不要写进 cache
+PUSH_TO_SORTED_SETS_SCRIPT = """
+local pushed = 0
+for i = 1, #KEYS / 3 do
+    local key = KEYS[3 * i - 2]
+    if redis.call('EXISTS', key) == 1 then
+        redis.call('ZADD', key, ARGV[2 * i + 3], ARGV[2 * i + 2])
+        if ARGV[3] == '1' then
+            redis.call('ZREMRANGEBYRANK', key, tonumber(ARGV[1]), -1)
+        else
+            redis.call('ZREMRANGEBYRANK', key, 0, -tonumber(ARGV[1]) - 1)
+        end
+        pushed = pushed + 1
+    elseif redis.call('EXISTS', KEYS[3 * i - 1]) == 1 then
+        redis.call('SET', KEYS[3 * i], 1, 'EX', ARGV[2])
+    end
+end
+return pushed
+"""
+
+
+# KEYS: 版本号的 keys
+# 只增加已经存在的版本号，返回增加了多少个
+# 版本号不存在说明最近没有人读取过，也就没有渲染结果需要过期，不需要创建一个新的 key
+BUMP_EXISTING_VERSIONS_SCRIPT = """
+local bumped = 0
+for _, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        redis.call('INCR', key)
+        bumped = bumped + 1
+    end
+end
+return bumped
+"""
 
 
 class RedisHelper:
+    # script name -> redis Script
+    scripts = {}
 
     @classmethod
-    def _load_objects_to_cache(cls, key, objects):
-        conn = RedisClient.get_connection()
+    def _write_rebuilt_cache(cls, conn, key, write):
+        """
+        重建的过程中如果有 push 因为 key 不存在而没能写进 cache（被标记为 dirty）
+        这次从数据库读出来的数据可能缺少那个 object，不能再写进 cache，下次读取的时候再重建
+        watch dirty 标记，检查之后到 exec 之前被标记为 dirty 的话 exec 也会失败
+        """
+        dirty_key = CACHE_REBUILD_DIRTY_PATTERN.format(key=key)
+        with conn.pipeline(transaction=True) as pipe:
+            try:
+                pipe.watch(dirty_key)
+                if pipe.exists(dirty_key):
+                    pipe.unwatch()
+                    Metrics.incr('redis_cache.rebuild_discarded')
+                    return False
+                pipe.multi()
+                write(pipe)
+                pipe.execute()
+            except WatchError:
+                Metrics.incr('redis_cache.rebuild_discarded')
+                return False
+        return True
 
-        serialized_list = []
-        # for obj in objects:
+    @classmethod
+    def _start_rebuild(cls, conn, key):
+        """
+        拿到重建的锁之后，在读数据库之前清掉之前的 dirty 标记
+        之前 push 的 objects 已经在数据库里了，这次读数据库的时候一定可以读到
+        """
+        conn.delete(CACHE_REBUILD_DIRTY_PATTERN.format(key=key))
 
-        # 最多只 cache REDIS_LIST_LENGTH_LIMIT 那么多个 objects
-        # 超过这个限制的 objects，就去数据库里读取。一般这个限制会比较大，比如 1000
-        # 因此翻页翻到 1000 的用户访问量会比较少，从数据库读取也不是大问题
-        for obj in objects[:settings.REDIS_LIST_LENGTH_LIMIT]:
-            serialized_data = DjangoModelSerializer.serialize(obj)
-            serialized_list.append(serialized_data)
+    @classmethod
+    def _read_through(cls, read, rebuild, read_db):
+        """
+        read() 读 cache，cache miss 的时候返回 None
+        rebuild() 拿到锁之后重建 cache 并返回结果，没有拿到锁的时候返回 None
+        read_db() 等待其他请求重建 cache 超时之后，直接读数据库
+        """
+        result = read()
+        if result is not None:
+            return result
+
+        result = rebuild()
+        if result is not None:
+            return result
+
+        # 其他请求正在重建 cache，等一小段时间再从 cache 里读
+        Metrics.incr('redis_cache.rebuild_coalesced')
+        for _ in range(settings.CACHE_REBUILD_POLL_TIMES):
+            time.sleep(settings.CACHE_REBUILD_POLL_INTERVAL)
+            result = read()
+            if result is not None:
+                return result
 
+        # 等待超时，直接读数据库，但是不写 cache
+        Metrics.incr('redis_cache.rebuild_wait_timeout')
+        return read_db()
+
+    @classmethod
+    def _rebuild_sorted_set(cls, key, queryset, to_member):
+        """
+        single-flight 重建 cache：只有拿到锁的请求去数据库 load 并写 cache
+        cache 里只存 to_member(obj) 返回的 (member, score)
+        返回按 score 从大到小排列的 [(member, score)]，没有拿到锁的时候返回 None
+        """
+        conn = RedisClient.get_connection()
+        lock = conn.lock(
+            CACHE_REBUILD_LOCK_PATTERN.format(key=key),
+            timeout=settings.CACHE_REBUILD_LOCK_TIMEOUT,
+        )
+        if not lock.acquire(blocking=False):
+            return None
 
-        if serialized_list:
-            conn.rpush(key, *serialized_list)
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        try:
+            cls._start_rebuild(conn, key)
+            objects = list(queryset[:settings.REDIS_LIST_LENGTH_LIMIT])
+            items = [to_member(obj) for obj in objects]
+            if items:
+                def write(pipe):
+                    pipe.delete(key)
+                    pipe.zadd(key, dict(items))
+                    pipe.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+                cls._write_rebuilt_cache(conn, key, write)
+        finally:
+            try:
+                lock.release()
+            except LockError:
+                # 重建的时间超过了锁的 timeout，锁已经过期了
+                pass
+        Metrics.incr('redis_cache.rebuild')
+        return cls._sort_members(items)
 
+    @classmethod
+    def _sort_members(cls, items):
+        # 和 zrevrange 的顺序一致：score 从大到小，score 相同的时候按照 member 的字典序从大到小
+        return sorted(items, key=lambda item: (item[1], item[0]), reverse=True)
 
     @classmethod
-    def load_objects(cls, key, queryset):
+    def _read_sorted_set(cls, key, max_score, min_score, count, ascending=False):
         conn = RedisClient.get_connection()
+        # zrevrangebyscore 和 zcard 放在一个 pipeline 里，只需要一次 round trip
+        # key 不存在时 zcard 返回 0
+        pipe = conn.pipeline(transaction=False)
+        max_score = '+inf' if max_score is None else '({}'.format(max_score)
+        min_score = '-inf' if min_score is None else '({}'.format(min_score)
+        if ascending:
+            pipe.zrangebyscore(
+                key,
+                min_score,
+                max_score,
+                start=None if count is None else 0,
+                num=count,
+                withscores=True,
+                score_cast_func=int,
+            )
+        else:
+            pipe.zrevrangebyscore(
+                key,
+                max_score,
+                min_score,
+                start=None if count is None else 0,
+                num=count,
+                withscores=True,
+                score_cast_func=int,
+            )
+        pipe.zcard(key)
+        items, cached_length = pipe.execute()
+        if not cached_length:
+            return None
+        return [(member.decode('utf-8'), score) for member, score in items], cached_length
 
+    @classmethod
+    def load_sorted_set_range(
+        cls,
+        key,
+        queryset,
+        to_member,
+        max_score=None,
+        min_score=None,
+        count=None,
+        ascending=False,
+    ):
+        """
+        读取 sorted set 里 min_score < score < max_score 的前 count 个 (member, score)
+        按 score 从大到小排列（ascending=True 的时候从小到大），max_score / min_score 是 None
+        的时候表示不限制
+        返回 ([(member, score)], cached_length)
+        queryset 需要按照 score 从大到小排列，cache 里保存的是 score 最大的那些 members
+        ascending=True 的时候 queryset 按照 score 从小到大排列，cache 里保存的是 score 最小的
+        那些 members，push 的时候也要传 ascending=True
 
-        # 如果在 cache 里存在，则直接拿出来，然后返回
-        if conn.exists(key):
-            serialized_list = conn.lrange(key, 0, -1) # a list of strings，每一个string都是serialize之后的结果。
-            objects = []
-            for serialized_data in serialized_list: # deserialize
-                deserialized_obj = DjangoModelSerializer.deserialize(serialized_data)
-                objects.append(deserialized_obj)
-            return objects
+        sorted set 按 score 的范围查询是 O(log n + count)，不需要把整个 cache 读出来再查找位置
+        """
+        def in_range(score):
+            if max_score is not None and score >= max_score:
+                return False
+            if min_score is not None and score <= min_score:
+                return False
+            return True
 
-        # cache miss -> 刚启用这个服务的时候，cache 中什么都没有。所以要放到 cache 中。
-        cls._load_objects_to_cache(key, queryset)
+        def select(items):
+            items = [item for item in items if in_range(item[1])]
+            if ascending:
+                items.reverse()
+            return items if count is None else items[:count]
 
+        def rebuild():
+            items = cls._rebuild_sorted_set(key, queryset, to_member)
+            if items is None:
+                return None
+            return select(items), len(items)
 
-        # 转换为 list 的原因是保持返回类型的统一，因为存在 redis 里的数据是 list 的形式
-        return list(queryset)
+        def read_db():
+            objects = list(queryset[:settings.REDIS_LIST_LENGTH_LIMIT])
+            items = cls._sort_members([to_member(obj) for obj in objects])
+            return select(items), len(items)
 
+        return cls._read_through(
+            lambda: cls._read_sorted_set(key, max_score, min_score, count, ascending),
+            rebuild,
+            read_db,
+        )
 
     @classmethod
-    def push_object(cls, key, obj, queryset):
-        conn = RedisClient.get_connection()
-        if not conn.exists(key):
-            # 如果 key 不存在，直接从数据库里 load
-            # 就不走单个 push 的方式加到 cache 里了
-            cls._load_objects_to_cache(key, queryset)
+    def push_to_sorted_set(cls, key, obj, queryset, to_member, ascending=False):
+        member, score = to_member(obj)
+        if cls.push_to_sorted_sets([(key, member, score)], ascending=ascending):
             return
-        serialized_data = DjangoModelSerializer.serialize(obj)
-        conn.lpush(key, serialized_data)
-        conn.ltrim(key, 0, settings.REDIS_LIST_LENGTH_LIMIT - 1)
+        # 如果 key 不存在，直接从数据库里 load，就不走单个 push 的方式加到 cache 里了
+        # 如果其他请求正在重建 cache，脚本已经把 cache 标记为 dirty，这里就不再重复重建
+        cls._rebuild_sorted_set(key, queryset, to_member)
 
     @classmethod
-    def get_count_key(cls, obj, attr):
-        return '{}.{}:{}'.format(obj.__class__.__name__, attr, obj.id)
+    def push_to_sorted_sets(cls, items, ascending=False):
+        """
+        items 是 [(key, member, score)]，一次 round trip 把每个 member 加到对应的 sorted set 里
+        只保留 score 最大的 REDIS_LIST_LENGTH_LIMIT 个 members
+        ascending=True 的时候保留 score 最小的，cache 满了之后更新的 members 不会再加进去
+        不存在的 sorted set 直接跳过，返回实际 push 了多少个
+        正在重建的 sorted set 会被标记为 dirty，重建的结果不会写进 cache
+        """
+        if not items:
+            return 0
+        keys = []
+        args = [
+            settings.REDIS_LIST_LENGTH_LIMIT,
+            settings.CACHE_REBUILD_LOCK_TIMEOUT,
+            1 if ascending else 0,
+        ]
+        for key, member, score in items:
+            keys.extend([
+                key,
+                CACHE_REBUILD_LOCK_PATTERN.format(key=key),
+                CACHE_REBUILD_DIRTY_PATTERN.format(key=key),
+            ])
+            args.extend([member, score])
+        script = cls._get_script('push_to_sorted_sets', PUSH_TO_SORTED_SETS_SCRIPT)
+        return script(keys=keys, args=args, client=RedisClient.get_connection())
 
+    @classmethod
+    def get_versions(cls, keys):
+        """
+        读取一组版本号，不存在的版本号初始化为 0，并且设置 NEWSFEED_VERSION_TIMEOUT 的过期时间
+        读取之后这些版本号就存在了，之后的 bump_versions 一定会改变它们
+        """
+        if not keys:
+            return []
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline(transaction=False)
+        for key in keys:
+            pipe.set(key, 0, ex=settings.NEWSFEED_VERSION_TIMEOUT, nx=True)
+        pipe.mget(keys)
+        values = pipe.execute()[-1]
+        return [int(value or 0) for value in values]
 
     @classmethod
-    def incr_count(cls, obj, attr):
+    def touch_versions(cls, keys):
+        """
+        保存用到这些版本号的渲染结果之前调用，延长版本号的过期时间，保证版本号比渲染结果保存得久
+        有版本号已经过期的时候返回 False，这时候不能保存渲染结果
+        """
+        if not keys:
+            return True
         conn = RedisClient.get_connection()
+        pipe = conn.pipeline(transaction=False)
+        for key in keys:
+            pipe.expire(key, settings.NEWSFEED_VERSION_TIMEOUT)
+        return all(pipe.execute())
+
+    @classmethod
+    def bump_versions(cls, keys):
+        """
+        增加已经存在的版本号，INCR 不会改变过期时间，返回增加了多少个
+        """
+        keys = sorted(set(keys))
+        if not keys:
+            return 0
+        script = cls._get_script('bump_existing_versions', BUMP_EXISTING_VERSIONS_SCRIPT)
+        return script(keys=keys, client=RedisClient.get_connection())
+
+    @classmethod
+    def get_count_key(cls, obj, attr):
+        return cls.get_count_key_by_id(obj.__class__, obj.id, attr)
+
+    @classmethod
+    def get_count_key_by_id(cls, model_class, object_id, attr):
+        return '{}.{}:{}'.format(model_class.__name__, attr, object_id)
+
+
+    @classmethod
+    def get_count_deltas_keys(cls, model_class, attr):
+        """
+        write-behind 模式下还没有写回数据库的计数变化，按照 object id 记录在 hash 里
+        返回 (等待写回的 deltas key, 正在写回的 deltas key)
+        """
+        name = '{}.{}'.format(model_class.__name__, attr)
+        return (
+            COUNT_DELTAS_PATTERN.format(name=name),
+            COUNT_DELTAS_FLUSHING_PATTERN.format(name=name),
+        )
+
+    @classmethod
+    def get_count_flush_keys(cls, model_class, attr):
+        """
+        返回 (flush 的锁, flush 的 generation, flush 的 epoch) 的 keys
+        """
+        name = '{}.{}'.format(model_class.__name__, attr)
+        deltas_key, _ = cls.get_count_deltas_keys(model_class, attr)
+        return (
+            COUNT_FLUSH_LOCK_PATTERN.format(key=deltas_key),
+            COUNT_FLUSH_GENERATION_PATTERN.format(name=name),
+            COUNT_FLUSH_EPOCH_PATTERN.format(name=name),
+        )
+
+    @classmethod
+    def get_count_flush_key(cls, model_class, attr, generation):
+        # 数据库里 CounterFlush 记录的 flush_key
+        _, flushing_key = cls.get_count_deltas_keys(model_class, attr)
+        return '{}:{}'.format(flushing_key, generation)
+
+    @classmethod
+    def _get_script(cls, name, script_text):
+        if name not in cls.scripts:
+            conn = RedisClient.get_connection()
+            cls.scripts[name] = conn.register_script(script_text)
+        return cls.scripts[name]
+
+    @classmethod
+    def _change_count(cls, obj, attr, delta):
         key = cls.get_count_key(obj, attr)
-        if not conn.exists(key):
-            # back fill cache from DB
-            # 不执行 +1 的操作，因为必须保证调用 incr_count 之前 obj.attr 已经 +1 过了
-            obj.refresh_from_db()
-            conn.set(key, getattr(obj, attr))
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
-            return getattr(obj, attr)
-        return conn.incr(key)
+        if not settings.COUNTER_WRITE_BEHIND:
+            return cls.change_existing_count(key, delta)
+
+        deltas_key, _ = cls.get_count_deltas_keys(obj.__class__, attr)
+        script = cls._get_script('write_behind', WRITE_BEHIND_CHANGE_COUNT_SCRIPT)
+        return script(
+            keys=[key, deltas_key],
+            args=[obj.id, delta],
+            client=RedisClient.get_connection(),
+        )
+
+    @classmethod
+    def change_existing_count(cls, key, delta):
+        script = cls._get_script('change_existing_count', CHANGE_EXISTING_COUNT_SCRIPT)
+        return script(keys=[key], args=[delta], client=RedisClient.get_connection())
+
+    @classmethod
+    def get_count_through_cache(cls, key, queryset):
+        """
+        没有数据库字段的计数器，cache miss 的时候用 queryset.count() 重新计算
+        """
+        conn = RedisClient.get_connection()
+        count = conn.get(key)
+        if count is not None:
+            return int(count)
+        count = queryset.count()
+        # nx=True 避免覆盖掉其他请求已经写进去的值
+        conn.set(key, count, ex=settings.REDIS_KEY_EXPIRE_TIME, nx=True)
+        return count
 
+    @classmethod
+    def incr_count(cls, obj, attr):
+        """
+        只用到 obj 的 class 和 id，可以传入 Model(id=object_id) 而不需要从数据库读出 obj
+        计数器存在的时候返回 +1 之后的值，不存在的时候返回 None，由 get_count / get_counts
+        在读取的时候从数据库初始化
+        - 普通模式下，调用方需要先在数据库里 +1
+        - write-behind 模式下，调用方不更新数据库，+1 只记录在 redis 里，之后由
+          flush_count_deltas 批量写回数据库
+        """
+        return cls._change_count(obj, attr, 1)
 
     @classmethod
     def decr_count(cls, obj, attr):
+        """
+        用法同 incr_count
+        """
+        return cls._change_count(obj, attr, -1)
+
+    @classmethod
+    def _get_flush_guards(cls, model_class, attrs):
+        """
+        cache miss 读数据库之前，记录每个 attr 的 (flush epoch, 是否正在 flush)
+        不是 write-behind 模式的时候返回 None
+        """
+        if not settings.COUNTER_WRITE_BEHIND:
+            return None
         conn = RedisClient.get_connection()
-        key = cls.get_count_key(obj, attr)
-        if not conn.exists(key):
-            obj.refresh_from_db()
-            conn.set(key, getattr(obj, attr))
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
-            return getattr(obj, attr)
-        return conn.decr(key)
+        pipe = conn.pipeline(transaction=False)
+        for attr in attrs:
+            lock_key, _, epoch_key = cls.get_count_flush_keys(model_class, attr)
+            pipe.get(epoch_key)
+            pipe.exists(lock_key)
+        values = iter(pipe.execute())
+        return {attr: (next(values), next(values)) for attr in attrs}
 
+    @classmethod
+    def _get_pending_deltas(cls, model_class, attrs, object_ids, guards):
+        """
+        write-behind 模式下，数据库里的值还要加上 redis 里没有写回的 deltas 才是真正的值
+        返回 ({attr: {object_id: delta}}, {attr: 是否可以写 cache})
+
+        flush 先提交数据库的 UPDATE 再删除 redis 里的 deltas，读数据库和读 deltas 之间如果
+        有 flush，可能两边都有这个 delta（多算），也可能两边都没有（少算）
+        所以和 deltas 一起再读一次 epoch 和锁，和读数据库之前的 guards 比较：
+        flush 的过程中一直拿着锁，每写回一批 epoch 加一，两次都没有锁并且 epoch 没有变化
+        才说明中间没有 flush，算出来的值才可以写进 cache
+        """
+        pending = {attr: {} for attr in attrs}
+        if guards is None or not object_ids:
+            return pending, {attr: True for attr in attrs}
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline(transaction=False)
+        for attr in attrs:
+            for key in cls.get_count_deltas_keys(model_class, attr):
+                pipe.hmget(key, object_ids)
+            lock_key, _, epoch_key = cls.get_count_flush_keys(model_class, attr)
+            pipe.get(epoch_key)
+            pipe.exists(lock_key)
+        results = iter(pipe.execute())
+        cacheable = {}
+        for attr in attrs:
+            for values in (next(results), next(results)):
+                for object_id, value in zip(object_ids, values):
+                    pending[attr][object_id] = pending[attr].get(object_id, 0) + int(value or 0)
+            epoch, locked = next(results), next(results)
+            guard_epoch, guard_locked = guards[attr]
+            cacheable[attr] = not locked and not guard_locked and epoch == guard_epoch
+        return pending, cacheable
 
     @classmethod
     def get_count(cls, obj, attr):
@@ -98,8 +508,171 @@ class RedisHelper:
         if count is not None:
             return int(count)
 
-
+        guards = cls._get_flush_guards(obj.__class__, [attr])
         obj.refresh_from_db()
-        count = getattr(obj, attr)
-        conn.set(key, count)
+        count = getattr(obj, attr) or 0
+        pending, cacheable = cls._get_pending_deltas(obj.__class__, [attr], [obj.id], guards)
+        count += pending[attr].get(obj.id, 0)
+        if cacheable[attr]:
+            # nx=True 避免覆盖掉其他请求已经写进去并且 +1 过的值
+            conn.set(key, count, ex=settings.REDIS_KEY_EXPIRE_TIME, nx=True)
         return count
+
+    @classmethod
+    def get_counts(cls, objs, attrs):
+        """
+        批量读取一组同一个 model 的 objects 的多个计数器
+        返回 {obj.id: {attr: count}}
+        所有的 key 用一次 MGET 读出来，cache miss 的部分用一次 id__in 的查询从数据库
+        读出来，再用一个 pipeline 写回 cache
+        """
+        if not objs:
+            return {}
+
+        conn = RedisClient.get_connection()
+        keys = [
+            cls.get_count_key(obj, attr)
+            for obj in objs
+            for attr in attrs
+        ]
+        values = iter(conn.mget(keys))
+
+        counts = {}
+        objs_by_id = {}
+        missing_ids = set()
+        for obj in objs:
+            objs_by_id[obj.id] = obj
+            obj_counts = counts.setdefault(obj.id, {})
+            for attr in attrs:
+                value = next(values)
+                if value is None:
+                    missing_ids.add(obj.id)
+                else:
+                    obj_counts[attr] = int(value)
+
+        if not missing_ids:
+            return counts
+
+        # back fill cache from DB
+        model_class = objs[0].__class__
+        missing_ids = list(missing_ids)
+        guards = cls._get_flush_guards(model_class, attrs)
+        rows = list(model_class.objects.filter(id__in=missing_ids).values_list('id', *attrs))
+        pending, cacheable = cls._get_pending_deltas(model_class, attrs, missing_ids, guards)
+        pipe = conn.pipeline(transaction=False)
+        for row in rows:
+            obj_id, row_values = row[0], row[1:]
+            for attr, value in zip(attrs, row_values):
+                if attr in counts[obj_id]:
+                    continue
+                value = (value or 0) + pending[attr].get(obj_id, 0)
+                counts[obj_id][attr] = value
+                if not cacheable[attr]:
+                    continue
+                # nx=True 避免覆盖掉其他请求已经写进去并且 +1 过的值
+                pipe.set(
+                    cls.get_count_key(objs_by_id[obj_id], attr),
+                    value,
+                    ex=settings.REDIS_KEY_EXPIRE_TIME,
+                    nx=True,
+                )
+        pipe.execute()
+        return counts
+
+    @classmethod
+    def flush_count_deltas(cls, model_class, attr):
+        """
+        把 write-behind 模式下累积在 redis 里的 deltas 批量写回数据库
+        每一批用一条 UPDATE ... SET attr = CASE id WHEN ... END 语句完成
+        返回写回了多少个 objects
+        """
+        from utils.models import CounterFlush
+
+        conn = RedisClient.get_connection()
+        deltas_key, flushing_key = cls.get_count_deltas_keys(model_class, attr)
+        lock_key, generation_key, epoch_key = cls.get_count_flush_keys(model_class, attr)
+        lock = conn.lock(lock_key, timeout=settings.COUNTER_FLUSH_LOCK_TIMEOUT)
+        if not lock.acquire(blocking=False):
+            # 另外一个 worker 正在 flush
+            return 0
+
+        try:
+            # 如果上一次 flush 中途失败了，flushing_key 里还有没写回的 deltas，先写回它们
+            # 否则把 deltas_key 整个 rename 过来，之后新的 deltas 会记录到新的 deltas_key 里
+            if not conn.exists(flushing_key):
+                if not conn.exists(deltas_key):
+                    return 0
+                pipe = conn.pipeline(transaction=True)
+                pipe.rename(deltas_key, flushing_key)
+                pipe.incr(generation_key)
+                pipe.execute()
+            flush_key = cls.get_count_flush_key(model_class, attr, int(conn.get(generation_key) or 0))
+
+            # 上一次 flush 在 UPDATE 提交之后、删除 deltas 之前中断了，这些 objects 已经写回过了
+            for flush in CounterFlush.objects.filter(flush_key=flush_key):
+                cls._finish_count_flush(conn, flushing_key, epoch_key, flush)
+
+            deltas = [
+                (int(object_id), int(delta))
+                for object_id, delta in conn.hgetall(flushing_key).items()
+            ]
+            batch_size = settings.COUNTER_FLUSH_BATCH_SIZE
+            for index in range(0, len(deltas), batch_size):
+                batch = deltas[index: index + batch_size]
+                changed = [(object_id, delta) for object_id, delta in batch if delta]
+                # UPDATE 和 CounterFlush 记录在同一个 transaction 里提交
+                # 中途失败重试的时候根据记录跳过已经写回的这一批，不会重复写回
+                with transaction.atomic():
+                    if changed:
+                        model_class.objects.filter(
+                            id__in=[object_id for object_id, _ in changed],
+                        ).update(**{attr: Case(
+                            *[
+                                When(id=object_id, then=F(attr) + delta)
+                                for object_id, delta in changed
+                            ],
+                            default=F(attr),
+                            output_field=IntegerField(),
+                        )})
+                    flush = CounterFlush.objects.create(
+                        flush_key=flush_key,
+                        object_ids=','.join(str(object_id) for object_id, _ in batch),
+                    )
+                cls._finish_count_flush(conn, flushing_key, epoch_key, flush)
+            conn.delete(flushing_key)
+        finally:
+            try:
+                lock.release()
+            except LockError:
+                pass
+        Metrics.incr('counters.flushed', len(deltas))
+        return len(deltas)
+
+    @classmethod
+    def _finish_count_flush(cls, conn, flushing_key, epoch_key, flush):
+        # 已经写回数据库的这一批从 flushing_key 里删掉，epoch 加一让正在 cache miss 的读取不写 cache
+        pipe = conn.pipeline(transaction=True)
+        pipe.hdel(flushing_key, *flush.get_object_ids())
+        pipe.incr(epoch_key)
+        pipe.execute()
+        # 删除 deltas 之后这条记录就没用了，删除之前挂掉的话留下的记录也不会再被用到
+        flush.delete()
+
+    @classmethod
+    def reset_counts(cls, model_class, object_ids, attrs):
+        """
+        数据库里的计数已经被重新计算过了，删除 redis 里的计数器和没有写回的 deltas
+        下次读取的时候会重新从数据库初始化
+        """
+        if not object_ids:
+            return
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline(transaction=False)
+        for attr in attrs:
+            pipe.delete(*[
+                cls.get_count_key_by_id(model_class, object_id, attr)
+                for object_id in object_ids
+            ])
+            for key in cls.get_count_deltas_keys(model_class, attr):
+                pipe.hdel(key, *object_ids)
+        pipe.execute()
@@ -0,0 +1,15 @@
+from django.db import models
+from rest_framework import serializers
+
+
+class PreloadListSerializer(serializers.ListSerializer):
+    """
+    many=True 的时候，在逐个 serialize 之前先调用 child.preload(objects)
+    把这一页需要的数据一次性批量读出来，避免每一行都单独访问一次 cache 或者数据库
+    """
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        objects = list(iterable)
+        self.child.preload(objects)
+        return super().to_representation(objects)
@@ -1,5 +1,22 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import override_settings
 from testing.testcases import TestCase
+from tweets.models import Tweet
+from twitter.cache import (
+    CACHE_LEASE_PATTERN,
+    CACHE_REBUILD_DIRTY_PATTERN,
+    CACHE_REBUILD_LOCK_PATTERN,
+)
+from utils.local_cache import LocalCache
+from utils.memcached_helper import DOES_NOT_EXIST, MemcachedHelper, cache
+from utils.metrics import Metrics
+from utils.paginations import decode_cursor, encode_cursor
 from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+from utils.time_helpers import utc_now
+
+import os
 
 
 class UtilsTests(TestCase):
@@ -17,3 +34,273 @@ class UtilsTests(TestCase):
         RedisClient.clear()
         cached_list = conn.lrange('redis_key', 0, -1)
         self.assertEqual(cached_list, [])
+
+    def test_redis_client_pool(self):
+        conn = RedisClient.get_connection()
+        self.assertEqual(RedisClient.get_connection() is conn, True)
+        conn.ping()
+        stats = RedisClient.get_pool_stats()[settings.REDIS_DB]
+        self.assertEqual(stats['max_connections'], settings.REDIS_MAX_CONNECTIONS)
+        self.assertEqual(stats['created_connections'] >= 1, True)
+        self.assertEqual(stats['in_use_connections'], 0)
+
+        # subscriber 使用单独的连接，不占用 pool 里的连接
+        subscriber = RedisClient.get_subscriber_connection()
+        self.assertEqual(subscriber.connection_pool is RedisClient.get_pool(), False)
+        subscriber.ping()
+        stats = RedisClient.get_pool_stats()[settings.REDIS_DB]
+        self.assertEqual(stats['in_use_connections'], 0)
+
+        # 模拟 fork 之后 pid 发生了变化，需要重新创建 pool
+        pool = RedisClient.get_pool()
+        RedisClient.pid = -1
+        self.assertEqual(RedisClient.get_pool() is pool, False)
+        self.assertEqual(RedisClient.get_connection() is conn, False)
+        RedisClient.get_connection().ping()
+
+
+    def test_cursor(self):
+        created_at = utc_now()
+        self.assertEqual(decode_cursor(encode_cursor(created_at, 42)), (created_at, 42))
+        self.assertEqual(decode_cursor(encode_cursor(created_at, None)), (created_at, None))
+
+class CacheRebuildTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        Metrics.clear()
+        self.linghu = self.create_user('linghu')
+
+    def test_redis_rebuild_is_single_flight(self):
+        tweets = [self.create_tweet(self.linghu) for _ in range(3)]
+        RedisClient.clear()
+        key = 'test_tweet_ids:{}'.format(self.linghu.id)
+        queryset = Tweet.objects.filter(user=self.linghu).order_by('-id')
+        to_member = lambda tweet: (str(tweet.id), tweet.id)
+        expected = [(str(t.id), t.id) for t in tweets[::-1]]
+
+        # 模拟另外一个请求正在重建 cache
+        conn = RedisClient.get_connection()
+        lock = conn.lock(
+            CACHE_REBUILD_LOCK_PATTERN.format(key=key),
+            timeout=settings.CACHE_REBUILD_LOCK_TIMEOUT,
+        )
+        lock.acquire(blocking=False)
+        items, cached_length = RedisHelper.load_sorted_set_range(key, queryset, to_member)
+        self.assertEqual(items, expected)
+        self.assertEqual(cached_length, 3)
+        # 没有拿到锁的请求不会写 cache
+        self.assertEqual(conn.exists(key), False)
+        counters = Metrics.get_counters()
+        self.assertEqual(counters['redis_cache.rebuild_coalesced'], 1)
+        self.assertEqual(counters['redis_cache.rebuild_wait_timeout'], 1)
+
+        lock.release()
+        items, _ = RedisHelper.load_sorted_set_range(key, queryset, to_member)
+        self.assertEqual(items, expected)
+        self.assertEqual(conn.zcard(key), 3)
+        self.assertEqual(Metrics.get_counters()['redis_cache.rebuild'], 1)
+
+    def test_push_during_rebuild(self):
+        tweets = [self.create_tweet(self.linghu) for _ in range(2)]
+        RedisClient.clear()
+        key = 'test_tweet_ids:{}'.format(self.linghu.id)
+        queryset = Tweet.objects.filter(user=self.linghu).order_by('-id')
+        to_member = lambda tweet: (str(tweet.id), tweet.id)
+        conn = RedisClient.get_connection()
+
+        # 另外一个请求拿到了锁，并且在新的 tweet 创建之前读完了数据库
+        lock = conn.lock(
+            CACHE_REBUILD_LOCK_PATTERN.format(key=key),
+            timeout=settings.CACHE_REBUILD_LOCK_TIMEOUT,
+        )
+        lock.acquire(blocking=False)
+        stale_items = [to_member(tweet) for tweet in queryset]
+        new_tweet = self.create_tweet(self.linghu)
+        RedisHelper.push_to_sorted_set(key, new_tweet, queryset, to_member)
+        self.assertEqual(conn.exists(CACHE_REBUILD_DIRTY_PATTERN.format(key=key)), True)
+
+        # 拿到锁的请求写 cache 的时候发现 cache 是 dirty 的，不会写进去
+        def write(pipe):
+            pipe.zadd(key, dict(stale_items))
+        self.assertEqual(RedisHelper._write_rebuilt_cache(conn, key, write), False)
+        self.assertEqual(conn.exists(key), False)
+        self.assertEqual(Metrics.get_counters()['redis_cache.rebuild_discarded'], 1)
+        lock.release()
+
+        # 下次读取的时候重新从数据库重建，不会丢掉新的 tweet
+        items, cached_length = RedisHelper.load_sorted_set_range(key, queryset, to_member)
+        self.assertEqual(
+            [member for member, _ in items],
+            [str(new_tweet.id)] + [str(t.id) for t in tweets[::-1]],
+        )
+        self.assertEqual(cached_length, 3)
+        self.assertEqual(conn.exists(CACHE_REBUILD_DIRTY_PATTERN.format(key=key)), False)
+
+    def test_memcached_lease(self):
+        tweet = self.create_tweet(self.linghu)
+        key = MemcachedHelper.get_key(Tweet, tweet.id)
+        MemcachedHelper.invalidate_cached_object(Tweet, tweet.id)
+
+        # 模拟另外一个请求拿到了 lease
+        cache.add(CACHE_LEASE_PATTERN.format(key=key), 'token')
+        obj = MemcachedHelper.get_object_through_cache(Tweet, tweet.id)
+        self.assertEqual(obj, tweet)
+        self.assertEqual(cache.get(key), None)
+        self.assertEqual(Metrics.get_counters()['memcached.rebuild_coalesced'], 1)
+
+        # invalidate 会同时删除 lease
+        MemcachedHelper.invalidate_cached_object(Tweet, tweet.id)
+        obj = MemcachedHelper.get_object_through_cache(Tweet, tweet.id)
+        self.assertEqual(obj, tweet)
+        self.assertEqual(cache.get(key), tweet)
+
+    def test_get_objects_through_cache(self):
+        tweets = [self.create_tweet(self.linghu) for _ in range(3)]
+        MemcachedHelper.invalidate_cached_object(Tweet, tweets[0].id)
+        MemcachedHelper.invalidate_cached_object(Tweet, tweets[1].id)
+        MemcachedHelper.get_object_through_cache(Tweet, tweets[2].id)
+
+        ids = [tweet.id for tweet in tweets] + [-1, None]
+        objects = MemcachedHelper.get_objects_through_cache(Tweet, ids)
+        self.assertEqual(objects, {tweet.id: tweet for tweet in tweets})
+        # cache miss 的 objects 被写回了 cache
+        for tweet in tweets:
+            self.assertEqual(cache.get(MemcachedHelper.get_key(Tweet, tweet.id)), tweet)
+        self.assertEqual(MemcachedHelper.get_objects_through_cache(Tweet, []), {})
+
+    def test_negative_cache(self):
+        tweet = self.create_tweet(self.linghu)
+        key = MemcachedHelper.get_key(Tweet, tweet.id)
+        tweet.delete()
+
+        self.assertEqual(MemcachedHelper.get_object_through_cache(Tweet, tweet.id), None)
+        self.assertEqual(cache.get(key), DOES_NOT_EXIST)
+        # 第二次读取命中 negative cache，不会查询数据库
+        with self.assertNumQueries(0):
+            self.assertEqual(MemcachedHelper.get_object_through_cache(Tweet, tweet.id), None)
+            self.assertEqual(MemcachedHelper.get_objects_through_cache(Tweet, [tweet.id]), {})
+        self.assertEqual(Metrics.get_counters()['memcached.negative_hit'], 2)
+        self.assertEqual(MemcachedHelper.get_object_through_cache(Tweet, None), None)
+
+        # 批量读取时不存在的 objects 也会被记录
+        MemcachedHelper.invalidate_cached_object(Tweet, tweet.id)
+        self.assertEqual(MemcachedHelper.get_objects_through_cache(Tweet, [tweet.id]), {})
+        self.assertEqual(cache.get(key), DOES_NOT_EXIST)
+
+        # object 被保存的时候 post_save 会 invalidate negative cache
+        new_tweet = self.create_tweet(self.linghu)
+        cache.set(MemcachedHelper.get_key(Tweet, new_tweet.id), DOES_NOT_EXIST)
+        new_tweet.save()
+        self.assertEqual(
+            MemcachedHelper.get_object_through_cache(Tweet, new_tweet.id),
+            new_tweet,
+        )
+
+
+class RedisCountTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.linghu = self.create_user('linghu')
+
+    def test_get_counts(self):
+        tweets = [self.create_tweet(self.linghu) for _ in range(3)]
+        Tweet.objects.filter(id=tweets[0].id).update(likes_count=2, comments_count=1)
+        conn = RedisClient.get_connection()
+        conn.set(RedisHelper.get_count_key(tweets[1], 'likes_count'), 5)
+
+        counts = RedisHelper.get_counts(tweets, ['likes_count', 'comments_count'])
+        self.assertEqual(counts[tweets[0].id], {'likes_count': 2, 'comments_count': 1})
+        # cache 里已有的值优先
+        self.assertEqual(counts[tweets[1].id], {'likes_count': 5, 'comments_count': 0})
+        self.assertEqual(counts[tweets[2].id], {'likes_count': 0, 'comments_count': 0})
+
+        # miss 的部分被写回了 cache
+        key = RedisHelper.get_count_key(tweets[0], 'likes_count')
+        self.assertEqual(conn.get(key), b'2')
+        self.assertEqual(conn.ttl(key) > 0, True)
+        self.assertEqual(RedisHelper.get_counts([], ['likes_count']), {})
+
+    def test_incr_and_decr_count(self):
+        tweet = self.create_tweet(self.linghu)
+        conn = RedisClient.get_connection()
+        key = RedisHelper.get_count_key(tweet, 'likes_count')
+
+        # cache miss 的时候不初始化，也不需要读数据库
+        with self.assertNumQueries(0):
+            self.assertEqual(RedisHelper.incr_count(Tweet(id=tweet.id), 'likes_count'), None)
+        self.assertEqual(conn.exists(key), False)
+
+        # 读取的时候从数据库初始化，之后的变化直接修改计数器
+        Tweet.objects.filter(id=tweet.id).update(likes_count=3)
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 3)
+        self.assertEqual(conn.ttl(key) > 0, True)
+        self.assertEqual(RedisHelper.incr_count(Tweet(id=tweet.id), 'likes_count'), 4)
+        self.assertEqual(RedisHelper.decr_count(Tweet(id=tweet.id), 'likes_count'), 3)
+
+    def test_concurrent_writers_on_cold_counter(self):
+        tweet = self.create_tweet(self.linghu)
+        dongxie = self.create_user('dongxie')
+        conn = RedisClient.get_connection()
+        key = RedisHelper.get_count_key(tweet, 'likes_count')
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 0)
+
+        # 计数器过期之后两个写请求都在数据库里 +1，redis 里都是 miss
+        conn.delete(key)
+        self.create_like(self.linghu, tweet)
+        self.create_like(dongxie, tweet)
+        self.assertEqual(conn.exists(key), False)
+        # 不会多算也不会少算
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 2)
+        self.create_like(self.create_user('someone'), tweet)
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 3)
+        tweet.refresh_from_db()
+        self.assertEqual(tweet.likes_count, 3)
+
+
+@override_settings(LOCAL_CACHE_ENABLED=True, LOCAL_CACHE_MAX_SIZE=2)
+class LocalCacheTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        Metrics.clear()
+        LocalCache.clear()
+        # 测试里不启动 subscriber 线程，直接调用 _handle_message
+        LocalCache.subscriber_pid = os.getpid()
+        self.linghu = self.create_user('linghu')
+
+    def tearDown(self):
+        LocalCache.clear()
+
+    def test_lru_and_copy(self):
+        LocalCache.set('a', self.linghu)
+        LocalCache.set('b', self.linghu)
+        self.assertEqual(LocalCache.get('a'), self.linghu)
+        LocalCache.set('c', self.linghu)
+        # b 是最久没有访问的 key，被淘汰了
+        self.assertEqual(LocalCache.get('b'), None)
+        self.assertEqual(LocalCache.get('c'), self.linghu)
+
+        # 修改返回的 object 不会影响 L1 里保存的 object
+        user = LocalCache.get('a')
+        user.username = 'changed'
+        self.assertEqual(LocalCache.get('a').username, 'linghu')
+
+        self.assertEqual(LocalCache.get_stats(), {'size': 2, 'hits': 4, 'misses': 1})
+
+        LocalCache._handle_message({'type': 'message', 'data': b'a'})
+        self.assertEqual(LocalCache.get('a'), None)
+
+    def test_memcached_helper_uses_local_cache(self):
+        key = MemcachedHelper.get_key(User, self.linghu.id)
+        user = MemcachedHelper.get_object_through_cache(User, self.linghu.id)
+        self.assertEqual(user, self.linghu)
+        # memcached 里的数据被删除之后仍然可以从 L1 里读到
+        cache.delete(key)
+        self.assertEqual(MemcachedHelper.get_object_through_cache(User, self.linghu.id), user)
+        self.assertEqual(LocalCache.get_stats()['hits'], 1)
+
+        # invalidate 会同时删除 L1 里的数据
+        MemcachedHelper.invalidate_cached_object(User, self.linghu.id)
+        self.assertEqual(LocalCache.get(key), None)
@@ -1,6 +1,21 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
 
 def utc_now():
     return datetime.now().replace(tzinfo=pytz.utc)
+
+
+def datetime_to_microseconds(value):
+    # 转换成 UTC 的 microseconds 整数，用于 redis 里的序列化数据和 sorted set 的 score
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=pytz.utc)
+    # 用 timedelta 整除而不是 timestamp() * 10^6，避免浮点数丢失精度
+    return (value - EPOCH) // ONE_MICROSECOND
+
+
+def microseconds_to_datetime(value):
+    return EPOCH + timedelta(microseconds=int(value))